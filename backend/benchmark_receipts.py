@@ -0,0 +1,95 @@
+"""
+Receipt Rendering Benchmark
+Times the thermal receipt renderers (ESC/POS, plain text, narrow 80mm PDF)
+against the A4 invoice PDF on synthetic invoices, and checks each receipt
+format against the per-receipt render budget.
+
+Usage:
+    python benchmark_receipts.py [--items 8] [--repeat 200] [--budget-ms 10]
+"""
+import argparse
+import random
+import statistics
+import time
+
+from thermal_receipt import render_receipt
+
+SHOP = {"shop_name": "Gold Jewellery ERP", "address": "123 Main Street, City, Country", "phone": "+968 1234 5678"}
+
+
+def make_invoice(items: int) -> dict:
+    lines = []
+    for _ in range(items):
+        weight = round(random.uniform(1, 50), 3)
+        rate = round(random.uniform(20, 30), 3)
+        gold_value = round(weight * rate, 3)
+        lines.append({
+            "description": random.choice(["22K Ring", "22K Chain", "21K Bangle", "18K Necklace"]),
+            "qty": 1,
+            "weight": weight,
+            "net_gold_weight": weight,
+            "metal_rate": rate,
+            "gold_value": gold_value,
+            "making_value": 10.0,
+            "vat_amount": round(gold_value * 0.05, 3),
+            "line_total": round(gold_value * 1.05 + 10, 3),
+        })
+    subtotal = sum(i["gold_value"] + i["making_value"] for i in lines)
+    vat_total = sum(i["vat_amount"] for i in lines)
+    return {
+        "invoice_number": "INV-2024-0001",
+        "date": "2024-01-01T10:00:00+00:00",
+        "customer_name": "Walk-in Customer",
+        "invoice_type": "sale",
+        "payment_status": "paid",
+        "items": lines,
+        "subtotal": round(subtotal, 3),
+        "discount_amount": 0.0,
+        "vat_total": round(vat_total, 3),
+        "grand_total": round(subtotal + vat_total, 3),
+        "paid_amount": round(subtotal + vat_total, 3),
+        "balance_due": 0.0,
+    }
+
+
+def timed(fn, repeat: int) -> list:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name: str, samples: list, budget_ms: float = None) -> bool:
+    median = statistics.median(samples)
+    p95 = sorted(samples)[int(len(samples) * 0.95) - 1]
+    within = budget_ms is None or p95 <= budget_ms
+    verdict = "" if budget_ms is None else ("  ✅" if within else f"  ❌ over {budget_ms} ms budget")
+    print(f"  {name:<28}: median {median:7.3f} ms   p95 {p95:7.3f} ms{verdict}")
+    return within
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--budget-ms", type=float, default=10.0)
+    args = parser.parse_args()
+
+    random.seed(42)
+    invoice = make_invoice(args.items)
+    print(f"Invoice with {args.items} items, {args.repeat} renders each")
+
+    ok = True
+    for output_format in ("escpos", "text", "pdf"):
+        ok &= report(f"receipt {output_format}", timed(lambda: render_receipt(invoice, SHOP, output_format), args.repeat), args.budget_ms)
+    ok &= report("receipt escpos + breakdown", timed(lambda: render_receipt(invoice, SHOP, "escpos", True), args.repeat), args.budget_ms)
+
+    from invoice_pdf import render_invoice_pdf
+    report("A4 invoice PDF (reference)", timed(lambda: render_invoice_pdf(invoice), args.repeat))
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
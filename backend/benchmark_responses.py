@@ -0,0 +1,174 @@
+"""
+Response Encoding Benchmark
+Compares the legacy serialization path (decimal_to_float + jsonable_encoder +
+json.dumps) against MongoJSONResponse (single orjson pass) on payloads shaped
+like the /api/invoices and /api/transactions list responses.
+
+Usage:
+    python benchmark_responses.py [--rows 500] [--repeat 20]
+"""
+import argparse
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from bson import Decimal128, ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from json_response import MongoJSONResponse
+
+
+def decimal_to_float(obj):
+    """Same conversion as server.decimal_to_float (copied to avoid a DB connection on import)"""
+    if isinstance(obj, dict):
+        return {k: decimal_to_float(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [decimal_to_float(item) for item in obj]
+    elif isinstance(obj, Decimal128):
+        return float(obj.to_decimal())
+    elif isinstance(obj, datetime):
+        return obj.isoformat()
+    elif isinstance(obj, ObjectId):
+        return str(obj)
+    return obj
+
+
+def money(value: float, places: str = '0.001') -> Decimal128:
+    return Decimal128(Decimal(str(value)).quantize(Decimal(places)))
+
+
+def make_invoice(n: int) -> dict:
+    created = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=n)
+    items = []
+    for _ in range(random.randint(1, 6)):
+        weight = round(random.uniform(1, 50), 3)
+        rate = round(random.uniform(20, 30), 3)
+        gold_value = round(weight * rate, 3)
+        items.append({
+            "id": str(uuid.uuid4()),
+            "category": random.choice(["Ring", "Chain", "Bangle", "Necklace"]),
+            "description": "22K gold item",
+            "qty": 1,
+            "gross_weight": weight,
+            "stone_weight": 0.0,
+            "net_gold_weight": weight,
+            "weight": weight,
+            "purity": 916,
+            "metal_rate": rate,
+            "gold_value": gold_value,
+            "making_charge_type": "per_gram",
+            "making_value": 10.0,
+            "stone_charges": 0.0,
+            "wastage_charges": 0.0,
+            "item_discount": 0.0,
+            "vat_percent": 5.0,
+            "vat_amount": round(gold_value * 0.05, 3),
+            "line_total": round(gold_value * 1.05, 3),
+        })
+    grand_total = sum(i["line_total"] for i in items)
+    return {
+        "_id": ObjectId(),
+        "id": str(uuid.uuid4()),
+        "invoice_number": f"INV-2024-{n:04d}",
+        "date": created,
+        "created_at": created,
+        "customer_type": "saved",
+        "customer_id": str(uuid.uuid4()),
+        "customer_name": f"Customer {n}",
+        "invoice_type": "sale",
+        "payment_status": "partial",
+        "status": "finalized",
+        "finalized_at": created,
+        "items": items,
+        "subtotal": money(grand_total / 1.05),
+        "vat_total": money(grand_total - grand_total / 1.05),
+        "grand_total": money(grand_total),
+        "paid_amount": money(grand_total / 2),
+        "balance_due": money(grand_total / 2),
+        "created_by": str(uuid.uuid4()),
+        "is_deleted": False,
+    }
+
+
+def make_transaction(n: int) -> dict:
+    created = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=n)
+    return {
+        "_id": ObjectId(),
+        "id": str(uuid.uuid4()),
+        "transaction_number": f"TXN-2024-{n:04d}",
+        "date": created,
+        "created_at": created,
+        "transaction_type": random.choice(["credit", "debit"]),
+        "mode": "cash",
+        "account_id": str(uuid.uuid4()),
+        "account_name": "Cash",
+        "party_id": str(uuid.uuid4()),
+        "party_name": f"Party {n}",
+        "amount": money(random.uniform(1, 5000)),
+        "category": "Sales",
+        "reference_type": "invoice",
+        "reference_id": str(uuid.uuid4()),
+        "account_type": "asset",
+        "account_current_balance": 1000.0,
+        "transaction_source": "Invoice Payment",
+        "balance_before": 10.0,
+        "balance_after": 20.0,
+        "created_by": str(uuid.uuid4()),
+        "is_deleted": False,
+    }
+
+
+def paginated(items: list) -> dict:
+    return {
+        "items": items,
+        "pagination": {"total_count": len(items), "page": 1, "page_size": len(items),
+                       "total_pages": 1, "has_next": False, "has_prev": False},
+    }
+
+
+def legacy_render(docs: list) -> bytes:
+    content = paginated([decimal_to_float(d) for d in docs])
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def orjson_render(docs: list) -> bytes:
+    return MongoJSONResponse(paginated(docs)).body
+
+
+def timed(fn, docs: list, repeat: int) -> list:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(docs)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name: str, docs: list, repeat: int):
+    legacy = timed(legacy_render, docs, repeat)
+    fast = timed(orjson_render, docs, repeat)
+    legacy_ms = statistics.median(legacy)
+    fast_ms = statistics.median(fast)
+    print(f"{name} ({len(docs)} rows, {len(orjson_render(docs)) / 1024:.1f} KiB)")
+    print(f"  legacy  decimal_to_float + jsonable_encoder + json : {legacy_ms:8.2f} ms")
+    print(f"  orjson  MongoJSONResponse                          : {fast_ms:8.2f} ms")
+    print(f"  speedup                                            : {legacy_ms / fast_ms:8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(42)
+    report("/api/invoices", [make_invoice(i) for i in range(args.rows)], args.repeat)
+    report("/api/transactions", [make_transaction(i) for i in range(args.rows)], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
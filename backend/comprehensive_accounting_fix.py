@@ -436,10 +436,15 @@ async def validate_double_entry():
     """Validate that all transactions follow double-entry (sum of debits = sum of credits)"""
     print("\n[STEP 6] Validating double-entry bookkeeping...")
     
-    transactions = await db.transactions.find({"is_deleted": False}).to_list(None)
-    
-    total_debits = sum(t.get('amount', 0) for t in transactions if t.get('transaction_type') == 'debit')
-    total_credits = sum(t.get('amount', 0) for t in transactions if t.get('transaction_type') == 'credit')
+    # Summed server-side - no need to load every transaction
+    totals = await db.transactions.aggregate([
+        {"$match": {"is_deleted": False}},
+        {"$group": {"_id": "$transaction_type", "amount": {"$sum": "$amount"}}}
+    ]).to_list(None)
+    totals = {row['_id']: float(str(row['amount'])) for row in totals}
+    
+    total_debits = totals.get('debit', 0)
+    total_credits = totals.get('credit', 0)
     
     print(f"  Total debit transactions: {total_debits:.2f}")
     print(f"  Total credit transactions: {total_credits:.2f}")
@@ -0,0 +1,155 @@
+"""
+Invoice PDF Rendering
+---------------------
+Draws invoices with ReportLab. Used by the single-invoice PDF endpoint and by
+the bulk endpoint, which runs these functions inside worker processes.
+
+Everything here works on plain dicts (decimal_to_float output) so invoices can
+be pickled to a worker process. ReportLab and the page layout constants are
+loaded once per process (see warm_up) instead of once per invoice.
+"""
+
+from io import BytesIO
+from typing import Any, Dict, List, Tuple
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+
+PAGE_SIZE = A4
+SHOP_TITLE = "Gold Shop ERP"
+SHOP_SUBTITLE = "The Artisan Ledger"
+FOOTER_TEXT = "Thank you for your business!"
+
+# (x position, header label) of the item table columns
+ITEM_COLUMNS = [(50, "Item"), (250, "Qty"), (300, "Weight"), (370, "Rate"), (450, "Total")]
+
+
+def warm_up():
+    """
+    Process pool initializer: build a throwaway page so ReportLab's font
+    metrics and encodings are loaded before the first real invoice arrives.
+    """
+    c = canvas.Canvas(BytesIO(), pagesize=PAGE_SIZE)
+    for font in ("Helvetica", "Helvetica-Bold", "Helvetica-Oblique"):
+        c.setFont(font, 10)
+        c.stringWidth("0", font, 10)
+
+
+def invoice_pdf_filename(invoice: Dict[str, Any]) -> str:
+    return f"invoice_{invoice.get('invoice_number', 'unknown')}.pdf"
+
+
+def draw_invoice(p: canvas.Canvas, invoice: Dict[str, Any]):
+    """
+    Draw one invoice onto a canvas, starting on a fresh page and ending with
+    showPage(), so several invoices can share one canvas.
+
+    Args:
+        p: ReportLab canvas
+        invoice: Invoice document with numeric amounts (decimal_to_float output)
+    """
+    width, height = PAGE_SIZE
+
+    # Header
+    p.setFont("Helvetica-Bold", 20)
+    p.drawString(50, height - 50, SHOP_TITLE)
+    p.setFont("Helvetica", 10)
+    p.drawString(50, height - 70, SHOP_SUBTITLE)
+
+    # Invoice details
+    p.setFont("Helvetica-Bold", 16)
+    p.drawString(50, height - 120, f"Invoice #{invoice.get('invoice_number', '')}")
+    p.setFont("Helvetica", 10)
+    date_str = str(invoice.get('date', ''))[:10]
+    p.drawString(50, height - 140, f"Date: {date_str}")
+    p.drawString(50, height - 155, f"Customer: {invoice.get('customer_name', 'N/A')}")
+    p.drawString(50, height - 170, f"Type: {invoice.get('invoice_type', 'sale').upper()}")
+    p.drawString(50, height - 185, f"Status: {invoice.get('payment_status', 'unpaid').upper()}")
+
+    # Items table
+    y_position = height - 230
+    p.setFont("Helvetica-Bold", 10)
+    for x, label in ITEM_COLUMNS:
+        p.drawString(x, y_position, label)
+
+    p.setFont("Helvetica", 9)
+    y_position -= 20
+
+    for item in invoice.get('items', []):
+        p.drawString(50, y_position, (item.get('description') or '')[:30])
+        p.drawString(250, y_position, str(item.get('qty', 0)))
+        p.drawString(300, y_position, f"{item.get('weight', 0)}g")
+        p.drawString(370, y_position, f"{item.get('metal_rate', 0):.2f}")
+        p.drawString(450, y_position, f"{item.get('line_total', 0):.2f}")
+        y_position -= 15
+
+        if y_position < 100:
+            p.showPage()
+            p.setFont("Helvetica", 9)
+            y_position = height - 50
+
+    # Totals
+    y_position -= 20
+    p.setFont("Helvetica-Bold", 10)
+    p.drawString(370, y_position, "Subtotal:")
+    p.drawString(450, y_position, f"{invoice.get('subtotal', 0):.2f} OMR")
+
+    # MODULE 7: Add discount line if discount exists
+    discount_amount = invoice.get('discount_amount') or 0
+    if discount_amount > 0:
+        y_position -= 15
+        p.setFont("Helvetica", 10)
+        p.drawString(370, y_position, "Discount:")
+        p.drawString(450, y_position, f"-{discount_amount:.2f} OMR")
+
+    y_position -= 15
+    p.setFont("Helvetica-Bold", 10)
+    p.drawString(370, y_position, "VAT:")
+    p.drawString(450, y_position, f"{invoice.get('vat_total', 0):.2f} OMR")
+    y_position -= 15
+    p.setFont("Helvetica-Bold", 12)
+    p.drawString(370, y_position, "Grand Total:")
+    p.drawString(450, y_position, f"{invoice.get('grand_total', 0):.2f} OMR")
+    y_position -= 15
+    p.setFont("Helvetica", 10)
+    p.drawString(370, y_position, "Balance Due:")
+    p.drawString(450, y_position, f"{invoice.get('balance_due', 0):.2f} OMR")
+
+    # Footer
+    p.setFont("Helvetica-Oblique", 8)
+    p.drawString(50, 50, FOOTER_TEXT)
+
+    p.showPage()
+
+
+def render_invoice_pdf(invoice: Dict[str, Any]) -> bytes:
+    """Render a single invoice to PDF bytes."""
+    buffer = BytesIO()
+    p = canvas.Canvas(buffer, pagesize=PAGE_SIZE)
+    draw_invoice(p, invoice)
+    p.save()
+    return buffer.getvalue()
+
+
+def render_invoice_pdfs(invoices: List[Dict[str, Any]]) -> List[Tuple[str, bytes]]:
+    """
+    Render a chunk of invoices to separate PDFs (one ZIP entry each).
+
+    Returns:
+        List of (filename, pdf bytes) in input order
+    """
+    return [(invoice_pdf_filename(invoice), render_invoice_pdf(invoice)) for invoice in invoices]
+
+
+def render_merged_pdf(invoices: List[Dict[str, Any]]) -> bytes:
+    """
+    Render many invoices into one PDF on a single canvas: fonts and resources
+    are set up once and each invoice simply starts on a new page.
+    """
+    buffer = BytesIO()
+    p = canvas.Canvas(buffer, pagesize=PAGE_SIZE)
+    for invoice in invoices:
+        draw_invoice(p, invoice)
+    p.save()
+    return buffer.getvalue()
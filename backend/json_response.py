@@ -0,0 +1,65 @@
+"""
+Fast JSON Response Encoding
+---------------------------
+orjson-based response class used as the application default.
+
+MongoDB documents reach the handlers with Decimal128 amounts, ObjectId keys
+and datetime values. Instead of walking every document with decimal_to_float
+and then letting FastAPI's jsonable_encoder walk it again, handlers can return
+MongoJSONResponse directly and the conversion happens inside orjson's single
+C-level serialization pass through the default hook below.
+"""
+
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from bson import Decimal128, ObjectId
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def orjson_default(obj: Any) -> Any:
+    """
+    Fallback encoder for types orjson does not serialize natively.
+
+    Matches decimal_to_float output: Decimal128/Decimal become floats and
+    ObjectId becomes its hex string. datetime is native to orjson and emitted
+    in the same ISO 8601 format as datetime.isoformat().
+    """
+    if isinstance(obj, Decimal128):
+        return float(obj.to_decimal())
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if isinstance(obj, (datetime, date)):
+        # datetime subclasses orjson refuses (e.g. bson-specific wrappers)
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """Serialize content to JSON bytes using the shared orjson configuration."""
+    return orjson.dumps(content, default=orjson_default, option=ORJSON_OPTIONS)
+
+
+class MongoJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson.
+
+    Accepts raw MongoDB documents (Decimal128, ObjectId, datetime) so list
+    endpoints can skip the decimal_to_float pre-pass entirely.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
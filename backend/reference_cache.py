@@ -0,0 +1,151 @@
+"""
+Reference Data Cache
+--------------------
+In-process cache for small, rarely changing collections (accounts, inventory
+headers, jobcard templates, shop settings).
+
+Each cache loads its whole collection once, keeps an id index and a name
+index, and is invalidated explicitly by the endpoints that create, rename or
+delete records. A TTL acts as a safety net when several worker processes
+share one database and an invalidation happens in another process. A load
+that overlaps an invalidation is discarded and retried, so a write can never
+be hidden behind a pre-write snapshot for a whole TTL.
+
+IMPORTANT: Only reference fields are cached (ids, names, types, flags).
+Running balances (accounts.current_balance, inventory_headers.current_qty /
+current_weight) change on every transaction and must always be read live;
+they are excluded from the cached projections.
+"""
+
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+
+class ReferenceCache:
+    """
+    Cache for one reference collection with id and name lookups.
+
+    Args:
+        collection: Motor collection to load from
+        label: Name used in stats output
+        query: Filter selecting the cached documents
+        projection: Fields to cache (always excludes _id)
+        name_field: Field indexed for name lookups (None to disable)
+        ttl_seconds: Maximum age before a transparent reload
+        keep_deleted: Also load soft-deleted documents (is_deleted: True). They
+                      are only returned to callers passing include_deleted=True,
+                      e.g. to resolve historical records; the default query
+                      then selects every document.
+    """
+
+    def __init__(
+        self,
+        collection,
+        label: str,
+        query: Optional[Dict[str, Any]] = None,
+        projection: Optional[Dict[str, int]] = None,
+        name_field: Optional[str] = "name",
+        ttl_seconds: float = 300.0,
+        keep_deleted: bool = False
+    ):
+        self.collection = collection
+        self.label = label
+        self.keep_deleted = keep_deleted
+        if query is None:
+            query = {} if keep_deleted else {"is_deleted": False}
+        self.query = query
+        self.projection = {"_id": 0, **(projection or {})}
+        if keep_deleted and projection:
+            self.projection["is_deleted"] = 1
+        self.name_field = name_field
+        self.ttl_seconds = ttl_seconds
+
+        self._docs: Optional[List[Dict[str, Any]]] = None
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._by_name: Dict[str, Dict[str, Any]] = {}
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def _is_fresh(self) -> bool:
+        return self._docs is not None and (time.monotonic() - self._loaded_at) < self.ttl_seconds
+
+    async def _ensure_loaded(self):
+        if self._is_fresh():
+            self.hits += 1
+            return
+        async with self._lock:
+            # Another coroutine may have reloaded while we waited
+            if self._is_fresh():
+                self.hits += 1
+                return
+            self.misses += 1
+            while True:
+                generation = self._generation
+                docs = await self.collection.find(self.query, self.projection).to_list(None)
+                if generation == self._generation:
+                    break
+                # invalidate() ran during the read - it may predate the write
+            self._by_id = {doc["id"]: doc for doc in docs if "id" in doc}
+            self._by_name = {}
+            if self.name_field:
+                for doc in docs:
+                    name = doc.get(self.name_field)
+                    if name is not None and self._visible(doc, False):
+                        self._by_name.setdefault(name, doc)
+            self._docs = docs
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+
+    def _visible(self, doc: Dict[str, Any], include_deleted: bool) -> bool:
+        return include_deleted or not (self.keep_deleted and doc.get("is_deleted"))
+
+    async def all(self, include_deleted: bool = False) -> List[Dict[str, Any]]:
+        """All cached documents (shallow copies, safe to mutate)."""
+        await self._ensure_loaded()
+        return [dict(doc) for doc in self._docs if self._visible(doc, include_deleted)]
+
+    async def get_by_id(self, doc_id: str, include_deleted: bool = False) -> Optional[Dict[str, Any]]:
+        await self._ensure_loaded()
+        doc = self._by_id.get(doc_id)
+        return dict(doc) if doc and self._visible(doc, include_deleted) else None
+
+    async def get_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        await self._ensure_loaded()
+        doc = self._by_name.get(name)
+        return dict(doc) if doc else None
+
+    async def first(self) -> Optional[Dict[str, Any]]:
+        """First cached document - for singleton collections such as shop settings."""
+        await self._ensure_loaded()
+        docs = [doc for doc in self._docs if self._visible(doc, False)]
+        return dict(docs[0]) if docs else None
+
+    def invalidate(self):
+        """Drop cached data; the next read reloads from the database."""
+        self._docs = None
+        self._by_id = {}
+        self._by_name = {}
+        self._generation += 1
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "collection": self.label,
+            "cached_documents": len(self._docs) if self._docs is not None else 0,
+            "loaded": self._docs is not None,
+            "age_seconds": round(time.monotonic() - self._loaded_at, 1) if self._docs is not None else None,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "loads": self.loads,
+            "invalidations": self.invalidations
+        }
@@ -18,6 +18,8 @@ import jwt
 from decimal import Decimal
 from bson import Decimal128, ObjectId
 import secrets
+from json_response import MongoJSONResponse
+from reference_cache import ReferenceCache
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -119,7 +121,9 @@ def get_user_identifier(request: Request) -> str:
 # Initialize rate limiter with custom key function
 limiter = Limiter(key_func=get_user_identifier)
 
-app = FastAPI()
+# orjson-backed default response class: Decimal128/ObjectId/datetime are encoded
+# natively, so hot list endpoints can return raw Mongo documents (see json_response.py)
+app = FastAPI(default_response_class=MongoJSONResponse)
 api_router = APIRouter(prefix="/api")
 
 # Add rate limiter to app state
@@ -206,81 +210,420 @@ class SecurityHeadersMiddleware(BaseHTTPMiddleware):
 
 
 # ============================================================================
-# INPUT SANITIZATION MIDDLEWARE
+# INPUT SANITIZATION
 # ============================================================================
+# Sanitization is schema-aware: free-text fields on the Pydantic models below are
+# annotated with SafeStr (or validators.sanitized_text) and are cleaned while the
+# model validates. IDs, dates, enums and numeric strings are never re-processed,
+# and request bodies are no longer parsed twice by a middleware.
 
-from validators import sanitize_html, sanitize_text_field, PartyValidator
-import json
+from validators import SafeStr, PartyValidator
 
-class InputSanitizationMiddleware(BaseHTTPMiddleware):
+
+# ============================================================================
+# RESPONSE COMPRESSION MIDDLEWARE
+# ============================================================================
+
+import zlib
+
+try:
+    import brotli  # Optional - gzip is used when brotli is not installed
+    BROTLI_AVAILABLE = True
+except ImportError:
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+from starlette.datastructures import Headers, MutableHeaders
+
+class CompressionMiddleware:
     """
-    Middleware to automatically sanitize all incoming request data.
+    Pure ASGI middleware that compresses responses with brotli or gzip,
+    negotiated from the client's Accept-Encoding header.
     
-    Protection Features:
-    - Removes HTML tags and scripts from text inputs
-    - Escapes special characters
-    - Validates data types
-    - Prevents XSS attacks through input sanitization
+    Behaviour:
+    - brotli is preferred when installed and accepted, gzip otherwise
+    - Single-body responses smaller than minimum_size are sent uncompressed
+    - StreamingResponse bodies are compressed chunk by chunk (flushed per chunk)
+    - Already-compressed media (PDF, XLSX, ZIP, images) and responses that
+      already carry a Content-Encoding are passed through untouched
     
-    Applied to all POST, PUT, PATCH requests with JSON body.
+    Configuration (environment):
+    - COMPRESSION_MIN_SIZE       minimum body size in bytes (default 1024)
+    - COMPRESSION_GZIP_LEVEL     zlib level 1-9 (default 6)
+    - COMPRESSION_BROTLI_QUALITY brotli quality 0-11 (default 4)
     """
     
-    def sanitize_value(self, value: Any) -> Any:
-        """
-        Recursively sanitize values in request data.
-        """
-        if isinstance(value, str):
-            # Only sanitize strings that are not UUIDs, dates, or specific fields
-            # Avoid sanitizing IDs, dates, and technical fields
-            if len(value) > 0 and not self._is_technical_field(value):
-                return sanitize_html(value)
-            return value
-        elif isinstance(value, dict):
-            return {k: self.sanitize_value(v) for k, v in value.items()}
-        elif isinstance(value, list):
-            return [self.sanitize_value(item) for item in value]
-        else:
-            return value
+    # Media types that are already compressed containers - recompressing wastes CPU
+    SKIP_MEDIA_TYPES = (
+        'application/pdf',
+        'application/zip',
+        'application/gzip',
+        'application/vnd.openxmlformats-officedocument',
+        'image/',
+        'audio/',
+        'video/',
+    )
+    
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
     
-    def _is_technical_field(self, value: str) -> bool:
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        encoding = self._negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        responder = _CompressionResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+    
+    @staticmethod
+    def _negotiate(accept_encoding: str) -> Optional[str]:
         """
-        Check if value is a technical field that shouldn't be sanitized.
-        Returns True for UUIDs, ISO dates, email-like patterns.
+        Pick 'br' or 'gzip' from an Accept-Encoding header: the supported
+        coding with the highest q-value wins ('*' covers codings not listed,
+        ties prefer br). Returns None when neither is acceptable.
         """
-        # Check for UUID pattern
-        if re.match(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', value, re.IGNORECASE):
-            return True
-        # Check for ISO date pattern
-        if re.match(r'^\d{4}-\d{2}-\d{2}', value):
-            return True
-        # Short technical strings (likely IDs)
-        if len(value) < 5 and value.replace('-', '').replace('_', '').isalnum():
-            return True
-        return False
+        accepted = {}
+        for part in accept_encoding.lower().split(','):
+            token, *params = [piece.strip() for piece in part.split(';')]
+            if not token:
+                continue
+            q = 1.0
+            for param in params:
+                if param.startswith('q='):
+                    try:
+                        q = float(param[2:])
+                    except ValueError:
+                        q = 0.0
+            accepted[token] = q
+        
+        supported = ('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)
+        best, best_q = None, 0.0
+        for encoding in supported:
+            q = accepted.get(encoding, accepted.get('*', 0.0))
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+    
+    def create_compressor(self, encoding: str):
+        if encoding == 'br':
+            return brotli.Compressor(quality=self.brotli_quality)
+        # wbits=31 -> gzip container
+        return zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+
+
+class _CompressionResponder:
+    """Per-request state for CompressionMiddleware (buffers the start message)."""
+    
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.downstream_send = send
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+    
+    def _compress(self, chunk: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self.compressor.process(chunk) + self.compressor.flush()
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def _finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush(zlib.Z_FINISH)
+    
+    async def send(self, message):
+        message_type = message["type"]
+        
+        if message_type == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            if "content-encoding" in headers or content_type.startswith(CompressionMiddleware.SKIP_MEDIA_TYPES):
+                self.passthrough = True
+                await self.downstream_send(message)
+            else:
+                # Hold until the first body chunk tells us the size/streaming mode
+                self.start_message = message
+            return
+        
+        if message_type != "http.response.body" or self.passthrough:
+            await self.downstream_send(message)
+            return
+        
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        
+        if self.start_message is not None:
+            start_message, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start_message["headers"])
+            
+            if not more_body and len(body) < self.middleware.minimum_size:
+                # Small single-chunk body - not worth compressing
+                self.passthrough = True
+                await self.downstream_send(start_message)
+                await self.downstream_send(message)
+                return
+            
+            self.compressor = self.middleware.create_compressor(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            if "accept-encoding" not in headers.get("vary", "").lower():
+                headers.add_vary_header("Accept-Encoding")
+            
+            if not more_body:
+                compressed = self._compress(body) + self._finish()
+                headers["Content-Length"] = str(len(compressed))
+                await self.downstream_send(start_message)
+                await self.downstream_send({"type": "http.response.body", "body": compressed})
+                return
+            
+            # Streaming - final length is unknown
+            if "content-length" in headers:
+                del headers["Content-Length"]
+            await self.downstream_send(start_message)
+        
+        chunk = self._compress(body) if body else b""
+        if not more_body:
+            chunk += self._finish()
+        await self.downstream_send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+
+# ============================================================================
+# IDEMPOTENCY KEYS
+# ============================================================================
+# Payment and finalize calls can be retried safely when the client sends an
+# Idempotency-Key header: the first response is stored (idempotency_keys,
+# TTL-indexed on expires_at) and replayed for every retry with the same key.
+# While the first request is still running, duplicates get 409 + Retry-After
+# instead of executing a second time.
+#
+# Keys are scoped per user and endpoint. Reusing a key with a different body
+# is rejected (422). 5xx responses and 409 conflicts are not stored - the
+# lock is dropped so a retry executes again.
+#
+# A running request refreshes its lock (locked_at) every heartbeat, so only
+# a lock whose request died (no heartbeat for the whole timeout) is taken
+# over - a slow finalize-batch is never executed twice.
+
+from pymongo.errors import DuplicateKeyError
+
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+IDEMPOTENCY_LOCK_TIMEOUT_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT_SECONDS', '120'))  # No heartbeat for this long = crashed request
+IDEMPOTENCY_LOCK_HEARTBEAT_SECONDS = max(1, IDEMPOTENCY_LOCK_TIMEOUT_SECONDS // 4)
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+
+# POST endpoints that honour Idempotency-Key
+IDEMPOTENT_PATHS = [re.compile(pattern) for pattern in (
+    r"^/api/invoices/[^/]+/add-payments?$",
+    r"^/api/invoices/[^/]+/finalize$",
+    r"^/api/invoices/finalize-batch$",
+    r"^/api/purchases/[^/]+/add-payment$",
+    r"^/api/parties/[^/]+/(receipts|vendor-payments)$",
+)]
+
+# Response headers kept with the stored response
+IDEMPOTENCY_REPLAY_HEADERS = ("content-type", "etag", "cache-control", "location")
+
+
+class IdempotencyMiddleware:
+    """
+    Pure ASGI middleware implementing Idempotency-Key for IDEMPOTENT_PATHS.
+    
+    Flow for a request carrying the header:
+    1. Insert {_id: scope hash, status: in_progress} - the unique _id is the lock
+    2. On DuplicateKeyError: replay the stored response (completed), answer
+       409 (still in progress) or take over a lock whose request died
+    3. Run the endpoint (heartbeating the lock), capture its response and
+       store it (status < 500, not 409)
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not any(p.match(scope["path"]) for p in IDEMPOTENT_PATHS):
+            await self.app(scope, receive, send)
+            return
+        
+        headers = Headers(scope=scope)
+        key = headers.get("idempotency-key")
+        if not key:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+            await self._send_json(send, 400, {"detail": f"Idempotency-Key must be at most {IDEMPOTENCY_MAX_KEY_LENGTH} characters"})
+            return
+        
+        user_id = self._user_id(scope, headers)
+        if not user_id:
+            # Unauthenticated - the endpoint rejects it; nothing worth storing
+            await self.app(scope, receive, send)
+            return
+        
+        # Buffer the body once (for the fingerprint) and replay it to the app
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        body = bytes(body)
+        
+        body_sent = False
+        
+        async def replay_receive():
+            nonlocal body_sent
+            if body_sent:
+                return await receive()  # disconnect notifications
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        
+        record_id = hashlib.sha256(f"{user_id}|{scope['path']}|{key}".encode("utf-8")).hexdigest()
+        fingerprint = hashlib.sha256(body).hexdigest()
+        now = datetime.now(timezone.utc)
+        
+        lock_owner = str(uuid.uuid4())
+        acquired = await self._acquire(record_id, key, user_id, scope["path"], fingerprint, now, lock_owner)
+        if not acquired:
+            existing = await db.idempotency_keys.find_one({"_id": record_id})
+            if existing is None:
+                # Released between insert and read - treat as new
+                acquired = await self._acquire(record_id, key, user_id, scope["path"], fingerprint, now, lock_owner)
+                existing = {"fingerprint": fingerprint, "status": "in_progress", "locked_at": now}
+            if not acquired:
+                if existing.get("fingerprint") != fingerprint:
+                    await self._send_json(send, 422, {"detail": "Idempotency-Key was already used with a different request body"})
+                    return
+                if existing.get("status") == "completed":
+                    await self._replay(send, existing)
+                    return
+                # In progress: take over only if the original request is long gone
+                stale_before = now - timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT_SECONDS)
+                taken = await db.idempotency_keys.update_one(
+                    {"_id": record_id, "status": "in_progress", "locked_at": {"$lt": stale_before}},
+                    {"$set": {"locked_at": now, "lock_owner": lock_owner}}
+                )
+                if taken.modified_count == 0:
+                    await self._send_json(
+                        send, 409,
+                        {"detail": "A request with this Idempotency-Key is still being processed"},
+                        extra_headers=[(b"retry-after", b"1")]
+                    )
+                    return
+        
+        captured = {"status": 500, "headers": [], "body": bytearray()}
+        
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                captured["status"] = message["status"]
+                captured["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                captured["body"] += message.get("body", b"")
+            await send(message)
+        
+        heartbeat = asyncio.create_task(self._heartbeat(record_id, lock_owner))
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except BaseException:
+            await db.idempotency_keys.delete_one({"_id": record_id, "status": "in_progress"})
+            raise
+        finally:
+            heartbeat.cancel()
+        
+        status_code = captured["status"]
+        if status_code >= 500 or status_code == 409:
+            await db.idempotency_keys.delete_one({"_id": record_id, "status": "in_progress"})
+            return
+        stored_headers = [
+            [name.decode("latin-1"), value.decode("latin-1")]
+            for name, value in captured["headers"]
+            if name.decode("latin-1").lower() in IDEMPOTENCY_REPLAY_HEADERS
+        ]
+        await db.idempotency_keys.update_one(
+            {"_id": record_id},
+            {"$set": {
+                "status": "completed",
+                "response_status": status_code,
+                "response_headers": stored_headers,
+                "response_body": bytes(captured["body"]),
+                "completed_at": datetime.now(timezone.utc)
+            }}
+        )
     
-    async def dispatch(self, request: Request, call_next):
-        # Only sanitize body data on state-changing methods
-        if request.method in ['POST', 'PUT', 'PATCH']:
+    @staticmethod
+    def _user_id(scope, headers: Headers) -> Optional[str]:
+        """User id from the access_token cookie or Bearer header (same sources as get_current_user)."""
+        token = None
+        for part in headers.get("cookie", "").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "access_token":
+                token = value
+                break
+        if not token:
+            authorization = headers.get("authorization", "")
+            if authorization.lower().startswith("bearer "):
+                token = authorization[7:].strip()
+        if not token:
+            return None
+        try:
+            return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM]).get("user_id")
+        except jwt.PyJWTError:
+            return None
+    
+    @staticmethod
+    async def _heartbeat(record_id: str, lock_owner: str):
+        """Keep the lock fresh while the request runs (cancelled when it finishes)."""
+        while True:
+            await asyncio.sleep(IDEMPOTENCY_LOCK_HEARTBEAT_SECONDS)
             try:
-                # Read the body
-                body = await request.body()
-                if body:
-                    try:
-                        # Parse JSON
-                        data = json.loads(body)
-                        # Sanitize the data
-                        sanitized_data = self.sanitize_value(data)
-                        # Update request body with sanitized data
-                        request._body = json.dumps(sanitized_data).encode('utf-8')
-                    except json.JSONDecodeError:
-                        # Not JSON, skip sanitization
-                        pass
+                await db.idempotency_keys.update_one(
+                    {"_id": record_id, "status": "in_progress", "lock_owner": lock_owner},
+                    {"$set": {"locked_at": datetime.now(timezone.utc)}}
+                )
             except Exception as e:
-                # If any error in sanitization, log but don't break the request
-                logging.warning(f"Input sanitization error: {str(e)}")
-        
-        response = await call_next(request)
-        return response
+                logger.warning(f"Idempotency lock heartbeat failed for {record_id}: {e}")
+    
+    @staticmethod
+    async def _acquire(record_id: str, key: str, user_id: str, path: str, fingerprint: str, now: datetime, lock_owner: str) -> bool:
+        try:
+            await db.idempotency_keys.insert_one({
+                "_id": record_id,
+                "key": key,
+                "user_id": user_id,
+                "path": path,
+                "fingerprint": fingerprint,
+                "status": "in_progress",
+                "locked_at": now,
+                "lock_owner": lock_owner,
+                "expires_at": now + timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+    
+    @staticmethod
+    async def _replay(send, record: dict):
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in record.get("response_headers", [])]
+        headers.append((b"idempotent-replayed", b"true"))
+        body = bytes(record.get("response_body") or b"")
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": record.get("response_status", 200), "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+    
+    @staticmethod
+    async def _send_json(send, status_code: int, content: dict, extra_headers: Optional[list] = None):
+        body = MongoJSONResponse(content).body
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("latin-1"))]
+        headers += extra_headers or []
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
 
 
 # ============================================================================
@@ -422,6 +765,7 @@ PERMISSIONS = {
     'finance.view': 'View finance data',
     'finance.create': 'Create financial transactions',
     'finance.delete': 'Delete financial transactions',
+    'finance.close': 'Close and reopen accounting periods',
     
     # Inventory Management
     'inventory.view': 'View inventory',
@@ -454,7 +798,7 @@ ROLE_PERMISSIONS = {
         'parties.view', 'parties.create', 'parties.update', 'parties.delete',
         'invoices.view', 'invoices.create', 'invoices.finalize', 'invoices.delete',
         'purchases.view', 'purchases.create', 'purchases.finalize', 'purchases.delete',
-        'finance.view', 'finance.create', 'finance.delete',
+        'finance.view', 'finance.create', 'finance.delete', 'finance.close',
         'inventory.view', 'inventory.adjust',
         'jobcards.view', 'jobcards.create', 'jobcards.update', 'jobcards.delete',
         'reports.view',
@@ -765,6 +1109,571 @@ def create_pagination_response(items: list, total_count: int, page: int, page_si
         }
     }
 
+# ============================================================================
+# LIST PROJECTIONS (fields= parameter)
+# ============================================================================
+# List screens show a handful of columns, so list routes return the "summary"
+# projection by default and skip nested arrays such as items (an item_count is
+# computed inside the projection instead). "full" returns whole documents as
+# before. View/edit dialogs load the full document from the detail routes.
+
+def _summary(*fields: str, item_count: bool = False) -> Dict[str, Any]:
+    projection = {"_id": 0, **{field: 1 for field in fields}}
+    if item_count:
+        projection["item_count"] = {"$size": {"$ifNull": ["$items", []]}}
+    return projection
+
+LIST_PROJECTIONS: Dict[str, Dict[str, Optional[Dict[str, Any]]]] = {
+    "invoices": {
+        "summary": _summary(
+            "id", "invoice_number", "date", "created_at", "customer_type", "customer_id",
+            "customer_name", "walk_in_name", "walk_in_phone", "invoice_type", "status",
+            "payment_status", "grand_total", "paid_amount", "balance_due", "finalized_at",
+            "jobcard_id", item_count=True
+        ),
+        "full": {"_id": 0},
+    },
+    "purchases": {
+        "summary": _summary(
+            "id", "vendor_party_id", "date", "description", "weight_grams", "entered_purity",
+            "rate_per_gram", "amount_total", "paid_amount_money", "balance_due_money",
+            "status", "locked", "finalized_at", "created_at"
+        ),
+        "full": None,
+    },
+    "returns": {
+        "summary": _summary(
+            "id", "return_number", "return_type", "reference_type", "reference_id",
+            "reference_number", "party_id", "party_name", "date", "total_weight_grams",
+            "total_amount", "refund_mode", "refund_money_amount", "refund_gold_grams",
+            "payment_mode", "reason", "notes", "status", "finalized_at", "created_at",
+            item_count=True
+        ),
+        "full": None,
+    },
+    "jobcards": {
+        "summary": _summary(
+            "id", "job_card_number", "card_type", "date_created", "created_at", "delivery_date",
+            "status", "customer_type", "customer_id", "customer_name", "walk_in_name",
+            "walk_in_phone", "worker_id", "worker_name", "locked", "is_invoiced", "invoice_id",
+            item_count=True
+        ),
+        "full": {"_id": 0},
+    },
+    "parties": {
+        "summary": _summary("id", "name", "phone", "address", "party_type", "created_at"),
+        "full": {"_id": 0},
+    },
+}
+
+def list_projection(resource: str, fields: str) -> Optional[Dict[str, Any]]:
+    """
+    Resolve a named list projection.
+    
+    Args:
+        resource: Key in LIST_PROJECTIONS
+        fields: Projection name from the fields= query parameter
+    
+    Returns:
+        Mongo projection (None means the whole document)
+    """
+    projections = LIST_PROJECTIONS[resource]
+    if fields not in projections:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid fields '{fields}'. Must be one of: {', '.join(projections)}"
+        )
+    return projections[fields]
+
+# ============================================================================
+# CONDITIONAL GET (ETag) HELPERS
+# ============================================================================
+# Finalized invoices, returns and purchases are locked by business rule, so their
+# representation only changes through a small set of "version" fields (status,
+# finalization stamp, and the payment/balance fields that payments still touch).
+# ETags are derived from those fields only, which lets If-None-Match be
+# answered from a tiny projected read instead of loading and serializing the
+# whole document. They are weak (W/"..."): CompressionMiddleware serves the
+# same representation as identity, gzip or br bytes, and a strong validator
+# would have to differ per content-encoding. Responses carrying them always
+# send Vary: Accept-Encoding so shared caches keep the encodings apart.
+
+import hashlib
+
+INVOICE_VERSION_FIELDS = ["status", "finalized_at", "payment_status", "paid_amount", "balance_due", "paid_at"]
+RETURN_VERSION_FIELDS = ["status", "finalized_at", "updated_at"]
+PURCHASE_VERSION_FIELDS = ["status", "locked", "finalized_at", "paid_amount_money", "balance_due_money"]
+
+# Cache-Control per resource state
+CACHE_CONTROL_DRAFT = "no-store"  # Still editable - never cache
+CACHE_CONTROL_FINALIZED = "private, no-cache"  # Locked, but balances can change - revalidate via ETag
+CACHE_CONTROL_IMMUTABLE = "private, max-age=300, must-revalidate"  # Locked and never modified again
+
+def is_document_finalized(doc: dict) -> bool:
+    """True when the document is locked (finalized invoice/return, locked purchase)."""
+    return doc.get("status") == "finalized" or bool(doc.get("locked"))
+
+def build_document_etag(doc: dict, version_fields: List[str], variant: str) -> Optional[str]:
+    """
+    Build a weak ETag for a finalized document.
+    
+    Args:
+        doc: Document (full or projected) containing id and the version fields
+        version_fields: Fields whose change alters the representation
+        variant: Representation name (json, full-details, pdf...) so each
+                 endpoint serving the same document gets a distinct tag
+    
+    Returns:
+        Weak ETag string (W/"..."), or None for drafts (drafts are never cached)
+    """
+    if not is_document_finalized(doc):
+        return None
+    parts = [variant, str(doc.get("id"))] + [f"{f}={doc.get(f)}" for f in version_fields]
+    digest = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+    return f'W/"{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag (RFC 9110 13.1.2)."""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == opaque for tag in candidates)
+
+def apply_cache_headers(response: Response, etag: Optional[str], cache_control: str):
+    """Set ETag (when present), Cache-Control and Vary: Accept-Encoding on an outgoing response."""
+    if etag:
+        response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = cache_control
+    if "accept-encoding" not in response.headers.get("vary", "").lower():
+        response.headers.add_vary_header("Accept-Encoding")
+
+async def check_not_modified(
+    request: Request,
+    collection,
+    doc_id: str,
+    version_fields: List[str],
+    variant: str,
+    cache_control: str = CACHE_CONTROL_FINALIZED
+) -> Optional[Response]:
+    """
+    Answer If-None-Match with 304 using only a projected read of the version fields.
+    
+    Returns:
+        A 304 Response when the client's copy is current, otherwise None
+        (the caller then performs the full read and serialization).
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    projection = {"_id": 0, "id": 1, "locked": 1, **{f: 1 for f in version_fields}}
+    stamp = await collection.find_one({"id": doc_id, "is_deleted": False}, projection)
+    if not stamp:
+        return None
+    etag = build_document_etag(stamp, version_fields, variant)
+    if not etag_matches(if_none_match, etag):
+        return None
+    not_modified = Response(status_code=304)
+    apply_cache_headers(not_modified, etag, cache_control)
+    return not_modified
+
+# ============================================================================
+# REFERENCE DATA CACHE
+# ============================================================================
+# Small, rarely changing collections served from process memory (see
+# reference_cache.py). Balance fields are deliberately NOT cached - they move on
+# every transaction - so only create/rename/delete endpoints invalidate.
+
+# Soft-deleted accounts stay cached (hidden by default): transactions and
+# financial statements still have to resolve them
+account_ref_cache = ReferenceCache(
+    db.accounts, "accounts",
+    projection={"id": 1, "name": 1, "account_type": 1, "opening_balance": 1},
+    keep_deleted=True
+)
+inventory_header_cache = ReferenceCache(
+    db.inventory_headers, "inventory_headers",
+    projection={"id": 1, "name": 1, "is_active": 1}
+)
+jobcard_template_cache = ReferenceCache(
+    db.jobcards, "jobcard_templates",
+    query={"card_type": "template", "is_deleted": False},
+    name_field="template_name"
+)
+shop_settings_cache = ReferenceCache(db.shop_settings, "shop_settings", query={}, name_field=None)
+
+REFERENCE_CACHES = [account_ref_cache, inventory_header_cache, jobcard_template_cache, shop_settings_cache]
+
+async def get_accounts_with_balances() -> List[Dict[str, Any]]:
+    """
+    All active accounts: reference fields from the cache merged with a lean
+    live read of current_balance (balances are never served from cache).
+    """
+    accounts = await account_ref_cache.all()
+    balances = await db.accounts.find(
+        {"is_deleted": False}, {"_id": 0, "id": 1, "current_balance": 1}
+    ).to_list(None)
+    balance_map = {b['id']: b.get('current_balance', 0) for b in balances if 'id' in b}
+    for acc in accounts:
+        acc['current_balance'] = balance_map.get(acc['id'], 0)
+    return accounts
+
+# ============================================================================
+# ATOMIC STOCK MUTATIONS
+# ============================================================================
+# Stock levels are only ever changed with filtered $inc updates. Decrements carry
+# a guard (current_qty >= qty AND current_weight >= weight) inside the update
+# filter, so the check and the write are one atomic server-side operation:
+# concurrent finalizations on different counters can neither lose an update nor
+# drive a header negative, and no application-level serialization is needed.
+
+async def resolve_inventory_header(name: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Resolve an active inventory header by exact name.
+    Served from the reference cache; falls back to a live read for headers
+    created by another worker since the cache was loaded.
+    """
+    if not name:
+        return None
+    header = await inventory_header_cache.get_by_name(name)
+    if header:
+        return header
+    header = await db.inventory_headers.find_one(
+        {"name": name, "is_deleted": False}, {"_id": 0, "id": 1, "name": 1, "is_active": 1}
+    )
+    if header:
+        inventory_header_cache.invalidate()
+    return header
+
+def stock_stamp() -> Dict[str, datetime]:
+    """
+    $set fragment for every header stock $inc: stock_updated_at lets
+    reconciliation skip headers whose movements may still be in flight and
+    detect changes between its read and its correction.
+    """
+    return {"stock_updated_at": datetime.now(timezone.utc)}
+
+async def apply_stock_delta(header_id: str, qty_delta: float, weight_delta: float) -> bool:
+    """
+    Apply a stock change to one inventory header as a single filtered $inc.
+    
+    Negative deltas are guarded so the header cannot go below zero.
+    
+    Returns:
+        True when applied, False when the guard rejected it (insufficient stock
+        or header not found)
+    """
+    query = {"id": header_id}
+    if qty_delta < 0:
+        query["current_qty"] = {"$gte": -qty_delta}
+    if weight_delta < 0:
+        query["current_weight"] = {"$gte": -weight_delta}
+    result = await db.inventory_headers.update_one(
+        query,
+        {"$inc": {"current_qty": qty_delta, "current_weight": weight_delta}, "$set": stock_stamp()}
+    )
+    return result.matched_count == 1
+
+async def describe_stock_shortfall(line: Dict[str, Any]) -> str:
+    """Human-readable shortfall for a rejected decrement (reads live stock)."""
+    header = await db.inventory_headers.find_one(
+        {"id": line["header_id"]}, {"_id": 0, "current_qty": 1, "current_weight": 1}
+    )
+    if not header:
+        return f"{line['label']}: inventory header not found"
+    return (
+        f"{line['label']}: Need {line['qty']} qty/{line['weight']}g, "
+        f"but only {header.get('current_qty', 0)} qty/{header.get('current_weight', 0)}g available"
+    )
+
+async def decrement_stock_lines(lines: List[Dict[str, Any]]) -> tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Atomically decrement stock for several lines, all-or-nothing.
+    
+    Args:
+        lines: Dicts with header_id, label, qty and weight (positive amounts to remove)
+    
+    Returns:
+        (applied_lines, shortfalls). Every line is attempted so all shortfalls
+        are reported; if any line is short, the decrements already applied are
+        compensated and applied_lines is empty.
+    """
+    applied = []
+    shortfalls = []
+    for line in lines:
+        if await apply_stock_delta(line["header_id"], -line["qty"], -line["weight"]):
+            applied.append(line)
+        else:
+            shortfalls.append(await describe_stock_shortfall(line))
+    
+    if shortfalls:
+        # Compensate - unguarded increments always succeed
+        for line in applied:
+            await apply_stock_delta(line["header_id"], line["qty"], line["weight"])
+        applied = []
+    
+    return applied, shortfalls
+
+# ============================================================================
+# STOCK RESERVATIONS (draft invoices)
+# ============================================================================
+# Draft sale invoices hold their stock in `stock_reservations` so two counters
+# cannot promise the same pieces. A reservation is one document per invoice and
+# inventory header with an `expires_at`; a TTL index removes expired documents,
+# and every read also filters on expires_at > now so a reservation stops
+# counting the moment it expires, not when the TTL monitor gets to it.
+#
+#   available_to_sell = current_qty - sum(active reservations for the header)
+#
+# Reserving is insert-then-verify: the reservation documents are inserted
+# first, then the header totals are checked against all active reservations
+# (including concurrent ones). If the header is over-reserved, the new
+# documents are removed again. Two racing reservations can at worst both be
+# rejected - stock is never over-promised.
+#
+# Finalizing a draft that still holds a valid reservation only needs its own
+# quantities on the shelf; paths that cut stock without looking at
+# reservations (purchase returns, stock counts, manual adjustments) must not
+# block drafts that were admitted earlier.
+
+STOCK_RESERVATION_TTL_MINUTES = int(os.environ.get('STOCK_RESERVATION_TTL_MINUTES', '60'))
+STOCK_RESERVATION_EPSILON = 1e-9
+
+async def invoice_stock_lines(invoice: "Invoice") -> List[Dict[str, Any]]:
+    """
+    Map invoice items to stock lines (header_id, header_name, label, qty, weight, item).
+    
+    Items without weight are skipped. Items whose category has no inventory
+    header get header_id None.
+    """
+    lines = []
+    for item in invoice.items:
+        if item.weight <= 0:
+            continue
+        header = await resolve_inventory_header(item.category)
+        lines.append({
+            "header_id": header['id'] if header else None,
+            "header_name": header['name'] if header else (item.category or item.description or "Uncategorized"),
+            "label": item.category,
+            "qty": item.qty,
+            "weight": item.weight,
+            "item": item
+        })
+    return lines
+
+async def get_reserved_totals(header_ids: List[str], exclude_ids: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    """Active (unexpired) reserved qty/weight per header, from the (header_id, expires_at) index."""
+    match = {"header_id": {"$in": header_ids}, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+    if exclude_ids:
+        match["id"] = {"$nin": exclude_ids}
+    rows = await db.stock_reservations.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$header_id", "qty": {"$sum": "$qty"}, "weight": {"$sum": "$weight"}}}
+    ]).to_list(None)
+    return {row['_id']: {"qty": row['qty'], "weight": row['weight']} for row in rows}
+
+def merge_reservation_lines(lines: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Sum stock lines per header - one reservation per invoice and header."""
+    merged: Dict[str, Dict[str, Any]] = {}
+    for line in lines:
+        entry = merged.setdefault(line['header_id'], {"header_name": line['header_name'], "label": line['label'], "qty": 0, "weight": 0})
+        entry['qty'] += line['qty']
+        entry['weight'] = round(entry['weight'] + line['weight'], 3)
+    return merged
+
+async def holds_valid_reservation(invoice_id: str, stock_lines: List[Dict[str, Any]]) -> bool:
+    """
+    True when the invoice's unexpired reservations cover exactly its current stock lines.
+    
+    Such an invoice was admitted against everyone else's reservations when it
+    reserved, so at finalize it only needs its own quantities on the shelf.
+    """
+    merged = merge_reservation_lines(stock_lines)
+    if not merged:
+        return False
+    held = await db.stock_reservations.find(
+        {"invoice_id": invoice_id, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+        {"_id": 0, "header_id": 1, "qty": 1, "weight": 1}
+    ).to_list(None)
+    held_by_header = {r['header_id']: r for r in held}
+    if set(held_by_header) != set(merged):
+        return False
+    return all(
+        abs(held_by_header[header_id]['qty'] - entry['qty']) <= STOCK_RESERVATION_EPSILON
+        and abs(held_by_header[header_id]['weight'] - entry['weight']) <= STOCK_RESERVATION_EPSILON
+        for header_id, entry in merged.items()
+    )
+
+async def reserve_invoice_stock(invoice: "Invoice", user_id: str) -> List[str]:
+    """
+    (Re)reserve stock for a draft sale invoice and renew its expiry.
+    
+    The invoice's previous reservations keep holding their stock until the new
+    ones are verified, then they are replaced. Non-sale invoices hold nothing.
+    
+    Returns:
+        List of per-header shortfall messages. Empty on success; on failure the
+        previous reservations (if any) are left untouched.
+    """
+    previous_ids = [r['id'] for r in await db.stock_reservations.find(
+        {"invoice_id": invoice.id}, {"_id": 0, "id": 1}
+    ).to_list(None)]
+    
+    lines = []
+    if invoice.invoice_type == "sale":
+        lines = [line for line in await invoice_stock_lines(invoice) if line['header_id']]
+    merged = merge_reservation_lines(lines)
+    
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(minutes=STOCK_RESERVATION_TTL_MINUTES)
+    docs = [{
+        "id": str(uuid.uuid4()),
+        "invoice_id": invoice.id,
+        "invoice_number": invoice.invoice_number,
+        "header_id": header_id,
+        "header_name": entry['header_name'],
+        "qty": entry['qty'],
+        "weight": entry['weight'],
+        "expires_at": expires_at,
+        "created_at": now,
+        "created_by": user_id
+    } for header_id, entry in merged.items()]
+    
+    if docs:
+        await db.stock_reservations.insert_many(docs)
+        headers = await db.inventory_headers.find(
+            {"id": {"$in": list(merged)}}, {"_id": 0, "id": 1, "current_qty": 1, "current_weight": 1}
+        ).to_list(None)
+        stock = {h['id']: h for h in headers}
+        reserved = await get_reserved_totals(list(merged), exclude_ids=previous_ids)
+        
+        shortfalls = []
+        for header_id, entry in merged.items():
+            header = stock.get(header_id)
+            if not header:
+                shortfalls.append(f"{entry['label']}: inventory header not found")
+                continue
+            held = reserved.get(header_id, {"qty": 0, "weight": 0})
+            current_qty = header.get('current_qty', 0)
+            current_weight = header.get('current_weight', 0)
+            if (held['qty'] > current_qty + STOCK_RESERVATION_EPSILON
+                    or held['weight'] > current_weight + STOCK_RESERVATION_EPSILON):
+                # held includes this request; report what was free without it
+                available_qty = round(current_qty - (held['qty'] - entry['qty']), 3)
+                available_weight = round(current_weight - (held['weight'] - entry['weight']), 3)
+                shortfalls.append(
+                    f"{entry['label']}: Need {entry['qty']} qty/{entry['weight']}g, "
+                    f"but only {available_qty} qty/{available_weight}g available to sell"
+                )
+        
+        if shortfalls:
+            await db.stock_reservations.delete_many({"id": {"$in": [d['id'] for d in docs]}})
+            return shortfalls
+    
+    if previous_ids:
+        await db.stock_reservations.delete_many({"id": {"$in": previous_ids}})
+    return []
+
+async def mark_stock_items_sold(tags: List[str], invoice_id: str) -> List[str]:
+    """
+    Mark tagged pieces sold with one guarded update_many (status in_stock -> sold).
+    
+    Returns:
+        Messages for tags that are unknown or already sold. On failure the
+        pieces claimed by this call are put back in stock.
+    """
+    if not tags:
+        return []
+    result = await db.stock_items.update_many(
+        {"tag": {"$in": tags}, "status": "in_stock", "is_deleted": False},
+        {"$set": {"status": "sold", "invoice_id": invoice_id, "sold_at": datetime.now(timezone.utc)}}
+    )
+    if result.modified_count == len(set(tags)):
+        return []
+    
+    claimed = await db.stock_items.find(
+        {"tag": {"$in": tags}, "invoice_id": invoice_id, "status": "sold"}, {"_id": 0, "tag": 1}
+    ).to_list(None)
+    claimed_tags = {piece['tag'] for piece in claimed}
+    await release_stock_items(list(claimed_tags), invoice_id)
+    return [f"Tag {tag}: piece not found or already sold" for tag in tags if tag not in claimed_tags]
+
+async def release_stock_items(tags: List[str], invoice_id: str):
+    """Undo mark_stock_items_sold for the pieces this invoice claimed."""
+    if tags:
+        await db.stock_items.update_many(
+            {"tag": {"$in": tags}, "invoice_id": invoice_id, "status": "sold"},
+            {"$set": {"status": "in_stock", "invoice_id": None, "sold_at": None}}
+        )
+
+async def release_invoice_reservations(invoice_id: str) -> int:
+    """Drop all reservations held by an invoice (deleted draft / converted on finalize)."""
+    result = await db.stock_reservations.delete_many({"invoice_id": invoice_id})
+    return result.deleted_count
+
+async def deduct_invoice_stock(invoice: "Invoice", description: str, user_id: str, record_unmatched: bool = True) -> List[str]:
+    """
+    Stock OUT for a sale invoice: guarded decrements for every item whose
+    category matches an inventory header, then the draft's reservation is
+    released and the Stock OUT movements are recorded.
+    
+    A draft that still holds an unexpired reservation for exactly these lines
+    consumes it: the decrement only needs current_qty/current_weight to cover
+    its own quantities, even if a purchase return or stock count has since
+    left the header over-reserved. Drafts whose reservation expired (or that
+    never had one) reserve first, against all other active reservations.
+    
+    Args:
+        invoice: Invoice being finalized
+        description: Movement description
+        user_id: Acting user
+        record_unmatched: Also record movements (without header_id) for items
+                          whose category has no inventory header
+    
+    Returns:
+        List of per-item shortfall messages. Empty on success; on failure no
+        stock was changed and no movement was written.
+    """
+    lines = await invoice_stock_lines(invoice)
+    stock_lines = [line for line in lines if line['header_id']]
+    movement_lines = lines if record_unmatched else stock_lines
+    
+    if not await holds_valid_reservation(invoice.id, stock_lines):
+        shortfalls = await reserve_invoice_stock(invoice, user_id)
+        if shortfalls:
+            return shortfalls
+    
+    # Tagged pieces are claimed together, right next to the header decrement
+    tags = [item.tag for item in invoice.items if item.tag]
+    shortfalls = await mark_stock_items_sold(tags, invoice.id)
+    if shortfalls:
+        return shortfalls
+    
+    _, shortfalls = await decrement_stock_lines(stock_lines)
+    if shortfalls:
+        await release_stock_items(tags, invoice.id)
+        return shortfalls
+    
+    # Stock has left the shelf - the reservation is consumed
+    await release_invoice_reservations(invoice.id)
+    
+    if movement_lines:
+        await db.stock_movements.insert_many([StockMovement(
+            movement_type="Stock OUT",
+            header_id=line['header_id'],  # May be None if no header found
+            header_name=line['header_name'],
+            description=description,
+            qty_delta=-line['qty'],
+            weight_delta=-line['weight'],
+            purity=line['item'].purity,
+            reference_type="invoice",
+            reference_id=invoice.id,
+            created_by=user_id
+        ).model_dump() for line in movement_lines])
+    return []
+
 class UserRole(BaseModel):
     role: str
     permissions: List[str] = []
@@ -836,6 +1745,28 @@ class InventoryHeader(BaseModel):
     created_by: str
     is_deleted: bool = False
 
+class StockItem(BaseModel):
+    """Individually tagged piece (barcode/RFID) within an inventory header's aggregate stock"""
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tag: str  # Unique barcode/tag printed on the piece
+    header_id: str
+    header_name: str
+    description: Optional[SafeStr] = None
+    gross_weight: float  # Total weight including stones
+    stone_weight: float = 0.0
+    net_gold_weight: float = 0.0  # Calculated: gross_weight - stone_weight
+    purity: int
+    making_charge_type: Optional[str] = None  # 'per_gram' or 'flat'
+    making_charge_value: float = 0.0
+    stone_charges: float = 0.0
+    status: str = "in_stock"  # "in_stock" or "sold"
+    invoice_id: Optional[str] = None  # Set when sold
+    sold_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_by: str
+    is_deleted: bool = False
+
 class StockMovement(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -851,18 +1782,18 @@ class StockMovement(BaseModel):
     reference_type: Optional[str] = None
     reference_id: Optional[str] = None
     created_by: str
-    notes: Optional[str] = None
-    confirmation_reason: Optional[str] = None  # Required for manual adjustments
+    notes: Optional[SafeStr] = None
+    confirmation_reason: Optional[SafeStr] = None  # Required for manual adjustments
     is_deleted: bool = False
 
 class Party(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    name: str
+    name: SafeStr
     phone: Optional[str] = None
-    address: Optional[str] = None
+    address: Optional[SafeStr] = None
     party_type: str
-    notes: Optional[str] = None
+    notes: Optional[SafeStr] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_by: str
     is_deleted: bool = False
@@ -870,7 +1801,7 @@ class Party(BaseModel):
 class Worker(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    name: str
+    name: SafeStr
     phone: Optional[str] = None
     role: str
     active: bool = True
@@ -887,7 +1818,7 @@ class JobCardItem(BaseModel):
     weight_out: Optional[float] = None
     purity: int
     work_type: str
-    remarks: Optional[str] = None
+    remarks: Optional[SafeStr] = None
     making_charge_type: Optional[str] = None  # 'flat' or 'per_gram'
     making_charge_value: Optional[float] = None
     vat_percent: Optional[float] = None
@@ -907,13 +1838,13 @@ class JobCard(BaseModel):
     status: str = "created"
     customer_type: str = "saved"  # "saved" or "walk_in"
     customer_id: Optional[str] = None  # For saved customers only
-    customer_name: Optional[str] = None  # For saved customers only
-    walk_in_name: Optional[str] = None  # For walk-in customers only
+    customer_name: Optional[SafeStr] = None  # For saved customers only
+    walk_in_name: Optional[SafeStr] = None  # For walk-in customers only
     walk_in_phone: Optional[str] = None  # For walk-in customers only
     worker_id: Optional[str] = None
-    worker_name: Optional[str] = None
+    worker_name: Optional[SafeStr] = None
     items: List[JobCardItem] = []
-    notes: Optional[str] = None
+    notes: Optional[SafeStr] = None
     gold_rate_at_jobcard: Optional[float] = None  # MODULE 8: Gold rate at time of job card creation
     locked: bool = False  # True when linked invoice is finalized
     locked_at: Optional[datetime] = None
@@ -923,13 +1854,13 @@ class JobCard(BaseModel):
     created_by: str
     is_deleted: bool = False
     # Template-specific fields
-    template_name: Optional[str] = None  # Required when card_type='template'
+    template_name: Optional[SafeStr] = None  # Required when card_type='template'
     delivery_days_offset: Optional[int] = None  # For templates: days from creation to delivery
 
 class InvoiceItem(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     category: Optional[str] = None  # Inventory category for stock tracking
-    description: str
+    description: str  # Matched verbatim against inventory header names - not sanitized
     qty: int
     # Gold-specific weight breakdown (3 decimal precision)
     gross_weight: float = 0.0  # Total weight including stones
@@ -949,6 +1880,7 @@ class InvoiceItem(BaseModel):
     vat_percent: float
     vat_amount: float
     line_total: float  # gold_value + making_value + stone_charges + wastage_charges + vat_amount - item_discount
+    tag: Optional[str] = None  # Scanned piece tag (stock_items) - marked sold on finalization
 
 class Invoice(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -959,14 +1891,14 @@ class Invoice(BaseModel):
     due_date: Optional[datetime] = None  # For overdue calculations, defaults to invoice date
     customer_type: str = "saved"  # "saved" or "walk_in"
     customer_id: Optional[str] = None  # For saved customers only
-    customer_name: Optional[str] = None  # For saved customers only
+    customer_name: Optional[SafeStr] = None  # For saved customers only
     customer_phone: Optional[str] = None  # Customer phone (from party or walk-in)
-    customer_address: Optional[str] = None  # Customer address (from party)
+    customer_address: Optional[SafeStr] = None  # Customer address (from party)
     customer_gstin: Optional[str] = None  # Customer GSTIN (from party)
-    walk_in_name: Optional[str] = None  # For walk-in customers only
+    walk_in_name: Optional[SafeStr] = None  # For walk-in customers only
     walk_in_phone: Optional[str] = None  # For walk-in customers only
     worker_id: Optional[str] = None  # Worker assigned to the job (from job card)
-    worker_name: Optional[str] = None  # Worker name (from job card)
+    worker_name: Optional[SafeStr] = None  # Worker name (from job card)
     invoice_type: str = "sale"
     payment_status: str = "unpaid"
     status: str = "draft"  # "draft" or "finalized" - controls when stock is deducted
@@ -986,7 +1918,7 @@ class Invoice(BaseModel):
     grand_total: float = 0
     paid_amount: float = 0
     balance_due: float = 0
-    notes: Optional[str] = None
+    notes: Optional[SafeStr] = None
     jobcard_id: Optional[str] = None
     created_by: str
     is_deleted: bool = False
@@ -1021,12 +1953,36 @@ class Transaction(BaseModel):
     account_id: str
     account_name: str
     party_id: Optional[str] = None
-    party_name: Optional[str] = None
+    party_name: Optional[SafeStr] = None
     amount: float
     category: str
-    notes: Optional[str] = None
+    notes: Optional[SafeStr] = None
     reference_type: Optional[str] = None  # "invoice", "jobcard", or None for general transactions
     reference_id: Optional[str] = None  # UUID of the related invoice/jobcard
+    journal_entry_id: Optional[str] = None  # Set when the transaction is a line of a journal entry
+    created_by: str
+    is_deleted: bool = False
+
+class JournalEntry(BaseModel):
+    """
+    Balanced multi-line posting. Each line is also stored as a Transaction
+    (journal_entry_id set), so ledgers and balances see it like any other
+    transaction; this document groups the lines and carries the totals.
+    """
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    entry_number: str
+    date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    description: SafeStr
+    lines: List[Dict[str, Any]]  # account_id, account_name, account_type, debit, credit, memo, transaction_id
+    total_debit: float
+    total_credit: float
+    reference_type: Optional[str] = None
+    reference_id: Optional[str] = None
+    status: str = "posted"  # posted | reversed
+    reversal_of: Optional[str] = None  # Entry this one reverses
+    reversed_by: Optional[str] = None  # Entry that reversed this one
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_by: str
     is_deleted: bool = False
 
@@ -1042,7 +1998,7 @@ class DailyClosing(BaseModel):
     difference: Optional[float] = 0.0
     is_locked: bool = False
     closed_by: str
-    notes: Optional[str] = None
+    notes: Optional[SafeStr] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class AuditLog(BaseModel):
@@ -1067,7 +2023,7 @@ class GoldLedgerEntry(BaseModel):
     purpose: str  # job_work | exchange | advance_gold | adjustment
     reference_type: Optional[str] = None  # invoice | jobcard | purchase | manual
     reference_id: Optional[str] = None
-    notes: Optional[str] = None
+    notes: Optional[SafeStr] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_by: str
     is_deleted: bool = False
@@ -1080,7 +2036,7 @@ class Purchase(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     vendor_party_id: str  # Must be a vendor type party
     date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    description: str
+    description: SafeStr
     weight_grams: float  # 3 decimal precision - actual weight
     entered_purity: int  # Purity as entered/claimed by vendor (e.g., 999, 995, 916)
     valuation_purity_fixed: int = 916  # ALWAYS 916 for stock calculations and accounting
@@ -1113,6 +2069,7 @@ class ReturnItem(BaseModel):
     weight_grams: float  # Input as float, stored as Decimal128 with 3 decimal precision
     purity: int
     amount: float = 0.0  # Input as float, stored as Decimal128 with 2 decimal precision
+    item_id: Optional[str] = None  # Invoice line being returned (from returnable-items)
 
 class Return(BaseModel):
     """
@@ -1138,13 +2095,13 @@ class Return(BaseModel):
     reference_id: str  # UUID of the related invoice or purchase
     reference_number: Optional[str] = None  # Display number of invoice/purchase
     party_id: str  # Customer (for sale_return) or Vendor (for purchase_return)
-    party_name: str  # Party name for display
+    party_name: SafeStr  # Party name for display
     party_type: str  # "customer" or "vendor"
     date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     items: List[ReturnItem] = []
     total_weight_grams: float = 0.0  # Input as float, stored as Decimal128 with 3 decimals
     total_amount: float = 0.0  # Input as float, stored as Decimal128 with 2 decimals
-    reason: Optional[str] = None  # Return reason
+    reason: Optional[SafeStr] = None  # Return reason
     
     # Refund details (optional at draft creation, required at finalization)
     refund_mode: Optional[str] = None  # "money" | "gold" | "mixed" - Required at finalize, optional at draft
@@ -1170,7 +2127,7 @@ class Return(BaseModel):
     # Audit fields
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_by: str
-    notes: Optional[str] = None
+    notes: Optional[SafeStr] = None
     is_deleted: bool = False
     deleted_at: Optional[datetime] = None
     deleted_by: Optional[str] = None
@@ -1393,43 +2350,49 @@ async def validate_return_against_original(
         
         entity_name = f"Purchase {reference_id[:8]}..."
     
-    # Calculate totals already returned (finalized returns only)
-    query = {
-        'reference_type': reference_type,
-        'reference_id': reference_id,
-        'status': 'finalized',
-        'is_deleted': False
-    }
-    
-    # Exclude current return if updating
-    if current_return_id:
-        query['id'] = {'$ne': current_return_id}
-    
-    existing_returns = await db.returns.find(query).to_list(length=None)
-    
-    # Sum up already returned quantities, weights, and amounts using Decimal
-    already_returned_qty = 0
-    already_returned_weight = Decimal('0')
-    already_returned_amount = Decimal('0')
-    
-    for ret in existing_returns:
-        ret_items = ret.get('items', [])
-        already_returned_qty += sum(item.get('qty', 0) for item in ret_items)
-        
-        # Sum weights using Decimal
-        for item in ret_items:
-            weight = item.get('weight_grams', 0)
-            if isinstance(weight, Decimal128):
-                already_returned_weight += weight.to_decimal()
-            else:
-                already_returned_weight += Decimal(str(weight))
-        
-        # Sum amounts using Decimal
-        total_amt = ret.get('total_amount', 0)
-        if isinstance(total_amt, Decimal128):
-            already_returned_amount += total_amt.to_decimal()
-        else:
-            already_returned_amount += Decimal(str(total_amt))
+    # Totals already returned (finalized returns only) come from the counters
+    # kept on the reference document - no rescan of the returns collection.
+    # Only finalized returns are counted and only drafts can be edited, so the
+    # current return (current_return_id) is never part of the counters.
+    reference_doc = await ensure_return_counters(reference_type, reference_id, reference_doc)
+    returned_totals = reference_doc.get('returned_totals') or {}
+    already_returned_qty = returned_totals.get('qty', 0)
+    already_returned_weight = _to_decimal(returned_totals.get('weight', 0))
+    already_returned_amount = _to_decimal(returned_totals.get('amount', 0))
+    
+    # Exact per-line limits (invoice lines only)
+    if reference_type == 'invoice':
+        invoice_items = reference_doc.get('items', [])
+        returned_lines = reference_doc.get('returned_lines') or {}
+        requested: Dict[str, Dict[str, Any]] = {}
+        for line_id, item in zip(match_return_lines(invoice_items, return_items), return_items):
+            if not line_id:
+                continue
+            entry = requested.setdefault(line_id, {"qty": 0, "weight": Decimal('0')})
+            entry["qty"] += item.get('qty', 0)
+            entry["weight"] += _to_decimal(item.get('weight_grams', 0))
+        for line in invoice_items:
+            entry = requested.get(line.get('id'))
+            if not entry:
+                continue
+            returned = returned_lines.get(line['id']) or {}
+            line_qty = line.get('qty', 0)
+            line_weight = _to_decimal(line.get('net_gold_weight', 0) or line.get('weight', 0))
+            if returned.get('qty', 0) + entry["qty"] > line_qty:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Cannot return more than sold for '{line.get('description')}'. "
+                           f"Sold qty: {line_qty}, Already returned: {returned.get('qty', 0)}, "
+                           f"Current return: {entry['qty']}"
+                )
+            if _to_decimal(returned.get('weight', 0)) + entry["weight"] > line_weight * Decimal('1.001'):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Cannot return more weight than sold for '{line.get('description')}'. "
+                           f"Sold: {float(line_weight):.3f}g, "
+                           f"Already returned: {float(_to_decimal(returned.get('weight', 0))):.3f}g, "
+                           f"Current return: {float(entry['weight']):.3f}g"
+                )
     
     # Validate quantity
     total_qty_with_new = already_returned_qty + current_total_qty
@@ -1471,6 +2434,122 @@ async def validate_return_against_original(
                    f"Total would be: {float(total_amount_with_new):.2f} OMR"
         )
 
+# ============================================================================
+# RETURNED QUANTITY COUNTERS
+# ============================================================================
+# Finalized returns are accumulated on the referenced document so returnable
+# lookups and return validation are a single document read:
+#
+#   invoices:  returned_lines.<invoice line id>.{qty, weight, amount}
+#              returned_totals.{qty, weight, amount}
+#   purchases: returned_totals.{qty, weight, amount}
+#
+# finalize_return applies the return with one $inc on the reference document
+# (and reverses it on rollback). Documents created before the counters existed
+# are backfilled once from their finalized returns (returns_tracked flag).
+
+def _to_decimal(value) -> Decimal:
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return Decimal(str(value or 0))
+
+def match_return_lines(invoice_items: List[dict], return_items: List[dict]) -> List[Optional[str]]:
+    """
+    Resolve each return line to the invoice line it returns.
+    
+    Uses the line's item_id when it names a line of the invoice; legacy lines
+    without one fall back to the first invoice line with the same description
+    and purity. Unresolved lines map to None (they only count toward totals).
+    """
+    line_ids = {item.get('id') for item in invoice_items}
+    by_key = {}
+    for item in invoice_items:
+        by_key.setdefault((item.get('description', ''), item.get('purity', 0)), item.get('id'))
+    resolved = []
+    for ret_item in return_items:
+        item_id = ret_item.get('item_id')
+        if item_id and item_id in line_ids:
+            resolved.append(item_id)
+        else:
+            resolved.append(by_key.get((ret_item.get('description', ''), ret_item.get('purity', 0))))
+    return resolved
+
+def return_counter_increments(reference_doc: dict, reference_type: str, return_items: List[dict], sign: int = 1) -> Dict[str, Any]:
+    """$inc document applying (sign=1) or reversing (sign=-1) a return's lines."""
+    increments: Dict[str, Any] = {}
+    
+    def add(path: str, value):
+        increments[path] = increments.get(path, 0) + value
+    
+    line_ids = match_return_lines(reference_doc.get('items', []), return_items) if reference_type == 'invoice' else [None] * len(return_items)
+    for line_id, item in zip(line_ids, return_items):
+        qty = sign * item.get('qty', 0)
+        weight = sign * round(float(_to_decimal(item.get('weight_grams', 0))), 3)
+        amount = sign * round(float(_to_decimal(item.get('amount', 0))), 3)
+        add("returned_totals.qty", qty)
+        add("returned_totals.weight", weight)
+        add("returned_totals.amount", amount)
+        if line_id:
+            add(f"returned_lines.{line_id}.qty", qty)
+            add(f"returned_lines.{line_id}.weight", weight)
+            add(f"returned_lines.{line_id}.amount", amount)
+    return increments
+
+def _reference_collection(reference_type: str):
+    return db.invoices if reference_type == 'invoice' else db.purchases
+
+async def ensure_return_counters(reference_type: str, reference_id: str, reference_doc: Optional[dict] = None) -> Optional[dict]:
+    """
+    Return the reference document with its returned counters, backfilling
+    them once (from finalized returns) for documents that predate them.
+    """
+    collection = _reference_collection(reference_type)
+    if reference_doc is None:
+        reference_doc = await collection.find_one({"id": reference_id, "is_deleted": False}, {"_id": 0})
+    if not reference_doc or reference_doc.get('returns_tracked'):
+        return reference_doc
+    
+    returns = await db.returns.find({
+        "reference_type": reference_type,
+        "reference_id": reference_id,
+        "status": "finalized",
+        "is_deleted": False
+    }, {"_id": 0, "items": 1}).to_list(None)
+    
+    counters: Dict[str, Any] = {}
+    for ret in returns:
+        for path, value in return_counter_increments(reference_doc, reference_type, ret.get('items', [])).items():
+            counters[path] = counters.get(path, 0) + value
+    
+    totals = {"qty": 0, "weight": 0.0, "amount": 0.0}
+    lines: Dict[str, Dict[str, Any]] = {}
+    for path, value in counters.items():
+        parts = path.split('.')
+        if parts[0] == "returned_totals":
+            totals[parts[1]] = value
+        else:
+            lines.setdefault(parts[1], {"qty": 0, "weight": 0.0, "amount": 0.0})[parts[2]] = value
+    backfill = {"returned_totals": totals, "returns_tracked": True}
+    if reference_type == 'invoice':
+        backfill["returned_lines"] = lines
+    
+    # Only the first backfill wins; a concurrent finalize always backfills
+    # before it marks its own return finalized, so nothing is counted twice
+    await collection.update_one({"id": reference_id, "returns_tracked": {"$ne": True}}, {"$set": backfill})
+    return await collection.find_one({"id": reference_id}, {"_id": 0})
+
+async def apply_return_counters(return_doc: dict, sign: int = 1) -> bool:
+    """Add (sign=1) or remove (sign=-1) a return's lines on its reference document in one $inc."""
+    reference_type = return_doc.get('reference_type')
+    reference_doc = await ensure_return_counters(reference_type, return_doc.get('reference_id'))
+    if not reference_doc:
+        return False
+    increments = return_counter_increments(reference_doc, reference_type, return_doc.get('items', []), sign)
+    if not increments:
+        return False
+    await _reference_collection(reference_type).update_one({"id": reference_doc['id']}, {"$inc": increments})
+    return True
+
 # ============================================================================
 # PERMISSION DECORATOR
 # ============================================================================
@@ -1996,6 +3075,7 @@ async def create_inventory_header(header_data: dict, current_user: User = Depend
     
     header = InventoryHeader(name=category_name, created_by=current_user.id)
     await db.inventory_headers.insert_one(header.model_dump())
+    inventory_header_cache.invalidate()
     await create_audit_log(current_user.id, current_user.full_name, "inventory_header", header.id, "create")
     return header
 
@@ -2060,11 +3140,20 @@ async def update_inventory_header(
     if not update_data:
         raise HTTPException(status_code=400, detail="No valid fields to update")
     
+    # Legacy return movements carry only the header name - pin them to this
+    # header before the name changes, so the stock ledger still finds them
+    if update_data.get('name') and update_data['name'] != existing_header['name']:
+        await db.stock_movements.update_many(
+            {"header_id": None, "reference_type": "return", "header_name": existing_header['name']},
+            {"$set": {"header_id": header_id}}
+        )
+    
     # Update the header
     await db.inventory_headers.update_one(
         {"id": header_id},
         {"$set": update_data}
     )
+    inventory_header_cache.invalidate()
     
     # Create audit log
     await create_audit_log(
@@ -2103,6 +3192,7 @@ async def delete_inventory_header(header_id: str, current_user: User = Depends(r
         {"id": header_id},
         {"$set": {"is_deleted": True}}
     )
+    inventory_header_cache.invalidate()
     
     # Create audit log
     await create_audit_log(
@@ -2127,38 +3217,11 @@ async def get_stock_movements(header_id: Optional[str] = None, current_user: Use
     movements = await db.stock_movements.find(query, {"_id": 0}).sort("date", -1).to_list(1000)
     return movements
 
-@api_router.post("/inventory/movements", response_model=StockMovement, status_code=201)
-async def create_stock_movement(movement_data: dict, current_user: User = Depends(require_permission('inventory.adjust'))):
+def validate_manual_stock_movement(movement_type: str, qty_delta: float, weight_delta: float):
     """
-    Create manual stock movement for inventory adjustments.
-    
-    CRITICAL RESTRICTION - Production ERP Compliance:
-    - Stock OUT movements are PROHIBITED via manual entry
-    - Stock can only be reduced through Invoice Finalization (POST /api/invoices/{id}/finalize)
-    - This ensures proper audit trail, accounting accuracy, and GST compliance
-    
-    Allowed movement types:
-    - "Stock IN": Manual stock additions (returns, found items, corrections)
-    - "Adjustment": Inventory reconciliation adjustments (positive only)
-    
-    Prohibited:
-    - "Stock OUT": Must occur ONLY through invoice finalization to maintain:
-      * Complete audit trail (tied to invoice)
-      * Accurate accounting (revenue recorded)
-      * GST compliance (tax collected)
+    Rules for manually entered stock movements (create_stock_movement and
+    stock-count postings). Raises HTTPException when a movement is not allowed.
     """
-    header = await db.inventory_headers.find_one({"id": movement_data['header_id']}, {"_id": 0})
-    if not header:
-        raise HTTPException(status_code=404, detail="Header not found")
-    
-    # CRITICAL VALIDATION: Prevent manual Stock OUT movements
-    movement_type = movement_data.get('movement_type', '').strip()
-    qty_delta = movement_data.get('qty_delta', 0)
-    weight_delta = movement_data.get('weight_delta', 0)
-    
-    # Get optional confirmation_reason for audit trail
-    confirmation_reason = movement_data.get('confirmation_reason', '').strip() if movement_data.get('confirmation_reason') else None
-    
     # Block Stock OUT movement type entirely
     if movement_type == "Stock OUT":
         raise HTTPException(
@@ -2181,6 +3244,40 @@ async def create_stock_movement(movement_data: dict, current_user: User = Depend
             status_code=400,
             detail=f"Invalid movement_type '{movement_type}'. Allowed types: {', '.join(allowed_types)}. Note: 'Stock OUT' is only created automatically through Invoice Finalization."
         )
+
+@api_router.post("/inventory/movements", response_model=StockMovement, status_code=201)
+async def create_stock_movement(movement_data: dict, current_user: User = Depends(require_permission('inventory.adjust'))):
+    """
+    Create manual stock movement for inventory adjustments.
+    
+    CRITICAL RESTRICTION - Production ERP Compliance:
+    - Stock OUT movements are PROHIBITED via manual entry
+    - Stock can only be reduced through Invoice Finalization (POST /api/invoices/{id}/finalize)
+    - This ensures proper audit trail, accounting accuracy, and GST compliance
+    
+    Allowed movement types:
+    - "Stock IN": Manual stock additions (returns, found items, corrections)
+    - "Adjustment": Inventory reconciliation adjustments (positive only)
+    
+    Prohibited:
+    - "Stock OUT": Must occur ONLY through invoice finalization to maintain:
+      * Complete audit trail (tied to invoice)
+      * Accurate accounting (revenue recorded)
+      * GST compliance (tax collected)
+    """
+    header = await db.inventory_headers.find_one({"id": movement_data['header_id']}, {"_id": 0})
+    if not header:
+        raise HTTPException(status_code=404, detail="Header not found")
+    
+    # CRITICAL VALIDATION: Prevent manual Stock OUT movements
+    movement_type = movement_data.get('movement_type', '').strip()
+    qty_delta = movement_data.get('qty_delta', 0)
+    weight_delta = movement_data.get('weight_delta', 0)
+    
+    # Get optional confirmation_reason for audit trail
+    confirmation_reason = movement_data.get('confirmation_reason', '').strip() if movement_data.get('confirmation_reason') else None
+    
+    validate_manual_stock_movement(movement_type, qty_delta, weight_delta)
     
     movement = StockMovement(
         movement_type=movement_type,
@@ -2214,12 +3311,9 @@ async def create_stock_movement(movement_data: dict, current_user: User = Depend
         }
     )
     
-    # DIRECT UPDATE: Update header's current quantity and weight
-    new_qty = header.get('current_qty', 0) + qty_delta
-    new_weight = header.get('current_weight', 0) + weight_delta
-    
-    # Validate stock doesn't go negative (safety check, should not happen with positive deltas)
-    if new_qty < 0 or new_weight < 0:
+    # DIRECT UPDATE: Atomic $inc of the header's quantity and weight
+    # (guarded, although deltas are validated non-negative above)
+    if not await apply_stock_delta(movement_data['header_id'], qty_delta, weight_delta):
         # Delete the movement we just created
         await db.stock_movements.delete_one({"id": movement.id})
         raise HTTPException(
@@ -2227,11 +3321,6 @@ async def create_stock_movement(movement_data: dict, current_user: User = Depend
             detail=f"Insufficient stock. Available: {header.get('current_qty', 0)} qty, {header.get('current_weight', 0)}g. Requested: {abs(qty_delta)} qty, {abs(weight_delta)}g"
         )
     
-    await db.inventory_headers.update_one(
-        {"id": movement_data['header_id']},
-        {"$set": {"current_qty": new_qty, "current_weight": new_weight}}
-    )
-    
     await create_audit_log(current_user.id, current_user.full_name, "stock_movement", movement.id, "create", 
                           changes={"movement_type": movement_type, "qty_delta": qty_delta, "weight_delta": weight_delta})
     return movement
@@ -2269,34 +3358,31 @@ async def delete_stock_movement(movement_id: str, current_user: User = Depends(r
             detail="Cannot delete 'Stock OUT' movement. Stock OUT movements represent sales/reductions and must be preserved for audit trail. If this movement was created in error, contact system administrator."
         )
     
-    # Get the header to reverse the stock changes
-    header = await db.inventory_headers.find_one({"id": movement['header_id']}, {"_id": 0})
-    if not header:
-        raise HTTPException(status_code=404, detail="Inventory header not found")
-    
-    # Calculate reversed values
-    new_qty = header.get('current_qty', 0) - movement['qty_delta']
-    new_weight = header.get('current_weight', 0) - movement['weight_delta']
+    # Claim the movement first (conditional soft delete) so a concurrent delete
+    # of the same movement cannot reverse it twice
+    claim = await db.stock_movements.update_one(
+        {"id": movement_id, "is_deleted": False},
+        {"$set": {"is_deleted": True, "deleted_at": datetime.now(timezone.utc), "deleted_by": current_user.id}}
+    )
+    if claim.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Stock movement not found")
     
-    # Validate reversal won't make stock negative
-    if new_qty < 0 or new_weight < 0:
+    # Reverse the stock change with a guarded atomic $inc (cannot go negative)
+    reversed_ok = await apply_stock_delta(movement['header_id'], -movement['qty_delta'], -movement['weight_delta'])
+    if not reversed_ok:
+        # Undo the claim - the movement stays in effect
+        await db.stock_movements.update_one(
+            {"id": movement_id},
+            {"$set": {"is_deleted": False}, "$unset": {"deleted_at": "", "deleted_by": ""}}
+        )
+        header = await db.inventory_headers.find_one({"id": movement['header_id']}, {"_id": 0})
+        if not header:
+            raise HTTPException(status_code=404, detail="Inventory header not found")
         raise HTTPException(
             status_code=400,
             detail=f"Cannot delete movement: would result in negative stock. Current: {header.get('current_qty', 0)} qty, {header.get('current_weight', 0)}g. Movement: {movement['qty_delta']} qty, {movement['weight_delta']}g"
         )
     
-    # Soft delete the movement
-    await db.stock_movements.update_one(
-        {"id": movement_id},
-        {"$set": {"is_deleted": True}}
-    )
-    
-    # Reverse the stock change in header
-    await db.inventory_headers.update_one(
-        {"id": movement['header_id']},
-        {"$set": {"current_qty": new_qty, "current_weight": new_weight}}
-    )
-    
     # Create audit log
     await create_audit_log(
         current_user.id,
@@ -2337,6 +3423,426 @@ async def get_stock_totals(current_user: User = Depends(require_permission('inve
         for h in headers
     ]
 
+# ============================================================================
+# STOCK LEDGER CHECKPOINTS & DRIFT RECONCILIATION
+# ============================================================================
+# inventory_headers.current_qty/current_weight must equal the sum of the
+# stock_movements deltas. Checkpoints store the ledger balance of each header up
+# to a cut (last movement created_at + id), so reconciliation only replays the
+# movements recorded after the latest checkpoint instead of the full history.
+
+import asyncio
+
+# Movements younger than this are left out of new checkpoints (a movement object
+# may be stamped slightly before a concurrent one but inserted after it)
+STOCK_CHECKPOINT_SETTLE_SECONDS = int(os.environ.get('STOCK_CHECKPOINT_SETTLE_SECONDS', '300'))
+# Background checkpoint interval; 0 disables the periodic task
+STOCK_CHECKPOINT_INTERVAL_HOURS = float(os.environ.get('STOCK_CHECKPOINT_INTERVAL_HOURS', '24'))
+STOCK_DRIFT_TOLERANCE = 0.001  # grams / qty below which a difference is rounding noise
+# Headers whose stock changed more recently than this are not reported or
+# corrected: their counter may already be moved while the movement is not
+# inserted yet
+STOCK_RECONCILE_SETTLE_SECONDS = int(os.environ.get('STOCK_RECONCILE_SETTLE_SECONDS', '60'))
+
+def stock_movements_for_header(header: dict) -> dict:
+    """
+    Filter for the movements that affect a header: movements carrying its
+    header_id, plus legacy return movements recorded without a header_id
+    (matched by name; their header_id is backfilled when a header is renamed).
+    """
+    return {"$or": [
+        {"header_id": header['id']},
+        {"header_id": None, "reference_type": "return", "header_name": header['name']}
+    ]}
+
+def movements_after_cut(cut_at: Optional[datetime], cut_id: Optional[str]) -> dict:
+    """Filter for movements strictly after a (created_at, id) cut."""
+    if cut_at is None:
+        return {}
+    return {"$or": [
+        {"created_at": {"$gt": cut_at}},
+        {"created_at": cut_at, "id": {"$gt": cut_id or ""}}
+    ]}
+
+async def sum_stock_movements(match: dict) -> Dict[str, Any]:
+    """Aggregate qty/weight deltas for matching movements, plus the last one in (created_at, id) order."""
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"created_at": 1, "id": 1}},
+        {"$group": {
+            "_id": None,
+            "qty": {"$sum": "$qty_delta"},
+            "weight": {"$sum": "$weight_delta"},
+            "count": {"$sum": 1},
+            "last_id": {"$last": "$id"},
+            "last_at": {"$last": "$created_at"}
+        }}
+    ]
+    rows = await db.stock_movements.aggregate(pipeline).to_list(1)
+    if not rows:
+        return {"qty": 0.0, "weight": 0.0, "count": 0, "last_id": None, "last_at": None}
+    return rows[0]
+
+async def get_latest_stock_checkpoint(header_id: str, at_or_before: Optional[datetime] = None) -> Optional[dict]:
+    """Latest checkpoint for a header, optionally the latest whose cut is at or before a date."""
+    query = {"header_id": header_id}
+    if at_or_before is not None:
+        query["as_of"] = {"$lte": at_or_before}
+    return await db.stock_checkpoints.find_one(query, {"_id": 0}, sort=[("as_of", -1), ("created_at", -1)])
+
+async def compute_header_ledger(header: dict, checkpoint: Optional[dict] = None, upto: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Ledger balance of a header: checkpoint balance + movements after its cut
+    (optionally only up to `upto`), minus checkpointed movements that have
+    been soft-deleted since the checkpoint was taken.
+    
+    Returns:
+        Dict with ledger_qty, ledger_weight, replayed_movements and the last
+        movement id/date included in the balance
+    """
+    base_qty = checkpoint['ledger_qty'] if checkpoint else 0.0
+    base_weight = checkpoint['ledger_weight'] if checkpoint else 0.0
+    cut_at = checkpoint['as_of'] if checkpoint else None
+    cut_id = checkpoint.get('last_movement_id') if checkpoint else None
+    
+    header_filter = stock_movements_for_header(header)
+    after_filter = movements_after_cut(cut_at, cut_id)
+    clauses = [header_filter, {"is_deleted": False}]
+    if after_filter:
+        clauses.append(after_filter)
+    if upto is not None:
+        clauses.append({"created_at": {"$lte": upto}})
+    delta = await sum_stock_movements({"$and": clauses})
+    
+    removed = {"qty": 0.0, "weight": 0.0, "count": 0}
+    if checkpoint:
+        # Movements counted in the checkpoint and deleted (reversed) afterwards
+        # (soft-deleted movements are entry corrections: the ledger view treats
+        # them as never applied, also for as-of queries)
+        removed = await sum_stock_movements({"$and": [
+            header_filter,
+            {"is_deleted": True, "deleted_at": {"$gt": checkpoint['created_at']}},
+            {"$nor": [after_filter]}
+        ]})
+    
+    return {
+        "ledger_qty": round(base_qty + delta['qty'] - removed['qty'], 3),
+        "ledger_weight": round(base_weight + delta['weight'] - removed['weight'], 3),
+        "replayed_movements": delta['count'] + removed['count'],
+        "last_movement_id": delta['last_id'] or cut_id,
+        "last_movement_at": delta['last_at'] or cut_at
+    }
+
+async def create_stock_checkpoints(created_by: str) -> List[dict]:
+    """
+    Checkpoint every active header from its previous checkpoint plus the
+    settled movements since (never from the header's own counters, which are
+    what the ledger audits).
+    """
+    settle_cutoff = datetime.now(timezone.utc) - timedelta(seconds=STOCK_CHECKPOINT_SETTLE_SECONDS)
+    headers = await db.inventory_headers.find({"is_deleted": False}, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+    checkpoints = []
+    for header in headers:
+        previous = await get_latest_stock_checkpoint(header['id'])
+        ledger = await compute_header_ledger(header, previous, upto=settle_cutoff)
+        if previous and ledger['replayed_movements'] == 0:
+            continue  # No activity since the last checkpoint
+        checkpoints.append({
+            "id": str(uuid.uuid4()),
+            "header_id": header['id'],
+            "header_name": header['name'],
+            "ledger_qty": ledger['ledger_qty'],
+            "ledger_weight": ledger['ledger_weight'],
+            "last_movement_id": ledger['last_movement_id'],
+            "as_of": ledger['last_movement_at'] or settle_cutoff,
+            "previous_checkpoint_id": previous['id'] if previous else None,
+            "movements_since_previous": ledger['replayed_movements'],
+            "created_at": datetime.now(timezone.utc),
+            "created_by": created_by
+        })
+    if checkpoints:
+        await db.stock_checkpoints.insert_many(checkpoints)
+    return checkpoints
+
+async def reconcile_stock_headers(header_id: Optional[str] = None) -> List[dict]:
+    """Compare each header's counters with its ledger balance (checkpoint + recent replay)."""
+    query = {"is_deleted": False}
+    if header_id:
+        query["id"] = header_id
+    headers = await db.inventory_headers.find(query, {"_id": 0}).to_list(None)
+    settle_cutoff = datetime.now(timezone.utc) - timedelta(seconds=STOCK_RECONCILE_SETTLE_SECONDS)
+    results = []
+    for header in headers:
+        checkpoint = await get_latest_stock_checkpoint(header['id'])
+        ledger = await compute_header_ledger(header, checkpoint)
+        current_qty = header.get('current_qty', 0) or 0
+        current_weight = header.get('current_weight', 0) or 0
+        qty_drift = round(current_qty - ledger['ledger_qty'], 3)
+        weight_drift = round(current_weight - ledger['ledger_weight'], 3)
+        stamp = header.get('stock_updated_at')
+        settling = stamp is not None and as_utc(stamp) > settle_cutoff
+        results.append({
+            "header_id": header['id'],
+            "header_name": header['name'],
+            "current_qty": current_qty,
+            "current_weight": current_weight,
+            "ledger_qty": ledger['ledger_qty'],
+            "ledger_weight": ledger['ledger_weight'],
+            "qty_drift": qty_drift,
+            "weight_drift": weight_drift,
+            "has_drift": not settling and (abs(qty_drift) > STOCK_DRIFT_TOLERANCE or abs(weight_drift) > STOCK_DRIFT_TOLERANCE),
+            "settling": settling,
+            "stock_updated_at": stamp,
+            "checkpoint_id": checkpoint['id'] if checkpoint else None,
+            "checkpoint_as_of": checkpoint['as_of'] if checkpoint else None,
+            "replayed_movements": ledger['replayed_movements']
+        })
+    return results
+
+async def stock_checkpoint_loop():
+    """
+    Background task: every STOCK_CHECKPOINT_INTERVAL_HOURS checkpoint all
+    inventory headers, snapshot all account balances (as-of queries) and
+    build missing month-end period snapshots (financial statements).
+    """
+    while True:
+        await asyncio.sleep(STOCK_CHECKPOINT_INTERVAL_HOURS * 3600)
+        try:
+            created = await create_stock_checkpoints("system")
+            logger.info(f"Stock checkpoints created: {len(created)}")
+        except Exception as e:
+            logger.warning(f"Stock checkpoint run failed: {e}")
+        try:
+            snapshots = await create_account_snapshots("system")
+            logger.info(f"Account balance snapshots created: {len(snapshots)}")
+        except Exception as e:
+            logger.warning(f"Account snapshot run failed: {e}")
+        try:
+            periods = await ensure_period_snapshots("system")
+            if periods:
+                logger.info(f"Period snapshots created: {', '.join(p['period'] for p in periods)}")
+        except Exception as e:
+            logger.warning(f"Period snapshot run failed: {e}")
+
+@api_router.post("/inventory/checkpoints")
+async def create_inventory_checkpoints(current_user: User = Depends(require_permission('inventory.adjust'))):
+    """Create stock ledger checkpoints for all headers with activity since their last checkpoint"""
+    checkpoints = await create_stock_checkpoints(current_user.id)
+    await create_audit_log(
+        current_user.id, current_user.full_name, "inventory", "stock_checkpoints", "checkpoint",
+        {"headers_checkpointed": len(checkpoints)}
+    )
+    return {"created": len(checkpoints), "checkpoints": checkpoints}
+
+@api_router.get("/inventory/checkpoints")
+async def get_inventory_checkpoints(
+    header_id: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 50,
+    current_user: User = Depends(require_permission('inventory.view'))
+):
+    """List stock ledger checkpoints (newest first)"""
+    query = {"header_id": header_id} if header_id else {}
+    total_count = await db.stock_checkpoints.count_documents(query)
+    skip = (page - 1) * page_size
+    items = await db.stock_checkpoints.find(query, {"_id": 0}).sort("as_of", -1).skip(skip).limit(page_size).to_list(page_size)
+    return create_pagination_response(items, total_count, page, page_size)
+
+@api_router.get("/inventory/reconciliation")
+async def get_inventory_reconciliation(
+    header_id: Optional[str] = None,
+    discrepancies_only: bool = True,
+    current_user: User = Depends(require_permission('inventory.view'))
+):
+    """
+    Report per-header drift between inventory counters and the stock ledger.
+    Cost is proportional to the movements recorded since each header's last checkpoint.
+    """
+    results = await reconcile_stock_headers(header_id)
+    if discrepancies_only:
+        results = [r for r in results if r['has_drift']]
+    return {
+        "headers": results,
+        "headers_with_drift": sum(1 for r in results if r['has_drift']),
+        "checked_at": datetime.now(timezone.utc).isoformat()
+    }
+
+@api_router.post("/inventory/reconciliation/fix")
+async def fix_inventory_drift(
+    header_id: Optional[str] = None,
+    current_user: User = Depends(require_permission('inventory.adjust'))
+):
+    """
+    Correct drifted headers to their ledger balance.
+    Applied as a relative $inc (not $set), and only if the header's stock has
+    not changed since it was read (stock_updated_at). Headers that changed
+    within STOCK_RECONCILE_SETTLE_SECONDS are skipped, since their movements
+    may not be written yet.
+    """
+    results = await reconcile_stock_headers(header_id)
+    fixed = []
+    skipped = []
+    for r in results:
+        if r['settling']:
+            skipped.append(r['header_id'])
+            continue
+        if not r['has_drift']:
+            continue
+        result = await db.inventory_headers.update_one(
+            {"id": r['header_id'], "stock_updated_at": r['stock_updated_at']},
+            {"$inc": {"current_qty": -r['qty_drift'], "current_weight": -r['weight_drift']}, "$set": stock_stamp()}
+        )
+        if result.matched_count == 0:
+            skipped.append(r['header_id'])
+            continue
+        await create_audit_log(
+            current_user.id, current_user.full_name, "inventory_header", r['header_id'], "reconcile_drift",
+            {
+                "header_name": r['header_name'],
+                "qty_drift": r['qty_drift'],
+                "weight_drift": r['weight_drift'],
+                "ledger_qty": r['ledger_qty'],
+                "ledger_weight": r['ledger_weight']
+            }
+        )
+        fixed.append(r)
+    return {"fixed": len(fixed), "headers": fixed, "skipped_header_ids": skipped}
+
+# ============================================================================
+# AS-OF BALANCES (stock checkpoints + account balance snapshots)
+# ============================================================================
+# Historical balances are answered from the latest checkpoint/snapshot at or
+# before the requested date plus a replay of the (bounded) activity after it,
+# so "balance on 31 March" costs about the same as the current balance.
+
+def parse_as_of(as_of: str) -> datetime:
+    """
+    Parse an as_of query value. A bare date (YYYY-MM-DD) means the end of
+    that day (UTC); a full ISO timestamp is used as-is.
+    """
+    try:
+        if len(as_of) == 10:
+            day = datetime.fromisoformat(as_of).replace(tzinfo=timezone.utc)
+            return day + timedelta(days=1) - timedelta(microseconds=1)
+        parsed = datetime.fromisoformat(as_of.replace('Z', '+00:00'))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid as_of date '{as_of}'. Use YYYY-MM-DD or ISO 8601.")
+
+async def get_stock_balance_as_of(header: dict, as_of: datetime) -> Dict[str, Any]:
+    """Stock of a header as of a date: latest checkpoint at/before it + movements up to it."""
+    checkpoint = await get_latest_stock_checkpoint(header['id'], at_or_before=as_of)
+    ledger = await compute_header_ledger(header, checkpoint, upto=as_of)
+    return {
+        "as_of": as_of.isoformat(),
+        "qty": ledger['ledger_qty'],
+        "weight": ledger['ledger_weight'],
+        "checkpoint_id": checkpoint['id'] if checkpoint else None,
+        "checkpoint_as_of": checkpoint['as_of'] if checkpoint else None,
+        "replayed_movements": ledger['replayed_movements']
+    }
+
+def _to_float(value) -> float:
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    return float(value or 0)
+
+async def sum_account_transactions(account_type: str, match: dict) -> tuple[float, int]:
+    """Net balance effect (per calculate_balance_delta) and count of matching transactions."""
+    rows = await db.transactions.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$transaction_type", "amount": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    delta = 0.0
+    count = 0
+    for row in rows:
+        if row['_id'] in ('credit', 'debit'):
+            delta += calculate_balance_delta(account_type, row['_id'], _to_float(row['amount']))
+        count += row['count']
+    return delta, count
+
+async def compute_account_balance(account: dict, snapshot: Optional[dict], upto: datetime) -> Dict[str, Any]:
+    """
+    Account balance by business date (transaction.date) up to `upto`.
+    
+    Starting from a snapshot, three bounded sets are replayed:
+    - transactions dated after the snapshot cut (up to `upto`)
+    - back-dated transactions entered after the snapshot was taken
+    - snapshotted transactions deleted after the snapshot was taken
+    """
+    account_type = account.get('account_type', 'asset')
+    account_id = account['id']
+    
+    if snapshot is None:
+        delta, count = await sum_account_transactions(account_type, {
+            "account_id": account_id, "is_deleted": False, "date": {"$lte": upto}
+        })
+        return {"balance": round(_to_float(account.get('opening_balance')) + delta, 3), "replayed_transactions": count}
+    
+    cut = snapshot['as_of']
+    taken_at = snapshot['created_at']
+    new_delta, new_count = await sum_account_transactions(account_type, {
+        "account_id": account_id, "is_deleted": False, "date": {"$gt": cut, "$lte": upto}
+    })
+    backdated_delta, backdated_count = await sum_account_transactions(account_type, {
+        "account_id": account_id, "is_deleted": False, "date": {"$lte": cut}, "created_at": {"$gt": taken_at}
+    })
+    deleted_delta, deleted_count = await sum_account_transactions(account_type, {
+        "account_id": account_id, "is_deleted": True, "date": {"$lte": cut},
+        "created_at": {"$lte": taken_at}, "deleted_at": {"$gt": taken_at}
+    })
+    return {
+        "balance": round(snapshot['balance'] + new_delta + backdated_delta - deleted_delta, 3),
+        "replayed_transactions": new_count + backdated_count + deleted_count
+    }
+
+async def get_latest_account_snapshot(account_id: str, at_or_before: Optional[datetime] = None) -> Optional[dict]:
+    query = {"account_id": account_id}
+    if at_or_before is not None:
+        query["as_of"] = {"$lte": at_or_before}
+    return await db.account_balance_snapshots.find_one(query, {"_id": 0}, sort=[("as_of", -1), ("created_at", -1)])
+
+async def get_account_balance_as_of(account: dict, as_of: datetime) -> Dict[str, Any]:
+    snapshot = await get_latest_account_snapshot(account['id'], at_or_before=as_of)
+    result = await compute_account_balance(account, snapshot, as_of)
+    result.update({
+        "as_of": as_of.isoformat(),
+        "snapshot_id": snapshot['id'] if snapshot else None,
+        "snapshot_as_of": snapshot['as_of'] if snapshot else None
+    })
+    return result
+
+async def create_account_snapshots(created_by: str) -> List[dict]:
+    """Daily balance snapshot of every account, cut at the end of the previous UTC day."""
+    cut = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(microseconds=1)
+    accounts = await account_ref_cache.all()
+    snapshots = []
+    for account in accounts:
+        previous = await get_latest_account_snapshot(account['id'])
+        if previous and previous['as_of'].replace(tzinfo=timezone.utc) >= cut:
+            continue  # Already snapshotted for this day
+        result = await compute_account_balance(account, previous, cut)
+        snapshots.append({
+            "id": str(uuid.uuid4()),
+            "account_id": account['id'],
+            "account_name": account.get('name'),
+            "balance": result['balance'],
+            "as_of": cut,
+            "previous_snapshot_id": previous['id'] if previous else None,
+            "transactions_since_previous": result['replayed_transactions'],
+            "created_at": datetime.now(timezone.utc),
+            "created_by": created_by
+        })
+    if snapshots:
+        await db.account_balance_snapshots.insert_many(snapshots)
+    return snapshots
+
+@api_router.post("/accounts/snapshots")
+async def create_account_balance_snapshots(current_user: User = Depends(require_permission('finance.create'))):
+    """Create end-of-previous-day balance snapshots for all accounts (normally run by the background task)"""
+    snapshots = await create_account_snapshots(current_user.id)
+    return {"created": len(snapshots), "snapshots": snapshots}
+
 # ============================================================================
 # NEW ENDPOINTS FOR API COMPLETENESS
 # ============================================================================
@@ -2547,6 +4053,30 @@ async def get_reports_list(current_user: User = Depends(require_permission('repo
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
 
+# Case-insensitive collation shared by the inventory name index and the
+# category filter - both must use the same collation for the index to apply.
+CASE_INSENSITIVE_COLLATION = {"locale": "en", "strength": 2}
+LOW_STOCK_QTY_THRESHOLD = 5
+
+# Server-side projection to the listing item shape (replaces per-row Python formatting)
+INVENTORY_LIST_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "category": "$name",
+    "quantity": {"$round": [{"$ifNull": ["$current_qty", 0]}, 2]},
+    "weight_grams": {"$round": [{"$ifNull": ["$current_weight", 0]}, 3]},
+    "is_active": {"$ifNull": ["$is_active", True]},
+    "created_at": 1,
+    "created_by": 1,
+    "status": {
+        "$cond": [
+            {"$lt": [{"$ifNull": ["$current_qty", 0]}, LOW_STOCK_QTY_THRESHOLD]},
+            "low_stock",
+            "in_stock"
+        ]
+    }
+}
+
 @api_router.get("/inventory")
 async def get_inventory(
     category: Optional[str] = None,
@@ -2558,121 +4088,584 @@ async def get_inventory(
     """
     Basic inventory listing endpoint with pagination support
     Provides a simple interface for inventory data retrieval
+    
+    All filtering, sorting, pagination and formatting run in MongoDB:
+    - category: case-insensitive name prefix, served by the collated name index
+    - min_qty: current_qty >= min_qty
+    - results sorted by current_weight descending (indexed)
     """
     try:
         # Build query
         query = {"is_deleted": False}
         if category:
-            query['name'] = {"$regex": category, "$options": "i"}
-        
-        # Get all headers for filtering (if min_qty is used)
+            # Prefix range under a strength-2 collation == case-insensitive
+            # "starts with", and unlike an unanchored $regex it uses the index
+            query['name'] = {"$gte": category, "$lt": category + "\uffff"}
         if min_qty is not None:
-            # When filtering by quantity, we need to get all items first
-            headers = await db.inventory_headers.find(query, {"_id": 0}).to_list(1000)
-            headers = [h for h in headers if h.get('current_qty', 0) >= min_qty]
-            
-            # Format response with additional computed fields
-            inventory_items = []
-            for header in headers:
-                item = {
-                    "id": header.get('id'),
-                    "category": header.get('name'),
-                    "quantity": round(header.get('current_qty', 0), 2),
-                    "weight_grams": round(header.get('current_weight', 0), 3),
-                    "is_active": header.get('is_active', True),
-                    "created_at": header.get('created_at'),
-                    "created_by": header.get('created_by'),
-                    "status": "low_stock" if header.get('current_qty', 0) < 5 else "in_stock"
-                }
-                inventory_items.append(item)
-            
-            # Sort by weight descending
-            inventory_items.sort(key=lambda x: x['weight_grams'], reverse=True)
-            
-            # Apply pagination to filtered results
-            total_count = len(inventory_items)
-            skip = (page - 1) * page_size
-            inventory_items = inventory_items[skip:skip + page_size]
-        else:
-            # Efficient pagination without min_qty filter
-            # Calculate skip value
-            skip = (page - 1) * page_size
-            
-            # Get total count for pagination
-            total_count = await db.inventory_headers.count_documents(query)
-            
-            # Get paginated results sorted by current_weight descending
-            headers = await db.inventory_headers.find(query, {"_id": 0}).sort("current_weight", -1).skip(skip).limit(page_size).to_list(page_size)
-            
-            # Format response with additional computed fields
-            inventory_items = []
-            for header in headers:
-                item = {
-                    "id": header.get('id'),
-                    "category": header.get('name'),
-                    "quantity": round(header.get('current_qty', 0), 2),
-                    "weight_grams": round(header.get('current_weight', 0), 3),
-                    "is_active": header.get('is_active', True),
-                    "created_at": header.get('created_at'),
-                    "created_by": header.get('created_by'),
-                    "status": "low_stock" if header.get('current_qty', 0) < 5 else "in_stock"
-                }
-                inventory_items.append(item)
+            query['current_qty'] = {"$gte": min_qty}
+        
+        skip = (page - 1) * page_size
+        total_count = await db.inventory_headers.count_documents(query, collation=CASE_INSENSITIVE_COLLATION)
+        
+        inventory_items = await db.inventory_headers.aggregate([
+            {"$match": query},
+            {"$sort": {"current_weight": -1, "id": 1}},
+            {"$skip": skip},
+            {"$limit": page_size},
+            {"$project": INVENTORY_LIST_PROJECTION}
+        ], collation=CASE_INSENSITIVE_COLLATION).to_list(page_size)
         
         return create_pagination_response(inventory_items, total_count, page, page_size)
     except Exception as e:
         logging.error(f"Inventory listing error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to load inventory: {str(e)}")
 
+@api_router.get("/inventory/availability")
+async def get_inventory_availability(
+    header_id: Optional[str] = None,
+    current_user: User = Depends(require_permission('inventory.view'))
+):
+    """
+    Available-to-sell per inventory header: current stock minus the stock held
+    by active draft-invoice reservations.
+    """
+    query = {"is_deleted": False}
+    if header_id:
+        query["id"] = header_id
+    headers = await db.inventory_headers.find(
+        query, {"_id": 0, "id": 1, "name": 1, "current_qty": 1, "current_weight": 1}
+    ).to_list(None)
+    if header_id and not headers:
+        raise HTTPException(status_code=404, detail="Inventory category not found")
+    
+    reserved = await get_reserved_totals([h['id'] for h in headers])
+    items = []
+    for header in headers:
+        held = reserved.get(header['id'], {"qty": 0, "weight": 0})
+        current_qty = header.get('current_qty', 0)
+        current_weight = header.get('current_weight', 0)
+        items.append({
+            "header_id": header['id'],
+            "header_name": header.get('name'),
+            "current_qty": current_qty,
+            "current_weight": round(current_weight, 3),
+            "reserved_qty": held['qty'],
+            "reserved_weight": round(held['weight'], 3),
+            "available_qty": current_qty - held['qty'],
+            "available_weight": round(current_weight - held['weight'], 3)
+        })
+    return {"items": items, "reservation_ttl_minutes": STOCK_RESERVATION_TTL_MINUTES}
+
+@api_router.get("/invoices/{invoice_id}/reservations")
+async def get_invoice_reservations(invoice_id: str, current_user: User = Depends(require_permission('invoices.view'))):
+    """Active stock reservations held by a draft invoice"""
+    reservations = await db.stock_reservations.find(
+        {"invoice_id": invoice_id, "expires_at": {"$gt": datetime.now(timezone.utc)}}, {"_id": 0}
+    ).to_list(None)
+    return {"invoice_id": invoice_id, "reservations": reservations}
+
+@api_router.post("/invoices/{invoice_id}/reservations/renew")
+async def renew_invoice_reservations(invoice_id: str, current_user: User = Depends(require_permission('invoices.create'))):
+    """
+    Renew (or re-take, if it expired) the stock reservation of a draft invoice
+    for another STOCK_RESERVATION_TTL_MINUTES.
+    """
+    existing = await db.invoices.find_one({"id": invoice_id, "is_deleted": False}, {"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    if existing.get("status") == "finalized":
+        raise HTTPException(status_code=400, detail="Finalized invoices do not hold reservations")
+    
+    shortfalls = await reserve_invoice_stock(Invoice(**decimal_to_float(existing)), current_user.id)
+    if shortfalls:
+        raise HTTPException(status_code=400, detail=f"Insufficient stock: {'; '.join(shortfalls)}")
+    return await get_invoice_reservations(invoice_id, current_user)
+
 # ============================================================================
-# END OF NEW ENDPOINTS
+# TAGGED PIECES (stock_items) - POS scanning
 # ============================================================================
+# Pieces are labels over the header's aggregate stock: importing tags does not
+# change current_qty/current_weight. Selling a tagged piece still goes through
+# the header decrement; the piece itself is marked sold in the same step
+# (see mark_stock_items_sold in deduct_invoice_stock).
+
+from pymongo.errors import BulkWriteError
+
+def stock_item_invoice_line(piece: dict, metal_rate: float, vat_percent: float) -> Dict[str, Any]:
+    """Pre-filled InvoiceItem payload for a scanned piece."""
+    net_weight = piece.get('net_gold_weight') or round(piece['gross_weight'] - piece.get('stone_weight', 0), 3)
+    if piece.get('making_charge_type') == 'per_gram':
+        making_value = round(piece.get('making_charge_value', 0) * net_weight, 3)
+    else:
+        making_value = round(piece.get('making_charge_value', 0), 3)
+    line = calculate_line_item({
+        "category": piece['header_name'],
+        "description": piece.get('description') or piece['header_name'],
+        "qty": 1,
+        "gross_weight": piece['gross_weight'],
+        "stone_weight": piece.get('stone_weight', 0),
+        "net_gold_weight": net_weight,
+        "weight": net_weight,
+        "purity": piece['purity'],
+        "metal_rate": metal_rate,
+        "making_charge_type": piece.get('making_charge_type'),
+        "making_value": making_value,
+        "stone_charges": piece.get('stone_charges', 0),
+        "vat_percent": vat_percent,
+        "tag": piece['tag']
+    })
+    line.pop('subtotal_before_vat', None)
+    return line
+
+@api_router.get("/inventory/items/by-tag/{tag}")
+async def lookup_stock_item_by_tag(
+    tag: str,
+    metal_rate: float = 0.0,
+    vat_percent: float = 5.0,
+    current_user: User = Depends(require_permission('inventory.view'))
+):
+    """
+    Scan lookup: fetch a tagged piece (unique tag index) and return it with a
+    pre-filled invoice line. Pass the current metal_rate to get priced values.
+    """
+    piece = await db.stock_items.find_one({"tag": tag.strip(), "is_deleted": False}, {"_id": 0})
+    if not piece:
+        raise HTTPException(status_code=404, detail=f"No piece with tag '{tag}'")
+    if piece.get('status') != "in_stock":
+        raise HTTPException(status_code=400, detail=f"Piece '{tag}' is {piece.get('status')} (invoice {piece.get('invoice_id')})")
+    return {"item": piece, "invoice_line": stock_item_invoice_line(piece, metal_rate, vat_percent)}
 
-@api_router.get("/parties")
-@limiter.limit("1000/hour")  # General authenticated rate limit: 1000 requests per hour
-async def get_parties(
-    request: Request,
-    party_type: Optional[str] = None,
-    search: Optional[str] = None,
-    date_from: Optional[str] = None,
-    date_to: Optional[str] = None,
+@api_router.get("/inventory/items")
+async def get_stock_items(
+    header_id: Optional[str] = None,
+    status: Optional[str] = None,
     page: int = 1,
-    page_size: int = 10,
-    current_user: User = Depends(require_permission('parties.view'))
+    page_size: int = 50,
+    current_user: User = Depends(require_permission('inventory.view'))
 ):
-    """Get parties with server-side filtering and pagination support"""
+    """List tagged pieces, optionally by inventory header and status"""
     query = {"is_deleted": False}
+    if header_id:
+        query["header_id"] = header_id
+    if status:
+        query["status"] = status
+    skip = (page - 1) * page_size
+    total_count = await db.stock_items.count_documents(query)
+    items = await db.stock_items.find(query, {"_id": 0}).sort("tag", 1).skip(skip).limit(page_size).to_list(page_size)
+    return create_pagination_response(items, total_count, page, page_size)
+
+@api_router.post("/inventory/items/import", status_code=201)
+async def import_stock_items(payload: dict, current_user: User = Depends(require_permission('inventory.adjust'))):
+    """
+    Bulk tag import.
     
-    # Filter by party type
-    if party_type and party_type != 'all':
-        query['party_type'] = party_type
+    Body: {"items": [{"tag", "header_id" or "category", "gross_weight", "stone_weight",
+    "purity", "making_charge_type", "making_charge_value", "stone_charges", "description"}]}
     
-    # Server-side search filter (name or phone)
-    if search and search.strip():
-        search_pattern = {"$regex": search.strip(), "$options": "i"}  # case-insensitive
-        query['$or'] = [
-            {"name": search_pattern},
-            {"phone": search_pattern}
-        ]
+    Valid rows are inserted in one unordered insert_many; rows that fail
+    validation or hit an existing tag are reported with their index.
+    """
+    rows = payload.get('items') or []
+    if not rows:
+        raise HTTPException(status_code=400, detail="items is required")
     
-    # Date range filter (filter by created date)
-    if date_from or date_to:
-        date_query = {}
-        if date_from:
-            date_query['$gte'] = date_from
-        if date_to:
-            date_query['$lte'] = date_to
-        if date_query:
-            query['created_at'] = date_query
+    errors = []
+    docs = []
+    doc_rows = []
+    for index, row in enumerate(rows):
+        header = None
+        if row.get('header_id'):
+            header = await inventory_header_cache.get_by_id(row['header_id']) or await db.inventory_headers.find_one(
+                {"id": row['header_id'], "is_deleted": False}, {"_id": 0, "id": 1, "name": 1}
+            )
+        elif row.get('category'):
+            header = await resolve_inventory_header(row['category'])
+        if not header:
+            errors.append({"index": index, "tag": row.get('tag'), "error": "Inventory header not found"})
+            continue
+        try:
+            gross = float(row['gross_weight'])
+            stone = float(row.get('stone_weight') or 0)
+            if gross <= 0 or stone < 0 or stone > gross:
+                raise ValueError("gross_weight must be > 0 and stone_weight between 0 and gross_weight")
+            piece = StockItem(
+                tag=str(row['tag']).strip(),
+                header_id=header['id'],
+                header_name=header['name'],
+                description=row.get('description'),
+                gross_weight=round(gross, 3),
+                stone_weight=round(stone, 3),
+                net_gold_weight=round(gross - stone, 3),
+                purity=row['purity'],
+                making_charge_type=row.get('making_charge_type'),
+                making_charge_value=row.get('making_charge_value') or 0,
+                stone_charges=row.get('stone_charges') or 0,
+                created_by=current_user.id
+            )
+            if not piece.tag:
+                raise ValueError("tag is required")
+        except (KeyError, ValueError, TypeError) as e:
+            errors.append({"index": index, "tag": row.get('tag'), "error": str(e)})
+            continue
+        docs.append(piece.model_dump())
+        doc_rows.append(index)
     
-    # Calculate skip value
+    inserted = len(docs)
+    if docs:
+        try:
+            await db.stock_items.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                index = doc_rows[write_error['index']]
+                duplicate = write_error.get('code') == 11000
+                errors.append({
+                    "index": index,
+                    "tag": docs[write_error['index']]['tag'],
+                    "error": "Tag already exists" if duplicate else write_error.get('errmsg')
+                })
+            inserted = e.details.get('nInserted', 0)
+    
+    await create_audit_log(current_user.id, current_user.full_name, "stock_item", "bulk", "import",
+                           {"inserted": inserted, "failed": len(errors)})
+    return {"inserted": inserted, "failed": len(errors), "errors": sorted(errors, key=lambda err: err['index'])}
+
+# ============================================================================
+# PHYSICAL STOCK COUNT SESSIONS
+# ============================================================================
+# A count session accumulates counted qty/weight per header in one document:
+#   counts.<header_id>.qty / .weight / .lines
+# Several scanners post batches concurrently; each batch is a single atomic
+# $inc on the session document, and an optional batch_id makes a resent batch
+# a no-op. Variance against book stock is one aggregation over the session,
+# and approved positive variances are posted as one batch of "Adjustment"
+# movements under the same rules as manual movements.
+
+from pymongo import UpdateOne
+
+async def compute_count_variance(session_id: str) -> List[Dict[str, Any]]:
+    """Counted vs book stock per counted header (single aggregation)."""
+    return await db.stock_count_sessions.aggregate([
+        {"$match": {"id": session_id}},
+        {"$project": {"_id": 0, "counts": {"$objectToArray": {"$ifNull": ["$counts", {}]}}}},
+        {"$unwind": "$counts"},
+        {"$lookup": {
+            "from": "inventory_headers",
+            "localField": "counts.k",
+            "foreignField": "id",
+            "as": "header"
+        }},
+        {"$unwind": {"path": "$header", "preserveNullAndEmptyArrays": True}},
+        {"$project": {
+            "header_id": "$counts.k",
+            "header_name": "$header.name",
+            "counted_qty": "$counts.v.qty",
+            "counted_weight": {"$round": ["$counts.v.weight", 3]},
+            "scan_lines": "$counts.v.lines",
+            "book_qty": {"$ifNull": ["$header.current_qty", 0]},
+            "book_weight": {"$round": [{"$ifNull": ["$header.current_weight", 0]}, 3]},
+            "variance_qty": {"$subtract": ["$counts.v.qty", {"$ifNull": ["$header.current_qty", 0]}]},
+            "variance_weight": {"$round": [
+                {"$subtract": ["$counts.v.weight", {"$ifNull": ["$header.current_weight", 0]}]}, 3
+            ]}
+        }},
+        {"$sort": {"header_name": 1}}
+    ]).to_list(None)
+
+@api_router.post("/inventory/count-sessions", status_code=201)
+async def create_stock_count_session(session_data: dict, current_user: User = Depends(require_permission('inventory.adjust'))):
+    """Open a physical stock-count session"""
+    session = {
+        "id": str(uuid.uuid4()),
+        "name": (session_data.get('name') or f"Stock count {datetime.now(timezone.utc).date().isoformat()}").strip(),
+        "notes": session_data.get('notes'),
+        "status": "open",  # open -> closed -> posted
+        "counts": {},
+        "batch_ids": [],
+        "batch_count": 0,
+        "created_at": datetime.now(timezone.utc),
+        "created_by": current_user.id
+    }
+    await db.stock_count_sessions.insert_one(session)
+    session.pop('_id', None)
+    await create_audit_log(current_user.id, current_user.full_name, "stock_count", session['id'], "create")
+    return session
+
+@api_router.get("/inventory/count-sessions")
+async def get_stock_count_sessions(
+    page: int = 1,
+    page_size: int = 20,
+    current_user: User = Depends(require_permission('inventory.view'))
+):
+    """List stock-count sessions (without the per-header counts)"""
     skip = (page - 1) * page_size
+    total_count = await db.stock_count_sessions.count_documents({})
+    sessions = await db.stock_count_sessions.find(
+        {}, {"_id": 0, "counts": 0, "batch_ids": 0}
+    ).sort("created_at", -1).skip(skip).limit(page_size).to_list(page_size)
+    return create_pagination_response(sessions, total_count, page, page_size)
+
+@api_router.post("/inventory/count-sessions/{session_id}/batches")
+async def add_stock_count_batch(session_id: str, batch: dict, current_user: User = Depends(require_permission('inventory.adjust'))):
+    """
+    Add a batch of counted stock from one scanner.
     
-    # Get total count for pagination (with filters applied)
+    Body: {"batch_id": optional, "lines": [{"header_id" | "category" | "tag", "qty", "weight"}]}
+    - header_id/category lines add the given qty/weight (counted by weighing)
+    - tag lines count one tagged piece (qty 1, its net weight)
+    
+    The whole batch is applied as one atomic $inc on the session document.
+    """
+    lines = batch.get('lines') or []
+    if not lines:
+        raise HTTPException(status_code=400, detail="lines is required")
+    
+    # Resolve tagged pieces in one query
+    tags = [str(line['tag']).strip() for line in lines if line.get('tag')]
+    pieces = {}
+    if tags:
+        found = await db.stock_items.find(
+            {"tag": {"$in": tags}, "is_deleted": False}, {"_id": 0, "tag": 1, "header_id": 1, "net_gold_weight": 1}
+        ).to_list(None)
+        pieces = {piece['tag']: piece for piece in found}
+    
+    increments: Dict[str, float] = {}
+    errors = []
+    for index, line in enumerate(lines):
+        if line.get('tag'):
+            piece = pieces.get(str(line['tag']).strip())
+            if not piece:
+                errors.append({"index": index, "error": f"Unknown tag '{line['tag']}'"})
+                continue
+            header_id, qty, weight = piece['header_id'], 1, piece.get('net_gold_weight', 0)
+        else:
+            header = None
+            if line.get('header_id'):
+                header = await inventory_header_cache.get_by_id(line['header_id']) or await db.inventory_headers.find_one(
+                    {"id": line['header_id'], "is_deleted": False}, {"_id": 0, "id": 1, "name": 1}
+                )
+            elif line.get('category'):
+                header = await resolve_inventory_header(line['category'])
+            if not header:
+                errors.append({"index": index, "error": "Inventory header not found"})
+                continue
+            try:
+                header_id, qty, weight = header['id'], float(line.get('qty') or 0), float(line.get('weight') or 0)
+            except (TypeError, ValueError):
+                errors.append({"index": index, "error": "qty and weight must be numbers"})
+                continue
+            if qty < 0 or weight < 0:
+                errors.append({"index": index, "error": "qty and weight must not be negative"})
+                continue
+        for field, value in (("qty", qty), ("weight", weight), ("lines", 1)):
+            key = f"counts.{header_id}.{field}"
+            increments[key] = increments.get(key, 0) + value
+    
+    if errors:
+        # Reject the whole batch so a scanner can resend it once corrected
+        raise HTTPException(status_code=400, detail={"message": "Batch rejected", "errors": errors})
+    
+    query = {"id": session_id, "status": "open"}
+    update = {"$inc": {**increments, "batch_count": 1}, "$set": {"last_batch_at": datetime.now(timezone.utc)}}
+    batch_id = batch.get('batch_id')
+    if batch_id:
+        query["batch_ids"] = {"$ne": batch_id}
+        update["$push"] = {"batch_ids": batch_id}
+    
+    result = await db.stock_count_sessions.update_one(query, update)
+    if result.matched_count == 0:
+        session = await db.stock_count_sessions.find_one({"id": session_id}, {"_id": 0, "status": 1, "batch_ids": 1})
+        if not session:
+            raise HTTPException(status_code=404, detail="Count session not found")
+        if session['status'] != "open":
+            raise HTTPException(status_code=400, detail=f"Count session is {session['status']}")
+        return {"message": "Batch already applied", "batch_id": batch_id, "duplicate": True}
+    
+    return {"message": "Batch applied", "batch_id": batch_id, "lines": len(lines), "duplicate": False}
+
+@api_router.post("/inventory/count-sessions/{session_id}/close")
+async def close_stock_count_session(session_id: str, current_user: User = Depends(require_permission('inventory.adjust'))):
+    """Stop accepting batches (counting finished, ready for review)"""
+    result = await db.stock_count_sessions.update_one(
+        {"id": session_id, "status": "open"},
+        {"$set": {"status": "closed", "closed_at": datetime.now(timezone.utc), "closed_by": current_user.id}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=400, detail="Count session not found or not open")
+    await create_audit_log(current_user.id, current_user.full_name, "stock_count", session_id, "close")
+    return {"message": "Count session closed"}
+
+@api_router.get("/inventory/count-sessions/{session_id}/variance")
+async def get_stock_count_variance(
+    session_id: str,
+    discrepancies_only: bool = False,
+    current_user: User = Depends(require_permission('inventory.view'))
+):
+    """Counted vs book stock for every header counted in the session"""
+    session = await db.stock_count_sessions.find_one({"id": session_id}, {"_id": 0, "counts": 0, "batch_ids": 0})
+    if not session:
+        raise HTTPException(status_code=404, detail="Count session not found")
+    
+    rows = await compute_count_variance(session_id)
+    counted_ids = [row['header_id'] for row in rows]
+    uncounted = await db.inventory_headers.count_documents({"is_deleted": False, "id": {"$nin": counted_ids}})
+    if discrepancies_only:
+        rows = [row for row in rows if abs(row['variance_qty']) > STOCK_DRIFT_TOLERANCE or abs(row['variance_weight']) > STOCK_DRIFT_TOLERANCE]
+    return {"session": session, "items": rows, "uncounted_headers": uncounted}
+
+@api_router.post("/inventory/count-sessions/{session_id}/post")
+async def post_stock_count_variances(session_id: str, approval: dict, current_user: User = Depends(require_permission('inventory.adjust'))):
+    """
+    Post approved variances as one batch of Adjustment movements.
+    
+    Body: {"reason": required, "header_ids": optional subset, "purity": default 916}
+    
+    Each variance goes through validate_manual_stock_movement, the same rules
+    as POST /inventory/movements: surpluses are posted as "Adjustment";
+    shortages cannot be posted manually (stock is only reduced by invoice
+    finalization) and are returned as blocked for separate handling.
+    """
+    reason = (approval.get('reason') or '').strip()
+    if not reason:
+        raise HTTPException(status_code=400, detail="reason is required to post stock-count adjustments")
+    
+    # Claim the session so variances are posted exactly once
+    claimed = await db.stock_count_sessions.find_one_and_update(
+        {"id": session_id, "status": {"$in": ["open", "closed"]}},
+        {"$set": {"status": "posting"}},
+        projection={"_id": 0, "name": 1}
+    )
+    if not claimed:
+        raise HTTPException(status_code=400, detail="Count session not found or already posted")
+    
+    try:
+        rows = await compute_count_variance(session_id)
+        selected = set(approval.get('header_ids') or [row['header_id'] for row in rows])
+        purity = int(approval.get('purity') or 916)
+        
+        movements = []
+        blocked = []
+        for row in rows:
+            if row['header_id'] not in selected or row['header_name'] is None:
+                continue
+            qty_delta = round(row['variance_qty'], 3)
+            weight_delta = round(row['variance_weight'], 3)
+            if abs(qty_delta) <= STOCK_DRIFT_TOLERANCE and abs(weight_delta) <= STOCK_DRIFT_TOLERANCE:
+                continue
+            try:
+                validate_manual_stock_movement("Adjustment", qty_delta, weight_delta)
+            except HTTPException as e:
+                blocked.append({**row, "error": e.detail})
+                continue
+            movements.append(StockMovement(
+                movement_type="Adjustment",
+                header_id=row['header_id'],
+                header_name=row['header_name'],
+                description=f"Stock count: {claimed['name']}",
+                qty_delta=qty_delta,
+                weight_delta=weight_delta,
+                purity=purity,
+                reference_type="stock_count",
+                reference_id=session_id,
+                confirmation_reason=reason,
+                created_by=current_user.id
+            ))
+        
+        if movements:
+            try:
+                await db.stock_movements.insert_many([m.model_dump() for m in movements])
+                await db.inventory_headers.bulk_write([
+                    UpdateOne({"id": m.header_id}, {"$inc": {"current_qty": m.qty_delta, "current_weight": m.weight_delta}, "$set": stock_stamp()})
+                    for m in movements
+                ], ordered=True)
+            except Exception as e:
+                # Undo the header $incs before the failing write and drop the
+                # movements, so re-posting the session cannot duplicate them
+                applied = 0
+                if isinstance(e, BulkWriteError):
+                    write_errors = e.details.get('writeErrors') or []
+                    applied = write_errors[0]['index'] if write_errors else len(movements)
+                if applied:
+                    await db.inventory_headers.bulk_write([
+                        UpdateOne({"id": m.header_id}, {"$inc": {"current_qty": -m.qty_delta, "current_weight": -m.weight_delta}, "$set": stock_stamp()})
+                        for m in movements[:applied]
+                    ], ordered=True)
+                await db.stock_movements.delete_many({"id": {"$in": [m.id for m in movements]}})
+                raise
+    except Exception:
+        await db.stock_count_sessions.update_one({"id": session_id}, {"$set": {"status": "closed"}})
+        raise
+    
+    await db.stock_count_sessions.update_one(
+        {"id": session_id},
+        {"$set": {
+            "status": "posted",
+            "posted_at": datetime.now(timezone.utc),
+            "posted_by": current_user.id,
+            "posted_movement_ids": [m.id for m in movements],
+            "blocked_header_ids": [row['header_id'] for row in blocked]
+        }}
+    )
+    await create_audit_log(current_user.id, current_user.full_name, "stock_count", session_id, "post", {
+        "adjustments": len(movements),
+        "blocked": len(blocked),
+        "reason": reason
+    })
+    return {
+        "message": f"Posted {len(movements)} adjustment(s)",
+        "movements": [m.model_dump() for m in movements],
+        "blocked": blocked
+    }
+
+# ============================================================================
+# END OF NEW ENDPOINTS
+# ============================================================================
+
+@api_router.get("/parties")
+@limiter.limit("1000/hour")  # General authenticated rate limit: 1000 requests per hour
+async def get_parties(
+    request: Request,
+    party_type: Optional[str] = None,
+    search: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 10,
+    fields: str = "summary",
+    current_user: User = Depends(require_permission('parties.view'))
+):
+    """Get parties with server-side filtering and pagination support (fields: summary | full)"""
+    query = {"is_deleted": False}
+    
+    # Filter by party type
+    if party_type and party_type != 'all':
+        query['party_type'] = party_type
+    
+    # Server-side search filter (name or phone)
+    if search and search.strip():
+        search_pattern = {"$regex": search.strip(), "$options": "i"}  # case-insensitive
+        query['$or'] = [
+            {"name": search_pattern},
+            {"phone": search_pattern}
+        ]
+    
+    # Date range filter (filter by created date)
+    if date_from or date_to:
+        date_query = {}
+        if date_from:
+            date_query['$gte'] = date_from
+        if date_to:
+            date_query['$lte'] = date_to
+        if date_query:
+            query['created_at'] = date_query
+    
+    # Calculate skip value
+    skip = (page - 1) * page_size
+    
+    # Get total count for pagination (with filters applied)
     total_count = await db.parties.count_documents(query)
     
     # Get paginated results (with filters applied)
-    parties = await db.parties.find(query, {"_id": 0}).skip(skip).limit(page_size).to_list(page_size)
+    parties = await db.parties.find(query, list_projection("parties", fields)).skip(skip).limit(page_size).to_list(page_size)
     
     return create_pagination_response(parties, total_count, page, page_size)
 
@@ -3079,6 +5072,7 @@ async def create_gold_ledger_entry(entry_data: dict, current_user: User = Depend
         notes=entry_data.get('notes'),
         created_by=current_user.id
     )
+    await ensure_period_open(entry.date, "Gold ledger entry")
     
     await db.gold_ledger.insert_one(entry.model_dump())
     await create_audit_log(current_user.id, current_user.full_name, "gold_ledger", entry.id, "create")
@@ -3132,6 +5126,7 @@ async def delete_gold_ledger_entry(entry_id: str, current_user: User = Depends(r
     entry = await db.gold_ledger.find_one({"id": entry_id, "is_deleted": False})
     if not entry:
         raise HTTPException(status_code=404, detail="Gold ledger entry not found")
+    await ensure_period_open(entry.get('date'), "Gold ledger entry")
     
     # Soft delete
     await db.gold_ledger.update_one(
@@ -3200,6 +5195,7 @@ async def create_gold_deposit(deposit_data: dict, current_user: User = Depends(r
         notes=deposit_data.get('notes'),
         created_by=current_user.id
     )
+    await ensure_period_open(entry.date, "Gold deposit")
     
     await db.gold_ledger.insert_one(entry.model_dump())
     await create_audit_log(current_user.id, current_user.full_name, "gold_deposit", entry.id, "create")
@@ -3492,6 +5488,8 @@ async def create_purchase(request: Request, purchase_data: dict, current_user: U
     # Create Purchase model instance
     purchase = Purchase(**purchase_data)
     purchase_id = purchase.id
+    # Stock, gold ledger and transactions below are all dated purchase.date
+    await ensure_period_open(purchase.date, "Purchase")
     
     # Insert purchase
     await db.purchases.insert_one(purchase.model_dump())
@@ -3513,6 +5511,7 @@ async def create_purchase(request: Request, purchase_data: dict, current_user: U
             created_by=current_user.username
         )
         await db.inventory_headers.insert_one(header.model_dump())
+        inventory_header_cache.invalidate()
     
     # Create Stock IN movement
     movement = StockMovement(
@@ -3538,7 +5537,7 @@ async def create_purchase(request: Request, purchase_data: dict, current_user: U
         {"$inc": {
             "current_qty": 1,
             "current_weight": purchase.weight_grams
-        }}
+        }, "$set": stock_stamp()}
     )
     
     # === OPERATION 2: Create DEBIT transaction if paid_amount_money > 0 ===
@@ -3629,6 +5628,7 @@ async def create_purchase(request: Request, purchase_data: dict, current_user: U
                 created_by=current_user.username
             )
             await db.accounts.insert_one(purchases_account.model_dump())
+            account_ref_cache.invalidate()
         
         payable_transaction = Transaction(
             transaction_number=payable_txn_number,
@@ -3859,9 +5859,10 @@ async def get_purchases(
     status: Optional[str] = None,
     page: int = 1,
     page_size: int = 10,
+    fields: str = "summary",
     current_user: User = Depends(require_permission('purchases.view'))
 ):
-    """Get all purchases with optional filters and pagination"""
+    """Get all purchases with optional filters and pagination (fields: summary | full)"""
     query = {"is_deleted": False}
     
     # Filter by vendor
@@ -3887,12 +5888,11 @@ async def get_purchases(
     total_count = await db.purchases.count_documents(query)
     
     # Get paginated results
-    purchases = await db.purchases.find(query).sort("date", -1).skip(skip).limit(page_size).to_list(page_size)
-    
-    # CRITICAL FIX: Process purchases through decimal_to_float to handle Decimal serialization
-    purchases = [decimal_to_float(p) for p in purchases]
+    purchases = await db.purchases.find(query, list_projection("purchases", fields)).sort("date", -1).skip(skip).limit(page_size).to_list(page_size)
     
-    return create_pagination_response(purchases, total_count, page, page_size)
+    # Decimal128/ObjectId/datetime are converted by MongoJSONResponse in a single
+    # orjson pass - no decimal_to_float walk and no jsonable_encoder walk
+    return MongoJSONResponse(create_pagination_response(purchases, total_count, page, page_size))
 
 @api_router.patch("/purchases/{purchase_id}")
 async def update_purchase(
@@ -3919,6 +5919,9 @@ async def update_purchase(
             status_code=400,
             detail="Cannot edit locked purchase. Purchase is finalized and fully paid. Locked purchases are immutable to maintain financial integrity."
         )
+    await ensure_period_open(existing.get("date"), "Purchase")
+    if updates.get("date"):
+        await ensure_period_open(updates["date"], "Purchase")
     
     # Validate vendor if being updated
     if "vendor_party_id" in updates:
@@ -4017,6 +6020,26 @@ async def update_purchase(
     return decimal_to_float(updated)
 
 
+@api_router.get("/purchases/{purchase_id}")
+async def get_purchase(
+    purchase_id: str,
+    request: Request,
+    current_user: User = Depends(require_permission('purchases.view'))
+):
+    """Get a single purchase by ID (ETag-cacheable once locked)"""
+    not_modified = await check_not_modified(request, db.purchases, purchase_id, PURCHASE_VERSION_FIELDS, "purchase")
+    if not_modified:
+        return not_modified
+    
+    purchase = await db.purchases.find_one({"id": purchase_id, "is_deleted": False})
+    if not purchase:
+        raise HTTPException(status_code=404, detail="Purchase not found")
+    
+    purchase_response = MongoJSONResponse(purchase)
+    etag = build_document_etag(purchase, PURCHASE_VERSION_FIELDS, "purchase")
+    apply_cache_headers(purchase_response, etag, CACHE_CONTROL_FINALIZED if etag else CACHE_CONTROL_DRAFT)
+    return purchase_response
+
 @api_router.get("/purchases/{purchase_id}/impact")
 async def get_purchase_impact(purchase_id: str, current_user: User = Depends(require_permission('purchases.view'))):
     """
@@ -4104,9 +6127,10 @@ async def finalize_purchase(purchase_id: str, current_user: User = Depends(requi
 async def get_jobcards(
     page: int = 1,
     page_size: int = 10,
+    fields: str = "summary",
     current_user: User = Depends(require_permission('jobcards.view'))
 ):
-    """Get job cards with pagination support"""
+    """Get job cards with pagination support (fields: summary | full)"""
     query = {"is_deleted": False, "card_type": {"$ne": "template"}}
     
     # Calculate skip value
@@ -4116,10 +6140,18 @@ async def get_jobcards(
     total_count = await db.jobcards.count_documents(query)
     
     # Get paginated results, sorted by creation date (newest first)
-    jobcards = await db.jobcards.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(page_size).to_list(page_size)
+    jobcards = await db.jobcards.find(query, list_projection("jobcards", fields)).sort("created_at", -1).skip(skip).limit(page_size).to_list(page_size)
     
     return create_pagination_response(jobcards, total_count, page, page_size)
 
+@api_router.get("/jobcards/{jobcard_id}")
+async def get_jobcard(jobcard_id: str, current_user: User = Depends(require_permission('jobcards.view'))):
+    """Get a single job card (full document, including items)"""
+    jobcard = await db.jobcards.find_one({"id": jobcard_id, "is_deleted": False}, {"_id": 0})
+    if not jobcard:
+        raise HTTPException(status_code=404, detail="Job card not found")
+    return decimal_to_float(jobcard)
+
 @api_router.post("/jobcards", status_code=201)
 async def create_jobcard(jobcard_data: dict, current_user: User = Depends(require_permission('jobcards.create'))):
     """Create a new job card"""
@@ -4568,6 +6600,11 @@ async def convert_jobcard_to_invoice(jobcard_id: str, invoice_data: dict, curren
     
     invoice = Invoice(**invoice_dict)
     
+    # Same reservation rule as create_invoice (service invoices hold no stock)
+    shortfalls = await reserve_invoice_stock(invoice, current_user.id)
+    if shortfalls:
+        raise HTTPException(status_code=400, detail=f"Insufficient stock: {'; '.join(shortfalls)}")
+    
     await db.invoices.insert_one(invoice.model_dump())
     await create_audit_log(current_user.id, current_user.full_name, "invoice", invoice.id, "create_from_jobcard")
     
@@ -4592,8 +6629,8 @@ async def convert_jobcard_to_invoice(jobcard_id: str, invoice_data: dict, curren
 @api_router.get("/jobcard-templates")
 async def get_jobcard_templates(current_user: User = Depends(require_permission('jobcards.view'))):
     """Get all job card templates (accessible to all users)"""
-    query = {"card_type": "template", "is_deleted": False}
-    templates = await db.jobcards.find(query, {"_id": 0}).sort("template_name", 1).to_list(None)
+    templates = await jobcard_template_cache.all()
+    templates.sort(key=lambda t: t.get('template_name') or '')
     return {"items": templates}
 
 @api_router.post("/jobcard-templates")
@@ -4626,6 +6663,7 @@ async def create_jobcard_template(template_data: dict, current_user: User = Depe
     # Create the template
     template = JobCard(**template_data, created_by=current_user.id)
     await db.jobcards.insert_one(template.model_dump())
+    jobcard_template_cache.invalidate()
     await create_audit_log(current_user.id, current_user.full_name, "jobcard_template", template.id, "create")
     
     return template
@@ -4653,6 +6691,7 @@ async def update_jobcard_template(template_id: str, update_data: dict, current_u
     
     # Update the template
     await db.jobcards.update_one({"id": template_id}, {"$set": update_data})
+    jobcard_template_cache.invalidate()
     await create_audit_log(current_user.id, current_user.full_name, "jobcard_template", template_id, "update", update_data)
     
     return {"message": "Template updated successfully"}
@@ -4674,6 +6713,7 @@ async def delete_jobcard_template(template_id: str, current_user: User = Depends
         {"id": template_id},
         {"$set": {"is_deleted": True, "deleted_at": datetime.now(timezone.utc), "deleted_by": current_user.id}}
     )
+    jobcard_template_cache.invalidate()
     await create_audit_log(current_user.id, current_user.full_name, "jobcard_template", template_id, "delete")
     
     return {"message": "Template deleted successfully"}
@@ -4684,9 +6724,10 @@ async def get_invoices(
     request: Request,
     page: int = 1,
     page_size: int = 10,
+    fields: str = "summary",
     current_user: User = Depends(require_permission('invoices.view'))
 ):
-    """Get invoices with pagination support"""
+    """Get invoices with pagination support (fields: summary | full)"""
     if not user_has_permission(current_user, 'invoices.view'):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You don't have permission to view invoices")
     
@@ -4699,9 +6740,10 @@ async def get_invoices(
     total_count = await db.invoices.count_documents(query)
     
     # Get paginated results
-    invoices = await db.invoices.find(query, {"_id": 0}).sort("date", -1).skip(skip).limit(page_size).to_list(page_size)
+    invoices = await db.invoices.find(query, list_projection("invoices", fields)).sort("date", -1).skip(skip).limit(page_size).to_list(page_size)
     
-    return create_pagination_response(invoices, total_count, page, page_size)
+    # Returned directly so the raw documents are encoded once by orjson
+    return MongoJSONResponse(create_pagination_response(invoices, total_count, page, page_size))
 
 @api_router.get("/invoices/returnable")
 async def get_returnable_invoices(
@@ -4781,7 +6823,7 @@ async def get_invoice_returnable_items(
     
     This endpoint:
     1. Fetches the invoice and its items
-    2. Calculates already returned quantities/weights from finalized returns
+    2. Reads already returned quantities/weights per line from the invoice's returned counters
     3. Returns remaining returnable items (original - already returned)
     
     Returns:
@@ -4803,37 +6845,16 @@ async def get_invoice_returnable_items(
     if not invoice_items:
         return []
     
-    # Fetch all finalized returns for this invoice
-    returns = await db.returns.find({
-        "reference_type": "invoice",
-        "reference_id": invoice_id,
-        "status": "finalized",
-        "is_deleted": False
-    }).to_list(None)
-    
-    # Build a map of already returned quantities by item description and purity
-    # Using description+purity as key since items in returns might not have invoice item IDs
-    returned_map = {}
-    for ret in returns:
-        for ret_item in ret.get('items', []):
-            key = f"{ret_item.get('description', '')}_{ret_item.get('purity', 0)}"
-            if key not in returned_map:
-                returned_map[key] = {
-                    'qty': 0,
-                    'weight_grams': 0.0
-                }
-            returned_map[key]['qty'] += ret_item.get('qty', 0)
-            weight_value = ret_item.get('weight_grams', 0)
-            if isinstance(weight_value, Decimal128):
-                weight_value = float(weight_value.to_decimal())
-            returned_map[key]['weight_grams'] += float(weight_value)
+    # Already returned quantities per invoice line come from the counters on
+    # the invoice itself (maintained by finalize_return)
+    invoice = await ensure_return_counters('invoice', invoice_id, invoice)
+    returned_lines = invoice.get('returned_lines') or {}
     
     # Calculate returnable items
     returnable_items = []
     for item in invoice_items:
         item_desc = item.get('description', '')
         item_purity = item.get('purity', 0)
-        key = f"{item_desc}_{item_purity}"
         
         # Original quantities
         original_qty = item.get('qty', 0)
@@ -4841,9 +6862,9 @@ async def get_invoice_returnable_items(
         original_amount = float(item.get('line_total', 0))
         
         # Already returned
-        already_returned = returned_map.get(key, {'qty': 0, 'weight_grams': 0.0})
-        returned_qty = already_returned['qty']
-        returned_weight = already_returned['weight_grams']
+        already_returned = returned_lines.get(item.get('id')) or {}
+        returned_qty = already_returned.get('qty', 0)
+        returned_weight = float(already_returned.get('weight', 0.0))
         
         # Calculate remaining
         remaining_qty = original_qty - returned_qty
@@ -4877,10 +6898,17 @@ async def get_invoice_returnable_items(
     return returnable_items
 
 @api_router.get("/invoices/{invoice_id}", response_model=Invoice)
-async def get_invoice(invoice_id: str, current_user: User = Depends(require_permission('invoices.view'))):
+async def get_invoice(invoice_id: str, request: Request, response: Response, current_user: User = Depends(require_permission('invoices.view'))):
+    not_modified = await check_not_modified(request, db.invoices, invoice_id, INVOICE_VERSION_FIELDS, "invoice")
+    if not_modified:
+        return not_modified
+    
     invoice = await db.invoices.find_one({"id": invoice_id, "is_deleted": False}, {"_id": 0})
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
+    
+    etag = build_document_etag(invoice, INVOICE_VERSION_FIELDS, "invoice")
+    apply_cache_headers(response, etag, CACHE_CONTROL_FINALIZED if etag else CACHE_CONTROL_DRAFT)
     return Invoice(**invoice)
 
 @api_router.patch("/invoices/{invoice_id}")
@@ -4906,10 +6934,263 @@ async def update_invoice(invoice_id: str, update_data: dict, current_user: User
         del update_data["finalized_at"]
     if "finalized_by" in update_data:
         del update_data["finalized_by"]
+    if update_data.get("date"):
+        await ensure_period_open(update_data["date"], "Invoice")
+    
+    # Server-owned fields: autosave echoes a possibly stale items_version and
+    # client-side totals; the version is bumped and totals recalculated below
+    for field in ["items_version", *INVOICE_TOTAL_FIELDS]:
+        if field not in INVOICE_HEADER_EDITABLE_FIELDS:
+            update_data.pop(field, None)
+    
+    # Only write what actually changed - autosave resends the whole invoice
+    existing_plain = decimal_to_float(existing)
+    changed = {k: v for k, v in update_data.items() if existing_plain.get(k) != v}
+    if not changed:
+        return {"message": "Invoice updated successfully", "changed_fields": []}
+    
+    if changed.keys() & {"items", "discount_amount", "tax_type", "gst_percent"}:
+        merged = {**existing_plain, **changed}
+        calculated = calculate_full_invoice({
+            "items": merged.get("items") or [],
+            "discount_amount": merged.get("discount_amount", 0.0),
+            "paid_amount": merged.get("paid_amount", 0.0),
+            "tax_type": merged.get("tax_type", "cgst_sgst"),
+            "gst_percent": merged.get("gst_percent", 5.0)
+        })
+        try:
+            calculated_items = [InvoiceItem(**item).model_dump() for item in calculated["items"]]
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid item: {e}")
+        changed.pop("items", None)
+        if calculated_items != (existing_plain.get("items") or []):
+            changed["items"] = calculated_items
+        for field in INVOICE_TOTAL_FIELDS:
+            if existing_plain.get(field) != calculated[field]:
+                changed[field] = calculated[field]
+            else:
+                changed.pop(field, None)
+        if not changed:
+            return {"message": "Invoice updated successfully", "changed_fields": []}
+    
+    # Re-reserve when the stock-relevant part of the draft changes; the old
+    # reservation keeps holding stock if the new one cannot be satisfied
+    if "items" in changed or "invoice_type" in changed:
+        updated = Invoice(**decimal_to_float({**existing, **changed}))
+        shortfalls = await reserve_invoice_stock(updated, current_user.id)
+        if shortfalls:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock: {'; '.join(shortfalls)}")
+    
+    update = {"$set": changed}
+    if "items" in changed:
+        update["$inc"] = {"items_version": 1}
+    await db.invoices.update_one({"id": invoice_id}, update)
+    
+    audit_changes = dict(changed)
+    if "items" in audit_changes:
+        audit_changes["items"] = summarize_item_changes(existing_plain.get("items") or [], changed["items"] or [])
+    await create_audit_log(current_user.id, current_user.full_name, "invoice", invoice_id, "update", audit_changes)
+    return {"message": "Invoice updated successfully", "changed_fields": list(changed)}
+
+# ============================================================================
+# DRAFT INVOICE ITEM OPERATIONS (partial updates)
+# ============================================================================
+# POS autosave edits one line at a time. PATCH /invoices/{id}/items applies
+# item-level operations, recalculates the invoice with invoice_calculator and
+# writes only the lines that changed together with the totals that moved in ONE
+# guarded update, so items and totals can never disagree: changed fields via
+# $set on items.$[line] (arrayFilters), added lines via $push, removed lines
+# via $pull. MongoDB rejects $push/$pull next to positional $set on the same
+# array, so a patch that mixes kinds of line changes rewrites the whole
+# items array instead. items_version guards against two tills editing the
+# same draft at once; the audit entry records only the lines and fields that
+# changed.
+
+from invoice_calculator import calculate_full_invoice, calculate_line_item
+
+# Fields maintained by the server - never accepted from item operations
+INVOICE_TOTAL_FIELDS = [
+    "subtotal", "discount_amount", "vat_total", "grand_total", "balance_due",
+    "payment_status", "cgst_total", "sgst_total", "igst_total"
+]
+INVOICE_HEADER_EDITABLE_FIELDS = {"discount_amount", "tax_type", "gst_percent", "notes"}
+
+def summarize_item_changes(old_items: List[dict], new_items: List[dict]) -> Dict[str, Any]:
+    """Compact audit entry for an items change: ids added/removed and changed fields per item."""
+    old_by_id = {item.get('id'): item for item in old_items}
+    new_by_id = {item.get('id'): item for item in new_items}
+    updated = {}
+    for item_id, item in new_by_id.items():
+        before = old_by_id.get(item_id)
+        if before is not None:
+            fields = {k: v for k, v in item.items() if before.get(k) != v}
+            if fields:
+                updated[item_id] = fields
+    return {
+        "added": [item_id for item_id in new_by_id if item_id not in old_by_id],
+        "removed": [item_id for item_id in old_by_id if item_id not in new_by_id],
+        "updated": updated
+    }
+
+def build_items_update(new_items: List[dict], item_changes: Dict[str, Any]) -> tuple[Dict[str, Any], Optional[List[dict]]]:
+    """
+    Smallest update for the items array, given summarize_item_changes() output.
+    
+    Returns:
+        (update_operators, array_filters). Only one kind of line change is
+        written positionally; mixed changes fall back to $set of the whole array.
+    """
+    added, removed, updated = item_changes["added"], item_changes["removed"], item_changes["updated"]
+    if sum(1 for kind in (added, removed, updated) if kind) > 1:
+        return {"$set": {"items": new_items}}, None
+    if added:
+        added_ids = set(added)
+        return {"$push": {"items": {"$each": [item for item in new_items if item.get("id") in added_ids]}}}, None
+    if removed:
+        return {"$pull": {"items": {"id": {"$in": removed}}}}, None
+    set_fields = {}
+    array_filters = []
+    for index, (item_id, fields) in enumerate(updated.items()):
+        array_filters.append({f"line{index}.id": item_id})
+        for field, value in fields.items():
+            set_fields[f"items.$[line{index}].{field}"] = value
+    return {"$set": set_fields}, array_filters
+
+def items_version_filter(invoice: dict) -> dict:
+    """Optimistic-concurrency filter for the invoice's current items_version."""
+    version = invoice.get("items_version")
+    return {"items_version": version} if version is not None else {"items_version": {"$exists": False}}
+
+@api_router.patch("/invoices/{invoice_id}/items")
+async def patch_invoice_items(invoice_id: str, patch: dict, current_user: User = Depends(require_permission('invoices.create'))):
+    """
+    Apply item-level operations to a draft invoice.
+    
+    Body:
+        {
+          "operations": [
+            {"op": "add", "item": {...}},
+            {"op": "update", "item_id": "...", "fields": {...}},
+            {"op": "remove", "item_id": "..."}
+          ],
+          "fields": {"discount_amount": 0, "notes": "..."}   # optional header fields
+        }
+    
+    Line values (gold_value, vat_amount, line_total) and invoice totals are
+    recalculated server-side and written in one update; header fields are
+    limited to INVOICE_HEADER_EDITABLE_FIELDS and validated by the model.
+    """
+    existing = await db.invoices.find_one({"id": invoice_id, "is_deleted": False}, {"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    if existing.get("status") == "finalized":
+        raise HTTPException(
+            status_code=400,
+            detail="Cannot edit finalized invoice. Finalized invoices are immutable to maintain financial integrity."
+        )
+    
+    invoice = decimal_to_float(existing)
+    old_items = invoice.get("items") or []
+    items = [dict(item) for item in old_items]
+    
+    # 1. Apply operations in memory
+    for index, operation in enumerate(patch.get("operations") or []):
+        op = operation.get("op")
+        if op == "add":
+            item = dict(operation.get("item") or {})
+            item.setdefault("id", str(uuid.uuid4()))
+            item.setdefault("making_value", 0.0)
+            item.setdefault("vat_percent", invoice.get("gst_percent", 5.0))
+            items.append(item)
+        elif op in ("update", "remove"):
+            position = next((i for i, item in enumerate(items) if item.get("id") == operation.get("item_id")), None)
+            if position is None:
+                raise HTTPException(status_code=404, detail=f"Operation {index}: item {operation.get('item_id')} not found")
+            if op == "remove":
+                items.pop(position)
+            else:
+                fields = {k: v for k, v in (operation.get("fields") or {}).items() if k != "id"}
+                items[position] = {**items[position], **fields}
+        else:
+            raise HTTPException(status_code=400, detail=f"Operation {index}: unknown op '{op}'")
+    
+    unknown = set(patch.get("fields") or {}) - INVOICE_HEADER_EDITABLE_FIELDS
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Fields not editable here: {', '.join(sorted(unknown))}. Allowed: {', '.join(sorted(INVOICE_HEADER_EDITABLE_FIELDS))}"
+        )
+    # Validate (and sanitize) header values through the model before writing them
+    try:
+        validated = Invoice(**{**invoice, **(patch.get("fields") or {})}).model_dump()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid field: {e}")
+    header_fields = {k: validated[k] for k in (patch.get("fields") or {})}
     
-    await db.invoices.update_one({"id": invoice_id}, {"$set": update_data})
-    await create_audit_log(current_user.id, current_user.full_name, "invoice", invoice_id, "update", update_data)
-    return {"message": "Invoice updated successfully"}
+    # 2. Recalculate lines and totals
+    calculated = calculate_full_invoice({
+        "items": items,
+        "discount_amount": header_fields.get("discount_amount", invoice.get("discount_amount", 0.0)),
+        "paid_amount": invoice.get("paid_amount", 0.0),
+        "tax_type": header_fields.get("tax_type", invoice.get("tax_type", "cgst_sgst")),
+        "gst_percent": header_fields.get("gst_percent", invoice.get("gst_percent", 5.0))
+    })
+    try:
+        new_items = [InvoiceItem(**item).model_dump() for item in calculated["items"]]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid item: {e}")
+    if calculated["discount_amount"] < 0 or calculated["discount_amount"] > calculated["subtotal"]:
+        raise HTTPException(status_code=400, detail="Discount amount must be between 0 and the subtotal")
+    
+    # 3. Diff against the stored document
+    item_changes = summarize_item_changes(old_items, new_items)
+    set_fields = {k: v for k, v in header_fields.items() if invoice.get(k) != v}
+    for field in INVOICE_TOTAL_FIELDS:
+        if invoice.get(field) != calculated[field]:
+            set_fields[field] = calculated[field]
+    items_changed = any(item_changes.values())
+    if not items_changed and not set_fields:
+        return {"message": "No changes", "items_version": invoice.get("items_version", 0), "items": new_items}
+    
+    if items_changed or "invoice_type" in set_fields:
+        shortfalls = await reserve_invoice_stock(Invoice(**{**invoice, **set_fields, "items": new_items}), current_user.id)
+        if shortfalls:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock: {'; '.join(shortfalls)}")
+    
+    # 4. One guarded write: the changed lines plus the moved totals
+    version = invoice.get("items_version")
+    update: Dict[str, Any] = {"$set": dict(set_fields), "$inc": {"items_version": 1}}
+    array_filters = None
+    if items_changed:
+        items_update, array_filters = build_items_update(new_items, item_changes)
+        update["$set"].update(items_update.pop("$set", {}))
+        update.update(items_update)
+    if not update["$set"]:
+        del update["$set"]
+    result = await db.invoices.update_one(
+        {"id": invoice_id, "status": {"$ne": "finalized"}, **items_version_filter(invoice)},
+        update,
+        array_filters=array_filters
+    )
+    if result.matched_count == 0:
+        # Put the reservations back in line with whatever is stored now
+        current = await db.invoices.find_one({"id": invoice_id, "is_deleted": False}, {"_id": 0})
+        if current and current.get("status") != "finalized":
+            await reserve_invoice_stock(Invoice(**decimal_to_float(current)), current_user.id)
+        raise HTTPException(status_code=409, detail="Invoice was modified by another session. Reload and retry.")
+    
+    audit_changes = {k: v for k, v in item_changes.items() if v}
+    if set_fields:
+        audit_changes["fields"] = set_fields
+    await create_audit_log(current_user.id, current_user.full_name, "invoice", invoice_id, "update_items", audit_changes)
+    
+    return {
+        "message": "Invoice updated successfully",
+        "items_version": (version or 0) + 1,
+        "changes": audit_changes,
+        "items": new_items,
+        **{field: calculated[field] for field in INVOICE_TOTAL_FIELDS}
+    }
 
 
 @api_router.post("/invoices/{invoice_id}/finalize")
@@ -4933,7 +7214,7 @@ async def finalize_invoice(invoice_id: str, current_user: User = Depends(require
     Atomic operations performed:
     1. Update invoice status to "finalized"
     2. Create Stock OUT movements (ONLY for SALE invoices)
-    3. Directly reduce inventory header (ONLY for SALE invoices)
+    3. Directly reduce inventory header, consuming the draft's stock reservation (ONLY for SALE invoices)
     4. Lock linked job card (if exists)
     5. Create customer ledger entry
     6. Update customer outstanding balance
@@ -4958,6 +7239,7 @@ async def finalize_invoice(invoice_id: str, current_user: User = Depends(require
     
     # Parse invoice data
     invoice = Invoice(**decimal_to_float(existing))
+    await ensure_period_open(invoice.date, "Invoice")
 
     # BUSINESS RULE: Stock deduction only applies to SALE invoices
     # SERVICE invoices (making charges, repair, polish) may have zero weight and should skip stock validation
@@ -4978,9 +7260,10 @@ async def finalize_invoice(invoice_id: str, current_user: User = Depends(require
     # ATOMIC OPERATION: Finalize invoice with all required operations
     finalized_at = datetime.now(timezone.utc)
     
-    # Step 1: Update invoice to finalized status
-    await db.invoices.update_one(
-        {"id": invoice_id},
+    # Step 1: Claim the invoice - conditional update so two concurrent finalize
+    # calls cannot both proceed (only the first one matches status != finalized)
+    claim = await db.invoices.update_one(
+        {"id": invoice_id, "is_deleted": False, "status": {"$ne": "finalized"}},
         {
             "$set": {
                 "status": "finalized",
@@ -4989,65 +7272,16 @@ async def finalize_invoice(invoice_id: str, current_user: User = Depends(require
             }
         }
     )
+    if claim.matched_count == 0:
+        raise HTTPException(status_code=400, detail="Invoice is already finalized")
     
-    # Step 2: DIRECTLY REDUCE from inventory headers and create audit trail
+    # Step 2: Reduce inventory headers with guarded atomic $inc and record Stock OUT
     # ONLY for SALE invoices - SERVICE invoices skip stock deduction entirely
-    stock_errors = []
+    # All-or-nothing: on any shortfall no header is changed and no movement is written
     if is_sale_invoice:
-        for item in invoice.items:
-            # CRITICAL FIX: ALWAYS create Stock OUT movement for items with weight > 0
-            # This ensures complete audit trail and accurate inventory reports
-            if item.weight > 0:
-                # Determine header details for the movement
-                header_id_for_movement = None
-                header_name_for_movement = item.category or item.description or "Uncategorized"
-                
-                # Try to find matching inventory header for stock reduction
-                if item.category:
-                    header = await db.inventory_headers.find_one(
-                        {"name": item.category, "is_deleted": False}, 
-                        {"_id": 0}
-                    )
-                    
-                    if header:
-                        header_id_for_movement = header['id']
-                        header_name_for_movement = header['name']
-                        
-                        # Calculate new stock values
-                        current_qty = header.get('current_qty', 0)
-                        current_weight = header.get('current_weight', 0)
-                        new_qty = current_qty - item.qty
-                        new_weight = current_weight - item.weight
-                        
-                        # Check for insufficient stock
-                        if new_qty < 0 or new_weight < 0:
-                            stock_errors.append(
-                                f"{item.category}: Need {item.qty} qty/{item.weight}g, but only {current_qty} qty/{current_weight}g available"
-                            )
-                            # Continue to next item - don't create movement if insufficient stock
-                            continue
-                        
-                        # DIRECT UPDATE: Reduce from inventory header
-                        await db.inventory_headers.update_one(
-                            {"id": header['id']},
-                            {"$set": {"current_qty": new_qty, "current_weight": new_weight}}
-                        )
-                
-                # CRITICAL: ALWAYS create Stock OUT movement for audit trail
-                # Even if no inventory header exists, the movement must be recorded
-                movement = StockMovement(
-                    movement_type="Stock OUT",
-                    header_id=header_id_for_movement,  # May be None if no header found
-                    header_name=header_name_for_movement,
-                    description=f"Invoice {invoice.invoice_number} - Finalized",
-                    qty_delta=-item.qty,
-                    weight_delta=-item.weight,
-                    purity=item.purity,
-                    reference_type="invoice",
-                    reference_id=invoice.id,
-                    created_by=current_user.id
-                )
-                await db.stock_movements.insert_one(movement.model_dump())
+        stock_errors = await deduct_invoice_stock(
+            invoice, f"Invoice {invoice.invoice_number} - Finalized", current_user.id
+        )
         
         # If there were stock errors, rollback the invoice finalization
         # CRITICAL: Status rollback must NOT delete timestamps (audit safety)
@@ -5115,6 +7349,333 @@ async def finalize_invoice(invoice_id: str, current_user: User = Depends(require
     updated_invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
     return decimal_to_float(updated_invoice)
 
+# ============================================================================
+# BATCH FINALIZATION (end of day)
+# ============================================================================
+# Same rules as POST /invoices/{id}/finalize, but the work is batched: one read
+# for all invoices, stock demand aggregated per header and applied with a
+# single bulk_write of guarded $inc updates, one insert_many for all Stock OUT
+# movements and one for the audit logs.
+
+FINALIZE_BATCH_MODES = ("all_or_nothing", "best_effort")
+FINALIZE_BATCH_MAX_INVOICES = 200
+
+@api_router.post("/invoices/finalize-batch")
+async def finalize_invoices_batch(payload: dict, current_user: User = Depends(require_permission('invoices.finalize'))):
+    """
+    Finalize several draft invoices at once.
+    
+    Body: {"invoice_ids": [...], "mode": "all_or_nothing" (default) | "best_effort"}
+    
+    - all_or_nothing: any invalid invoice or stock shortfall fails the whole
+      batch (400) and nothing is changed
+    - best_effort: invoices that cannot be finalized are reported as failed,
+      the rest are finalized
+    
+    Returns per-invoice results in request order.
+    """
+    invoice_ids = list(dict.fromkeys(payload.get('invoice_ids') or []))
+    mode = payload.get('mode', 'all_or_nothing')
+    if mode not in FINALIZE_BATCH_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mode '{mode}'. Must be one of: {', '.join(FINALIZE_BATCH_MODES)}")
+    if not invoice_ids:
+        raise HTTPException(status_code=400, detail="invoice_ids is required")
+    if len(invoice_ids) > FINALIZE_BATCH_MAX_INVOICES:
+        raise HTTPException(status_code=400, detail=f"At most {FINALIZE_BATCH_MAX_INVOICES} invoices per batch")
+    all_or_nothing = mode == "all_or_nothing"
+    
+    results: Dict[str, Dict[str, Any]] = {}
+    
+    def fail(invoice_id: str, error: str):
+        results[invoice_id] = {"invoice_id": invoice_id, "status": "failed", "error": error}
+    
+    def batch_response(status_code: int = 200):
+        ordered = [results.get(i, {"invoice_id": i, "status": "skipped"}) for i in invoice_ids]
+        summary = {
+            "mode": mode,
+            "finalized": sum(1 for r in ordered if r["status"] == "finalized"),
+            "failed": sum(1 for r in ordered if r["status"] == "failed"),
+            "results": ordered
+        }
+        if status_code != 200:
+            raise HTTPException(status_code=status_code, detail=summary)
+        return summary
+    
+    # Step 1: Validate all drafts up front (single read)
+    closed = await get_closed_through()
+    docs = await db.invoices.find({"id": {"$in": invoice_ids}, "is_deleted": False}, {"_id": 0}).to_list(None)
+    by_id = {doc['id']: doc for doc in docs}
+    invoices: Dict[str, Invoice] = {}
+    for invoice_id in invoice_ids:
+        doc = by_id.get(invoice_id)
+        if not doc:
+            fail(invoice_id, "Invoice not found")
+            continue
+        if doc.get("status", "draft") == "finalized":
+            fail(invoice_id, "Invoice is already finalized")
+            continue
+        invoice = Invoice(**decimal_to_float(doc))
+        if closed and as_utc(invoice.date) <= as_utc(closed['period_end']):
+            fail(invoice_id, f"Invoice is dated in closed period {closed['period']}")
+            continue
+        if invoice.invoice_type == "sale":
+            total_weight = sum(item.weight * item.qty for item in invoice.items)
+            if total_weight <= 0:
+                fail(invoice_id, f"Cannot finalize sale invoice with total weight {round(total_weight, 3)}g")
+                continue
+        invoices[invoice_id] = invoice
+    if all_or_nothing and len(invoices) < len(invoice_ids):
+        return batch_response(400)
+    
+    # Step 2: Aggregate stock demand per header and allocate it in request order
+    # against available-to-sell (stock minus reservations held by other drafts)
+    lines_by_invoice = {
+        invoice_id: (await invoice_stock_lines(invoice) if invoice.invoice_type == "sale" else [])
+        for invoice_id, invoice in invoices.items()
+    }
+    header_ids = list({line['header_id'] for lines in lines_by_invoice.values() for line in lines if line['header_id']})
+    own_reservations = await db.stock_reservations.find(
+        {"invoice_id": {"$in": list(invoices)}}, {"_id": 0, "id": 1}
+    ).to_list(None)
+    reserved = await get_reserved_totals(header_ids, exclude_ids=[r['id'] for r in own_reservations])
+    headers = await db.inventory_headers.find(
+        {"id": {"$in": header_ids}}, {"_id": 0, "id": 1, "current_qty": 1, "current_weight": 1}
+    ).to_list(None)
+    available = {
+        h['id']: {
+            "qty": h.get('current_qty', 0) - reserved.get(h['id'], {}).get('qty', 0),
+            "weight": h.get('current_weight', 0) - reserved.get(h['id'], {}).get('weight', 0)
+        }
+        for h in headers
+    }
+    
+    demand: Dict[str, Dict[str, float]] = {}
+    accepted = []
+    for invoice_id in invoices:
+        need: Dict[str, Dict[str, Any]] = {}
+        for line in lines_by_invoice[invoice_id]:
+            if line['header_id']:
+                entry = need.setdefault(line['header_id'], {"label": line['label'], "qty": 0, "weight": 0.0})
+                entry['qty'] += line['qty']
+                entry['weight'] += line['weight']
+        shortfalls = []
+        for header_id, entry in need.items():
+            free = available.get(header_id, {"qty": 0, "weight": 0})
+            used = demand.get(header_id, {"qty": 0, "weight": 0.0})
+            if (used['qty'] + entry['qty'] > free['qty'] + STOCK_RESERVATION_EPSILON
+                    or used['weight'] + entry['weight'] > free['weight'] + STOCK_RESERVATION_EPSILON):
+                shortfalls.append(
+                    f"{entry['label']}: Need {entry['qty']} qty/{round(entry['weight'], 3)}g, "
+                    f"but only {free['qty'] - used['qty']} qty/{round(free['weight'] - used['weight'], 3)}g available"
+                )
+        if shortfalls:
+            fail(invoice_id, f"Insufficient stock: {'; '.join(shortfalls)}")
+            continue
+        for header_id, entry in need.items():
+            used = demand.setdefault(header_id, {"qty": 0, "weight": 0.0})
+            used['qty'] += entry['qty']
+            used['weight'] = round(used['weight'] + entry['weight'], 3)
+        accepted.append(invoice_id)
+    if all_or_nothing and len(accepted) < len(invoices):
+        return batch_response(400)
+    if not accepted:
+        return batch_response()
+    
+    # Step 2b: Reserve the accepted demand (insert-then-verify, as in
+    # reserve_invoice_stock) so a draft reserving in the meantime cannot be
+    # promised stock this batch is about to consume
+    batch_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(minutes=STOCK_RESERVATION_TTL_MINUTES)
+    batch_reservations = [{
+        "id": str(uuid.uuid4()),
+        "invoice_id": invoice_id,
+        "invoice_number": invoices[invoice_id].invoice_number,
+        "header_id": header_id,
+        "header_name": entry['header_name'],
+        "qty": entry['qty'],
+        "weight": entry['weight'],
+        "expires_at": expires_at,
+        "created_at": now,
+        "created_by": current_user.id,
+        "finalize_batch_id": batch_id
+    } for invoice_id in accepted for header_id, entry in merge_reservation_lines(
+        [line for line in lines_by_invoice[invoice_id] if line['header_id']]
+    ).items()]
+    
+    async def release_batch_reservations(ids):
+        if ids:
+            await db.stock_reservations.delete_many({"invoice_id": {"$in": list(ids)}, "finalize_batch_id": batch_id})
+    
+    if batch_reservations:
+        await db.stock_reservations.insert_many(batch_reservations)
+        reserved = await get_reserved_totals(list(demand), exclude_ids=[r['id'] for r in own_reservations])
+        headers = await db.inventory_headers.find(
+            {"id": {"$in": list(demand)}}, {"_id": 0, "id": 1, "current_qty": 1, "current_weight": 1}
+        ).to_list(None)
+        over_reserved = {
+            h['id'] for h in headers
+            if reserved.get(h['id'], {}).get('qty', 0) > h.get('current_qty', 0) + STOCK_RESERVATION_EPSILON
+            or reserved.get(h['id'], {}).get('weight', 0) > h.get('current_weight', 0) + STOCK_RESERVATION_EPSILON
+        } | (set(demand) - {h['id'] for h in headers})
+        if over_reserved:
+            losing = [
+                invoice_id for invoice_id in accepted
+                if any(line['header_id'] in over_reserved for line in lines_by_invoice[invoice_id])
+            ]
+            if all_or_nothing:
+                losing = accepted
+            await release_batch_reservations(losing)
+            for invoice_id in losing:
+                fail(invoice_id, "Insufficient stock: reserved by another draft while finalizing, please retry")
+            accepted = [invoice_id for invoice_id in accepted if invoice_id not in losing]
+            if all_or_nothing or not accepted:
+                return batch_response(400 if all_or_nothing else 200)
+    
+    # Step 3: Claim the invoices (conditional, so concurrent finalize calls lose)
+    finalized_at = datetime.now(timezone.utc)
+    await db.invoices.update_many(
+        {"id": {"$in": accepted}, "is_deleted": False, "status": {"$ne": "finalized"}},
+        {"$set": {"status": "finalized", "finalized_at": finalized_at, "finalized_by": current_user.id, "finalize_batch_id": batch_id}}
+    )
+    claimed = {doc['id'] for doc in await db.invoices.find(
+        {"id": {"$in": accepted}, "finalize_batch_id": batch_id}, {"_id": 0, "id": 1}
+    ).to_list(None)}
+    
+    async def unclaim(ids):
+        if ids:
+            await db.invoices.update_many(
+                {"id": {"$in": list(ids)}, "finalize_batch_id": batch_id},
+                {"$set": {"status": "draft", "finalized_by": None}, "$unset": {"finalize_batch_id": ""}}
+            )
+    
+    for invoice_id in accepted:
+        if invoice_id not in claimed:
+            fail(invoice_id, "Invoice is already finalized")
+    await release_batch_reservations(set(accepted) - claimed)
+    
+    # Step 4: Tagged pieces
+    tags_by_invoice = {i: [item.tag for item in invoices[i].items if item.tag] for i in claimed}
+    for invoice_id in list(claimed):
+        shortfalls = await mark_stock_items_sold(tags_by_invoice[invoice_id], invoice_id)
+        if shortfalls:
+            fail(invoice_id, "; ".join(shortfalls))
+            claimed.discard(invoice_id)
+            await unclaim([invoice_id])
+            await release_batch_reservations([invoice_id])
+    
+    async def abort():
+        for invoice_id in claimed:
+            await release_stock_items(tags_by_invoice[invoice_id], invoice_id)
+        await unclaim(claimed)
+        await release_batch_reservations(claimed)
+        for invoice_id in claimed:
+            results.setdefault(invoice_id, {"invoice_id": invoice_id, "status": "failed", "error": "Batch rolled back"})
+        return batch_response(400)
+    
+    if all_or_nothing and len(claimed) < len(accepted):
+        return await abort()
+    
+    # Step 5: One bulk_write of guarded decrements for the aggregated demand
+    demand = {}
+    for invoice_id in claimed:
+        for line in lines_by_invoice[invoice_id]:
+            if line['header_id']:
+                used = demand.setdefault(line['header_id'], {"qty": 0, "weight": 0.0})
+                used['qty'] += line['qty']
+                used['weight'] = round(used['weight'] + line['weight'], 3)
+    fallback = False
+    if demand:
+        result = await db.inventory_headers.bulk_write([
+            UpdateOne(
+                {"id": header_id, "current_qty": {"$gte": used['qty']}, "current_weight": {"$gte": used['weight']}},
+                {"$inc": {"current_qty": -used['qty'], "current_weight": -used['weight']}, "$set": {"last_stock_batch_id": batch_id, **stock_stamp()}}
+            )
+            for header_id, used in demand.items()
+        ], ordered=False)
+        if result.matched_count < len(demand):
+            # Stock moved since step 2 - undo the decrements that did apply
+            applied = await db.inventory_headers.find(
+                {"id": {"$in": list(demand)}, "last_stock_batch_id": batch_id}, {"_id": 0, "id": 1}
+            ).to_list(None)
+            if applied:
+                await db.inventory_headers.bulk_write([
+                    UpdateOne({"id": h['id']}, {"$inc": {"current_qty": demand[h['id']]['qty'], "current_weight": demand[h['id']]['weight']}, "$set": stock_stamp()})
+                    for h in applied
+                ], ordered=False)
+            if all_or_nothing:
+                return await abort()
+            fallback = True
+    
+    if fallback:
+        # Best effort: finalize the remaining invoices one by one (guarded per invoice)
+        for invoice_id in list(claimed):
+            invoice = invoices[invoice_id]
+            if invoice.invoice_type != "sale":
+                continue
+            await release_stock_items(tags_by_invoice[invoice_id], invoice_id)
+            stock_errors = await deduct_invoice_stock(invoice, f"Invoice {invoice.invoice_number} - Finalized", current_user.id)
+            if stock_errors:
+                fail(invoice_id, f"Insufficient stock: {'; '.join(stock_errors)}")
+                claimed.discard(invoice_id)
+                await unclaim([invoice_id])
+                await release_batch_reservations([invoice_id])
+    else:
+        # Step 6: All Stock OUT movements in one insert_many, reservations consumed
+        movements = [
+            StockMovement(
+                movement_type="Stock OUT",
+                header_id=line['header_id'],  # May be None if no header found
+                header_name=line['header_name'],
+                description=f"Invoice {invoices[invoice_id].invoice_number} - Finalized",
+                qty_delta=-line['qty'],
+                weight_delta=-line['weight'],
+                purity=line['item'].purity,
+                reference_type="invoice",
+                reference_id=invoice_id,
+                created_by=current_user.id
+            ).model_dump()
+            for invoice_id in claimed
+            for line in lines_by_invoice[invoice_id]
+        ]
+        if movements:
+            await db.stock_movements.insert_many(movements)
+        await db.stock_reservations.delete_many({"invoice_id": {"$in": list(claimed)}})
+    
+    # Step 7: Lock linked job cards and write all audit logs in one insert
+    jobcard_ids = [invoices[i].jobcard_id for i in claimed if invoices[i].jobcard_id]
+    if jobcard_ids:
+        await db.jobcards.update_many(
+            {"id": {"$in": jobcard_ids}, "is_deleted": False},
+            {"$set": {"status": "invoiced", "locked": True, "locked_at": finalized_at, "locked_by": current_user.id}}
+        )
+    audit_logs = [AuditLog(
+        user_id=current_user.id, user_name=current_user.full_name, module="invoice", record_id=invoice_id,
+        action="finalize",
+        changes={
+            "status": "finalized",
+            "finalized_at": finalized_at.isoformat(),
+            "jobcard_locked": bool(invoices[invoice_id].jobcard_id),
+            "finalize_batch_id": batch_id
+        }
+    ).model_dump() for invoice_id in claimed]
+    audit_logs += [AuditLog(
+        user_id=current_user.id, user_name=current_user.full_name, module="jobcard", record_id=jobcard_id,
+        action="lock", changes={"locked": True, "reason": "Invoice finalized (batch)", "finalize_batch_id": batch_id}
+    ).model_dump() for jobcard_id in jobcard_ids]
+    if audit_logs:
+        await db.audit_logs.insert_many(audit_logs)
+    
+    for invoice_id in claimed:
+        results[invoice_id] = {
+            "invoice_id": invoice_id,
+            "invoice_number": invoices[invoice_id].invoice_number,
+            "status": "finalized"
+        }
+    response = batch_response()
+    response["batch_id"] = batch_id
+    return response
+
 @api_router.post("/invoices/{invoice_id}/add-payment")
 async def add_payment_to_invoice(
     invoice_id: str, 
@@ -5270,6 +7831,7 @@ async def add_payment_to_invoice(
                 "is_deleted": False
             }
             await db.accounts.insert_one(account)
+            account_ref_cache.invalidate()
         
         account_id = account['id']
         account_name = account['name']
@@ -5375,48 +7937,12 @@ async def add_payment_to_invoice(
             gold_stock_errors = []
             
             if is_sale_invoice:
-                for item in invoice.items:
-                    if item.weight > 0 and item.category:
-                        # Find the inventory header by category name
-                        header = await db.inventory_headers.find_one(
-                            {"name": item.category, "is_deleted": False}, 
-                            {"_id": 0}
-                        )
-                        
-                        if header:
-                            # Calculate new stock values
-                            current_qty = header.get('current_qty', 0)
-                            current_weight = header.get('current_weight', 0)
-                            new_qty = current_qty - item.qty
-                            new_weight = current_weight - item.weight
-                            
-                            # Check for insufficient stock
-                            if new_qty < 0 or new_weight < 0:
-                                gold_stock_errors.append(
-                                    f"{item.category}: Need {item.qty} qty/{item.weight}g, but only {current_qty} qty/{current_weight}g available"
-                                )
-                                continue
-                            
-                            # DIRECT UPDATE: Reduce from inventory header
-                            await db.inventory_headers.update_one(
-                                {"id": header['id']},
-                                {"$set": {"current_qty": new_qty, "current_weight": new_weight}}
-                            )
-                            
-                            # Create stock movement for audit trail
-                            movement = StockMovement(
-                                movement_type="Stock OUT",
-                                header_id=header['id'],
-                                header_name=header['name'],
-                                description=f"Invoice {invoice.invoice_number} - Auto-finalized (Gold Exchange Payment)",
-                                qty_delta=-item.qty,
-                                weight_delta=-item.weight,
-                                purity=item.purity,
-                                reference_type="invoice",
-                                reference_id=invoice.id,
-                                created_by=current_user.id
-                            )
-                            await db.stock_movements.insert_one(movement.model_dump())
+                gold_stock_errors = await deduct_invoice_stock(
+                    invoice,
+                    f"Invoice {invoice.invoice_number} - Auto-finalized (Gold Exchange Payment)",
+                    current_user.id,
+                    record_unmatched=False
+                )
             
             # If stock errors occurred, rollback finalization but keep payment
             if gold_stock_errors:
@@ -5634,6 +8160,7 @@ async def add_payment_to_invoice(
                 "is_deleted": False
             }
             await db.accounts.insert_one(sales_account)
+            account_ref_cache.invalidate()
         
         credit_transaction = Transaction(
             transaction_number=credit_txn_number,
@@ -5713,48 +8240,12 @@ async def add_payment_to_invoice(
             stock_errors = []
             
             if is_sale_invoice:
-                for item in invoice.items:
-                    if item.weight > 0 and item.category:
-                        # Find the inventory header by category name
-                        header = await db.inventory_headers.find_one(
-                            {"name": item.category, "is_deleted": False}, 
-                            {"_id": 0}
-                        )
-                        
-                        if header:
-                            # Calculate new stock values
-                            current_qty = header.get('current_qty', 0)
-                            current_weight = header.get('current_weight', 0)
-                            new_qty = current_qty - item.qty
-                            new_weight = current_weight - item.weight
-                            
-                            # Check for insufficient stock
-                            if new_qty < 0 or new_weight < 0:
-                                stock_errors.append(
-                                    f"{item.category}: Need {item.qty} qty/{item.weight}g, but only {current_qty} qty/{current_weight}g available"
-                                )
-                                continue
-                            
-                            # DIRECT UPDATE: Reduce from inventory header
-                            await db.inventory_headers.update_one(
-                                {"id": header['id']},
-                                {"$set": {"current_qty": new_qty, "current_weight": new_weight}}
-                            )
-                            
-                            # Create stock movement for audit trail
-                            movement = StockMovement(
-                                movement_type="Stock OUT",
-                                header_id=header['id'],
-                                header_name=header['name'],
-                                description=f"Invoice {invoice.invoice_number} - Auto-finalized (Payment)",
-                                qty_delta=-item.qty,
-                                weight_delta=-item.weight,
-                                purity=item.purity,
-                                reference_type="invoice",
-                                reference_id=invoice.id,
-                                created_by=current_user.id
-                            )
-                            await db.stock_movements.insert_one(movement.model_dump())
+                stock_errors = await deduct_invoice_stock(
+                    invoice,
+                    f"Invoice {invoice.invoice_number} - Auto-finalized (Payment)",
+                    current_user.id,
+                    record_unmatched=False
+                )
             
             # If stock errors occurred, rollback finalization but keep payment
             if stock_errors:
@@ -5874,6 +8365,837 @@ async def add_payment_to_invoice(
         }
 
 
+# ============================================================================
+# SPLIT-TENDER PAYMENTS
+# ============================================================================
+# One call pays an invoice with several tenders (e.g. cash + card + old gold).
+# Each tender is booked exactly like a single add-payment call - standard
+# modes debit the chosen account and credit Sales Income, GOLD_EXCHANGE
+# writes a gold ledger OUT entry and credits Gold Exchange Income - but the
+# invoice is read and parsed once, validated once against balance_due, claimed
+# with one guarded update, and everything else is written in batches.
+
+SPLIT_TENDER_MAX_PAYMENTS = 10
+
+async def get_or_create_income_account(name: str, user_id: str) -> dict:
+    """Income account by name (Sales Income, Gold Exchange Income), created on first use."""
+    account = await account_ref_cache.get_by_name(name)
+    if account:
+        return account
+    account = await db.accounts.find_one({"name": name, "is_deleted": False}, {"_id": 0})
+    if not account:
+        account = {
+            "id": str(uuid.uuid4()),
+            "name": name,
+            "account_type": "income",
+            "opening_balance": 0,
+            "current_balance": 0,
+            "created_at": datetime.now(timezone.utc),
+            "created_by": user_id,
+            "is_deleted": False
+        }
+        await db.accounts.insert_one(dict(account))
+        account_ref_cache.invalidate()
+    return account
+
+async def get_party_gold_balance(party_id: str) -> float:
+    """Party gold balance in grams (IN - OUT over the gold ledger)."""
+    summary = await db.gold_ledger.aggregate([
+        {"$match": {"party_id": party_id, "is_deleted": False}},
+        {"$group": {
+            "_id": None,
+            "gold_in": {"$sum": {"$cond": [{"$eq": ["$type", "IN"]}, "$weight_grams", 0]}},
+            "gold_out": {"$sum": {"$cond": [{"$eq": ["$type", "OUT"]}, "$weight_grams", 0]}}
+        }}
+    ]).to_list(length=1)
+    if not summary:
+        return 0
+    return round(summary[0].get("gold_in", 0) - summary[0].get("gold_out", 0), 3)
+
+def restore_fields_update(doc: dict, fields) -> Dict[str, Any]:
+    """Update that puts `fields` back as they were in `doc` (fields it lacked are removed)."""
+    update: Dict[str, Any] = {}
+    for field in fields:
+        if field in doc:
+            update.setdefault("$set", {})[field] = doc[field]
+        else:
+            update.setdefault("$unset", {})[field] = ""
+    return update
+
+async def apply_account_increments(increments: Dict[str, float]):
+    """
+    $inc account balances in one ordered bulk_write. If it stops part-way, the
+    increments that were applied (those before the failing write) are reversed
+    before the error is re-raised, so callers only undo their own documents.
+    
+    Args:
+        increments: {account_id: balance delta}
+    """
+    changes = [(account_id, round(delta, 3)) for account_id, delta in increments.items() if round(delta, 3)]
+    if not changes:
+        return
+    try:
+        await db.accounts.bulk_write([
+            UpdateOne({"id": account_id}, {"$inc": {"current_balance": delta}})
+            for account_id, delta in changes
+        ], ordered=True)
+    except BulkWriteError as e:
+        write_errors = e.details.get('writeErrors') or []
+        applied = write_errors[0]['index'] if write_errors else len(changes)
+        if applied:
+            await db.accounts.bulk_write([
+                UpdateOne({"id": account_id}, {"$inc": {"current_balance": -delta}})
+                for account_id, delta in changes[:applied]
+            ], ordered=True)
+        raise
+
+@api_router.post("/invoices/{invoice_id}/add-payments")
+async def add_payments_to_invoice(
+    invoice_id: str,
+    payment_data: dict,
+    current_user: User = Depends(require_permission('invoices.create'))
+):
+    """
+    Add several payments (split tender) to an invoice in one call.
+    
+    Body:
+        {
+            "payments": [
+                {"payment_mode": "Cash", "amount": 100, "account_id": "...", "notes": "..."},
+                {"payment_mode": "Card", "amount": 50, "account_id": "..."},
+                {"payment_mode": "GOLD_EXCHANGE", "gold_weight_grams": 2.5, "rate_per_gram": 24, "purity_entered": 916}
+            ],
+            "notes": "applies to every tender (optional)"
+        }
+    
+    Tender rules are the same as POST /invoices/{id}/add-payment. All tenders
+    are validated together (total against balance_due, total gold weight
+    against the customer's gold balance); if any tender is invalid nothing is
+    written. A fully paid draft is auto-finalized exactly as with add-payment.
+    """
+    tenders = payment_data.get('payments') or []
+    if not tenders:
+        raise HTTPException(status_code=400, detail="At least one payment is required")
+    if len(tenders) > SPLIT_TENDER_MAX_PAYMENTS:
+        raise HTTPException(status_code=400, detail=f"At most {SPLIT_TENDER_MAX_PAYMENTS} payments per call")
+    
+    existing = await db.invoices.find_one({"id": invoice_id, "is_deleted": False}, {"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    invoice = Invoice(**decimal_to_float(existing))
+    common_notes = payment_data.get('notes', '')
+    
+    # Step 1: Validate every tender before anything is written
+    parsed = []
+    for index, tender in enumerate(tenders, start=1):
+        payment_mode = tender.get('payment_mode')
+        if not payment_mode:
+            raise HTTPException(status_code=400, detail=f"Payment {index}: payment mode is required")
+        notes = f"{tender.get('notes', '')} {common_notes}".strip()
+        if payment_mode == "GOLD_EXCHANGE":
+            if invoice.customer_type != "saved" or not invoice.customer_id:
+                raise HTTPException(status_code=400, detail="GOLD_EXCHANGE payment mode is only available for saved customers (not walk-in)")
+            gold_weight_grams = tender.get('gold_weight_grams')
+            rate_per_gram = tender.get('rate_per_gram')
+            if not gold_weight_grams or gold_weight_grams <= 0:
+                raise HTTPException(status_code=400, detail=f"Payment {index}: gold_weight_grams must be greater than 0 for GOLD_EXCHANGE mode")
+            if not rate_per_gram or rate_per_gram <= 0:
+                raise HTTPException(status_code=400, detail=f"Payment {index}: rate_per_gram must be greater than 0 for GOLD_EXCHANGE mode")
+            gold_weight_grams = round(float(gold_weight_grams), 3)
+            rate_per_gram = round(float(rate_per_gram), 2)
+            parsed.append({
+                "payment_mode": payment_mode,
+                "amount": round(gold_weight_grams * rate_per_gram, 2),
+                "gold_weight_grams": gold_weight_grams,
+                "rate_per_gram": rate_per_gram,
+                "purity_entered": tender.get('purity_entered', 916),
+                "notes": notes
+            })
+        else:
+            if not tender.get('amount') or tender['amount'] <= 0:
+                raise HTTPException(status_code=400, detail=f"Payment {index}: amount must be greater than 0")
+            if not tender.get('account_id'):
+                raise HTTPException(status_code=400, detail=f"Payment {index}: account ID is required")
+            parsed.append({
+                "payment_mode": payment_mode,
+                "amount": float(tender['amount']),
+                "account_id": tender['account_id'],
+                "notes": notes
+            })
+    
+    total_amount = round(sum(t['amount'] for t in parsed), 3)
+    new_paid_amount = invoice.paid_amount + total_amount
+    new_balance_due = invoice.grand_total - new_paid_amount
+    if new_balance_due < -0.01:  # Allow small rounding errors
+        raise HTTPException(
+            status_code=400,
+            detail=f"Total of payments ({total_amount:.3f}) exceeds remaining balance ({invoice.balance_due:.3f})"
+        )
+    
+    gold_tenders = [t for t in parsed if t['payment_mode'] == "GOLD_EXCHANGE"]
+    gold_requested = round(sum(t['gold_weight_grams'] for t in gold_tenders), 3)
+    gold_balance = None
+    if gold_tenders:
+        gold_balance = await get_party_gold_balance(invoice.customer_id)
+        if gold_balance < gold_requested:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient gold balance. Customer has {gold_balance:.3f}g available, but {gold_requested:.3f}g requested for payment"
+            )
+    
+    account_ids = list({t['account_id'] for t in parsed if 'account_id' in t})
+    accounts = {a['id']: a for a in await db.accounts.find(
+        {"id": {"$in": account_ids}, "is_deleted": False}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(None)}
+    missing = [account_id for account_id in account_ids if account_id not in accounts]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Account with ID {missing[0]} not found")
+    if len(gold_tenders) < len(parsed):
+        sales_account = await get_or_create_income_account("Sales Income", current_user.id)
+    if gold_tenders:
+        gold_income_account = await get_or_create_income_account("Gold Exchange Income", current_user.id)
+    
+    # Step 2: Claim the invoice with one guarded update. The paid_amount guard
+    # makes a concurrent payment on the same invoice fail here instead of
+    # overpaying it; the caller can simply retry.
+    now = datetime.now(timezone.utc)
+    new_payment_status = "paid" if new_balance_due < 0.01 else "partial"
+    update_data = {
+        "paid_amount": new_paid_amount,
+        "balance_due": max(0, new_balance_due),
+        "payment_status": new_payment_status
+    }
+    if new_payment_status == "paid" and not existing.get("paid_at"):
+        update_data["paid_at"] = now
+    auto_finalize = new_payment_status == "paid" and existing.get("status", "draft") == "draft"
+    if auto_finalize:
+        update_data.update({"status": "finalized", "finalized_at": now, "finalized_by": current_user.id})
+    
+    paid_guard = existing["paid_amount"] if "paid_amount" in existing else {"$exists": False}
+    claim = await db.invoices.update_one(
+        {"id": invoice_id, "is_deleted": False, "paid_amount": paid_guard},
+        {"$set": update_data}
+    )
+    if claim.matched_count == 0:
+        raise HTTPException(status_code=409, detail="Invoice was updated by another payment. Please retry.")
+    
+    # Step 3: Build all ledger documents, numbered from one count
+    if invoice.customer_type == "saved":
+        party_id = invoice.customer_id
+        party_name = invoice.customer_name or "Unknown Customer"
+    else:
+        party_id = None
+        party_name = f"{invoice.walk_in_name or 'Walk-in Customer'} (Walk-in)"
+    year = now.year
+    count = await db.transactions.count_documents({"transaction_number": {"$regex": f"^TXN-{year}"}})
+    
+    def next_txn_number() -> str:
+        nonlocal count
+        count += 1
+        return f"TXN-{year}-{str(count).zfill(4)}"
+    
+    transactions: List[Transaction] = []
+    gold_entries: List[GoldLedgerEntry] = []
+    account_increments: Dict[str, float] = {}
+    results = []
+    for tender in parsed:
+        amount = tender['amount']
+        if tender['payment_mode'] == "GOLD_EXCHANGE":
+            entry = GoldLedgerEntry(
+                party_id=invoice.customer_id,
+                type="OUT",  # Party uses their gold with the shop
+                weight_grams=tender['gold_weight_grams'],
+                purity_entered=tender['purity_entered'],
+                purpose="exchange",
+                reference_type="invoice",
+                reference_id=invoice_id,
+                notes=f"Gold exchange payment for invoice {invoice.invoice_number}. Rate: {tender['rate_per_gram']:.2f} OMR/g",
+                created_by=current_user.id
+            )
+            credit = Transaction(
+                transaction_number=next_txn_number(),
+                transaction_type="credit",  # Credit increases income
+                mode="GOLD_EXCHANGE",
+                account_id=gold_income_account['id'],
+                account_name=gold_income_account['name'],
+                party_id=party_id,
+                party_name=party_name,
+                amount=amount,
+                category="Invoice Payment - Gold Exchange Income (Credit)",
+                notes=f"Gold exchange revenue for {invoice.invoice_number}. {tender['gold_weight_grams']:.3f}g @ {tender['rate_per_gram']:.2f} OMR/g = {amount:.2f} OMR. {tender['notes']}".strip(),
+                reference_type="invoice",
+                reference_id=invoice_id,
+                created_by=current_user.id
+            )
+            gold_entries.append(entry)
+            transactions.append(credit)
+            account_increments[gold_income_account['id']] = account_increments.get(gold_income_account['id'], 0) + amount
+            results.append({
+                "payment_mode": "GOLD_EXCHANGE",
+                "amount": amount,
+                "gold_weight_grams": tender['gold_weight_grams'],
+                "rate_per_gram": tender['rate_per_gram'],
+                "gold_ledger_entry_id": entry.id,
+                "credit_transaction_id": credit.id,
+                "credit_transaction_number": credit.transaction_number
+            })
+        else:
+            debit = Transaction(
+                transaction_number=next_txn_number(),
+                transaction_type="debit",  # Debit increases asset
+                mode=tender['payment_mode'],
+                account_id=tender['account_id'],
+                account_name=accounts[tender['account_id']]['name'],
+                party_id=party_id,
+                party_name=party_name,
+                amount=amount,
+                category="Invoice Payment - Cash/Bank (Debit)",
+                notes=f"Payment for {invoice.invoice_number}. {tender['notes']}".strip(),
+                reference_type="invoice",
+                reference_id=invoice_id,
+                created_by=current_user.id
+            )
+            credit = Transaction(
+                transaction_number=next_txn_number(),
+                transaction_type="credit",  # Credit increases income
+                mode=tender['payment_mode'],
+                account_id=sales_account['id'],
+                account_name=sales_account['name'],
+                party_id=party_id,
+                party_name=party_name,
+                amount=amount,
+                category="Invoice Payment - Sales Income (Credit)",
+                notes=f"Revenue for {invoice.invoice_number}. {tender['notes']}".strip(),
+                reference_type="invoice",
+                reference_id=invoice_id,
+                created_by=current_user.id
+            )
+            transactions.extend([debit, credit])
+            for account_id in (tender['account_id'], sales_account['id']):
+                account_increments[account_id] = account_increments.get(account_id, 0) + amount
+            results.append({
+                "payment_mode": tender['payment_mode'],
+                "amount": amount,
+                "account_id": tender['account_id'],
+                "debit_transaction_id": debit.id,
+                "credit_transaction_id": credit.id,
+                "debit_transaction_number": debit.transaction_number,
+                "credit_transaction_number": credit.transaction_number
+            })
+    
+    # Step 4: Batched writes. If any of them fails, the claim and whatever
+    # was written are undone so the invoice never shows an unbooked payment.
+    try:
+        if gold_entries:
+            await db.gold_ledger.insert_many([entry.model_dump() for entry in gold_entries])
+        await db.transactions.insert_many([txn.model_dump() for txn in transactions])
+        await apply_account_increments(account_increments)
+    except Exception as e:
+        # apply_account_increments has already reversed any partial $inc
+        logger.error(f"Split-tender payment on invoice {invoice_id} failed, rolling back: {str(e)}")
+        await db.transactions.delete_many({"id": {"$in": [txn.id for txn in transactions]}})
+        await db.gold_ledger.delete_many({"id": {"$in": [entry.id for entry in gold_entries]}})
+        await db.invoices.update_one({"id": invoice_id}, restore_fields_update(existing, update_data))
+        raise HTTPException(status_code=500, detail="Failed to record payments. No payment was applied.")
+    
+    # Step 5: Auto-finalize a fully paid draft (stock + job card), as add-payment does
+    audit_logs = []
+    if auto_finalize:
+        stock_errors = []
+        if invoice.invoice_type == "sale":
+            stock_errors = await deduct_invoice_stock(
+                invoice,
+                f"Invoice {invoice.invoice_number} - Auto-finalized (Payment)",
+                current_user.id,
+                record_unmatched=False
+            )
+        if stock_errors:
+            # Keep the payments, revert only the finalization
+            auto_finalize = False
+            await db.invoices.update_one(
+                {"id": invoice_id},
+                {"$set": {"status": "draft"}, "$unset": {"finalized_at": "", "finalized_by": ""}}
+            )
+            audit_logs.append(AuditLog(
+                user_id=current_user.id, user_name=current_user.full_name, module="invoice", record_id=invoice_id,
+                action="auto_finalize_failed",
+                changes={"reason": "insufficient_stock", "errors": stock_errors, "payment_applied": True}
+            ))
+        else:
+            if invoice.jobcard_id:
+                locked = await db.jobcards.update_one(
+                    {"id": invoice.jobcard_id, "is_deleted": False},
+                    {"$set": {"status": "invoiced", "locked": True, "locked_at": now, "locked_by": current_user.id}}
+                )
+                if locked.matched_count:
+                    audit_logs.append(AuditLog(
+                        user_id=current_user.id, user_name=current_user.full_name, module="jobcard", record_id=invoice.jobcard_id,
+                        action="lock",
+                        changes={"locked": True, "reason": f"Invoice {invoice.invoice_number} auto-finalized due to full payment"}
+                    ))
+            audit_logs.append(AuditLog(
+                user_id=current_user.id, user_name=current_user.full_name, module="invoice", record_id=invoice_id,
+                action="auto_finalize",
+                changes={
+                    "status": "finalized",
+                    "finalized_at": now.isoformat(),
+                    "jobcard_locked": bool(invoice.jobcard_id),
+                    "ledger_entry_created": False,  # Payments already created the double entries
+                    "customer_type": invoice.customer_type,
+                    "trigger": "full_payment_received"
+                }
+            ))
+    
+    # Step 6: All audit logs in one insert
+    audit_logs += [AuditLog(
+        user_id=current_user.id, user_name=current_user.full_name, module="gold_ledger", record_id=entry.id,
+        action="create", changes={"invoice_id": invoice_id, "gold_weight_grams": entry.weight_grams}
+    ) for entry in gold_entries]
+    audit_logs += [AuditLog(
+        user_id=current_user.id, user_name=current_user.full_name, module="transaction", record_id=txn.id,
+        action="create",
+        changes={"invoice_id": invoice_id, "payment_amount": txn.amount, "transaction_type": txn.transaction_type, "account": txn.account_name}
+    ) for txn in transactions]
+    audit_logs.append(AuditLog(
+        user_id=current_user.id, user_name=current_user.full_name, module="invoice", record_id=invoice_id,
+        action="add_payments",
+        changes={
+            "amount": total_amount,
+            "tenders": [{"payment_mode": r['payment_mode'], "amount": r['amount']} for r in results],
+            "new_paid_amount": new_paid_amount,
+            "new_balance_due": max(0, new_balance_due),
+            "double_entry": True
+        }
+    ))
+    await db.audit_logs.insert_many([log.model_dump() for log in audit_logs])
+    
+    return {
+        "message": f"{len(results)} payments added successfully (double-entry recorded)",
+        "payments": results,
+        "total_amount": total_amount,
+        "new_paid_amount": new_paid_amount,
+        "new_balance_due": max(0, new_balance_due),
+        "payment_status": new_payment_status,
+        "status": "finalized" if auto_finalize else existing.get("status", "draft"),
+        "customer_gold_balance_remaining": round(gold_balance - gold_requested, 3) if gold_balance is not None else None,
+        "is_walk_in_partial_payment": invoice.customer_type == "walk_in" and new_balance_due > 0.01
+    }
+
+# ============================================================================
+# PARTY RECEIPT ALLOCATION
+# ============================================================================
+# A lump-sum payment from a credit customer (or to a vendor) is spread over
+# the party's open documents - finalized invoices with balance_due > 0, or
+# unlocked purchases with balance_due_money > 0 - either oldest first (FIFO)
+# or by an explicit split. Each allocation is booked exactly like the
+# per-document add-payment call, but all documents are updated with one
+# guarded bulk_write and all transactions / audit logs are inserted at once.
+
+PARTY_ALLOCATION_MODES = ("fifo", "explicit")
+
+def allocate_party_payment(
+    amount: Optional[float],
+    open_docs: List[dict],
+    balance_field: str,
+    mode: str,
+    allocations: Optional[List[dict]] = None,
+    label: str = "document",
+    precision: int = 3
+) -> List[tuple]:
+    """
+    Split a payment over open documents.
+    
+    Args:
+        amount: Payment amount (optional for explicit mode - defaults to the split total)
+        open_docs: Open documents sorted oldest first
+        balance_field: Outstanding balance field (balance_due / balance_due_money)
+        mode: "fifo" (oldest first) or "explicit"
+        allocations: For explicit mode - [{"id": ..., "amount": ...}]
+        label: Document name used in error messages
+        precision: Decimals the balance field is stored with - every share is
+                   rounded to it, so the shares add up to exactly the amount
+    
+    Returns:
+        List of (document, allocated amount) in document order
+    """
+    if mode not in PARTY_ALLOCATION_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid allocation '{mode}'. Must be one of: {', '.join(PARTY_ALLOCATION_MODES)}")
+    balances = {doc['id']: round(float(doc.get(balance_field) or 0), precision) for doc in open_docs}
+    total_outstanding = round(sum(balances.values()), precision)
+    
+    if mode == "fifo":
+        if not amount or amount <= 0:
+            raise HTTPException(status_code=400, detail="Payment amount must be greater than 0")
+        amount = round(amount, precision)
+        if amount > total_outstanding + 0.01:  # Allow small rounding errors
+            raise HTTPException(
+                status_code=400,
+                detail=f"Payment amount ({amount:.3f} OMR) exceeds the total outstanding ({total_outstanding:.3f} OMR) on {len(open_docs)} open {label}s"
+            )
+        result, remaining = [], amount
+        for doc in open_docs:
+            if remaining <= 0:
+                break
+            share = round(min(remaining, balances[doc['id']]), precision)
+            result.append((doc, share))
+            remaining = round(remaining - share, precision)
+        return result
+    
+    if not allocations:
+        raise HTTPException(status_code=400, detail="allocations are required for explicit allocation")
+    by_id = {doc['id']: doc for doc in open_docs}
+    result, seen = [], set()
+    for allocation in allocations:
+        doc_id = allocation.get('id')
+        share = round(float(allocation.get('amount') or 0), precision)
+        if doc_id in seen:
+            raise HTTPException(status_code=400, detail=f"{label.capitalize()} {doc_id} is allocated more than once")
+        seen.add(doc_id)
+        if doc_id not in by_id:
+            raise HTTPException(status_code=400, detail=f"{label.capitalize()} {doc_id} is not an open {label} of this party")
+        if share <= 0:
+            raise HTTPException(status_code=400, detail=f"Allocation to {label} {doc_id} must be greater than 0")
+        if share > balances[doc_id] + 0.01:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Allocation ({share:.3f} OMR) exceeds the balance ({balances[doc_id]:.3f} OMR) of {label} {doc_id}"
+            )
+        result.append((by_id[doc_id], min(share, balances[doc_id])))
+    allocated_total = round(sum(share for _, share in result), precision)
+    if amount and round(amount, precision) != allocated_total:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Allocations total {allocated_total:.3f} OMR but the payment amount is {amount:.3f} OMR"
+        )
+    return result
+
+async def apply_guarded_document_updates(collection, updates: List[tuple], guard_field: str, marker: str) -> bool:
+    """
+    Apply per-document $set updates in one bulk_write, each guarded on the
+    value of guard_field that was read. If any document changed meanwhile,
+    the updates that did apply are reverted and False is returned.
+    
+    Args:
+        collection: Motor collection
+        updates: List of (document as read, $set dict)
+        guard_field: Field compared against the value read (paid amount)
+        marker: Value stored in last_payment_batch_id to find applied updates
+    """
+    def guard(doc):
+        return doc[guard_field] if guard_field in doc else {"$exists": False}
+    
+    result = await collection.bulk_write([
+        UpdateOne(
+            {"id": doc['id'], "is_deleted": False, guard_field: guard(doc)},
+            {"$set": {**changes, "last_payment_batch_id": marker}}
+        )
+        for doc, changes in updates
+    ], ordered=False)
+    if result.matched_count == len(updates):
+        return True
+    applied = {d['id'] for d in await collection.find(
+        {"id": {"$in": [doc['id'] for doc, _ in updates]}, "last_payment_batch_id": marker}, {"_id": 0, "id": 1}
+    ).to_list(None)}
+    if applied:
+        await revert_guarded_document_updates(collection, [(doc, changes) for doc, changes in updates if doc['id'] in applied])
+    return False
+
+async def revert_guarded_document_updates(collection, updates: List[tuple]):
+    """Put documents changed by apply_guarded_document_updates back as read (batch marker included)."""
+    await collection.bulk_write([
+        UpdateOne({"id": doc['id']}, restore_fields_update(doc, [*changes, "last_payment_batch_id"]))
+        for doc, changes in updates
+    ], ordered=False)
+
+@api_router.post("/parties/{party_id}/receipts")
+async def add_party_receipt(
+    party_id: str,
+    payment_data: dict,
+    current_user: User = Depends(require_permission('invoices.create'))
+):
+    """
+    Record one customer receipt against several open invoices.
+    
+    Body:
+        {
+            "amount": 500,                 # optional for explicit allocation
+            "payment_mode": "Cash",
+            "account_id": "...",
+            "allocation": "fifo" | "explicit",
+            "allocations": [{"id": "<invoice_id>", "amount": 200}, ...],   # explicit only
+            "notes": "..."
+        }
+    
+    Open invoices are the customer's finalized invoices with balance_due > 0,
+    oldest first. Every allocation creates the same double entry as
+    add-payment (debit the receiving account, credit Sales Income).
+    """
+    party = await db.parties.find_one({"id": party_id, "is_deleted": False}, {"_id": 0, "id": 1, "name": 1})
+    if not party:
+        raise HTTPException(status_code=404, detail="Party not found")
+    payment_mode = payment_data.get('payment_mode')
+    if not payment_mode:
+        raise HTTPException(status_code=400, detail="Payment mode is required")
+    if payment_mode == "GOLD_EXCHANGE":
+        raise HTTPException(status_code=400, detail="GOLD_EXCHANGE is not supported for party receipts; use add-payment on the invoice")
+    account_id = payment_data.get('account_id')
+    if not account_id:
+        raise HTTPException(status_code=400, detail="Account ID is required")
+    account = await db.accounts.find_one({"id": account_id, "is_deleted": False}, {"_id": 0, "id": 1, "name": 1})
+    if not account:
+        raise HTTPException(status_code=404, detail=f"Account with ID {account_id} not found")
+    
+    raw_invoices = await db.invoices.find(
+        {"customer_id": party_id, "is_deleted": False, "status": "finalized", "balance_due": {"$gt": 0}},
+        {"_id": 0, "id": 1, "invoice_number": 1, "date": 1, "grand_total": 1, "paid_amount": 1, "balance_due": 1, "payment_status": 1, "paid_at": 1}
+    ).sort([("date", 1), ("id", 1)]).to_list(None)
+    raw_by_id = {doc['id']: doc for doc in raw_invoices}
+    open_invoices = [decimal_to_float(doc) for doc in raw_invoices]
+    amount = payment_data.get('amount')
+    amount = round(float(amount), 3) if amount else None
+    allocated = allocate_party_payment(
+        amount, open_invoices, "balance_due", payment_data.get('allocation', 'fifo'), payment_data.get('allocations'), "invoice"
+    )
+    sales_account = await get_or_create_income_account("Sales Income", current_user.id)
+    
+    # Step 1: One guarded bulk_write updates every allocated invoice
+    receipt_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    updates = []
+    for invoice, share in allocated:
+        new_paid_amount = round(float(invoice.get('paid_amount') or 0) + share, 3)
+        new_balance_due = round(float(invoice.get('grand_total') or 0) - new_paid_amount, 3)
+        changes = {
+            "paid_amount": new_paid_amount,
+            "balance_due": max(0, new_balance_due),
+            "payment_status": "paid" if new_balance_due < 0.01 else "partial"
+        }
+        if changes["payment_status"] == "paid" and not invoice.get("paid_at"):
+            changes["paid_at"] = now
+        # Guarded on the raw stored values (as read, before float conversion)
+        updates.append((raw_by_id[invoice['id']], changes))
+    if not await apply_guarded_document_updates(db.invoices, updates, "paid_amount", receipt_id):
+        raise HTTPException(status_code=409, detail="An invoice was paid meanwhile. Please retry.")
+    
+    # Step 2: Double entries for every allocation, numbered from one count
+    party_name = party.get('name') or "Unknown Customer"
+    year = now.year
+    count = await db.transactions.count_documents({"transaction_number": {"$regex": f"^TXN-{year}"}})
+    notes = payment_data.get('notes', '')
+    transactions, results = [], []
+    for invoice, share in allocated:
+        debit = Transaction(
+            transaction_number=f"TXN-{year}-{str(count + 1).zfill(4)}",
+            transaction_type="debit",  # Debit increases asset
+            mode=payment_mode,
+            account_id=account_id,
+            account_name=account['name'],
+            party_id=party_id,
+            party_name=party_name,
+            amount=share,
+            category="Invoice Payment - Cash/Bank (Debit)",
+            notes=f"Payment for {invoice.get('invoice_number')} (receipt {receipt_id[:8]}). {notes}".strip(),
+            reference_type="invoice",
+            reference_id=invoice['id'],
+            created_by=current_user.id
+        )
+        credit = Transaction(
+            transaction_number=f"TXN-{year}-{str(count + 2).zfill(4)}",
+            transaction_type="credit",  # Credit increases income
+            mode=payment_mode,
+            account_id=sales_account['id'],
+            account_name=sales_account['name'],
+            party_id=party_id,
+            party_name=party_name,
+            amount=share,
+            category="Invoice Payment - Sales Income (Credit)",
+            notes=f"Revenue for {invoice.get('invoice_number')} (receipt {receipt_id[:8]}). {notes}".strip(),
+            reference_type="invoice",
+            reference_id=invoice['id'],
+            created_by=current_user.id
+        )
+        count += 2
+        transactions.extend([debit, credit])
+        results.append({
+            "invoice_id": invoice['id'],
+            "invoice_number": invoice.get('invoice_number'),
+            "amount": share,
+            "debit_transaction_number": debit.transaction_number,
+            "credit_transaction_number": credit.transaction_number
+        })
+    total = round(sum(share for _, share in allocated), 3)
+    
+    try:
+        await db.transactions.insert_many([txn.model_dump() for txn in transactions])
+        increments = {account_id: total}
+        increments[sales_account['id']] = increments.get(sales_account['id'], 0) + total
+        await apply_account_increments(increments)
+    except Exception as e:
+        # apply_account_increments has already reversed any partial $inc
+        logger.error(f"Party receipt {receipt_id} failed, rolling back: {str(e)}")
+        await db.transactions.delete_many({"id": {"$in": [txn.id for txn in transactions]}})
+        await revert_guarded_document_updates(db.invoices, updates)
+        raise HTTPException(status_code=500, detail="Failed to record the receipt. No payment was applied.")
+    
+    audit_logs = [AuditLog(
+        user_id=current_user.id, user_name=current_user.full_name, module="invoice", record_id=invoice['id'],
+        action="add_payment",
+        changes={"amount": share, "payment_mode": payment_mode, "party_receipt_id": receipt_id, "double_entry": True}
+    ) for invoice, share in allocated]
+    audit_logs.append(AuditLog(
+        user_id=current_user.id, user_name=current_user.full_name, module="party", record_id=party_id,
+        action="receipt",
+        changes={"receipt_id": receipt_id, "amount": total, "account": account['name'], "allocations": [
+            {"invoice_id": r['invoice_id'], "amount": r['amount']} for r in results
+        ]}
+    ))
+    await db.audit_logs.insert_many([log.model_dump() for log in audit_logs])
+    
+    return {
+        "message": f"Receipt of {total:.3f} OMR allocated to {len(results)} invoices",
+        "receipt_id": receipt_id,
+        "amount": total,
+        "allocations": results,
+        "remaining_outstanding": round(sum(float(inv.get('balance_due') or 0) for inv in open_invoices) - total, 3)
+    }
+
+@api_router.post("/parties/{party_id}/vendor-payments")
+async def add_party_vendor_payment(
+    party_id: str,
+    payment_data: dict,
+    current_user: User = Depends(require_permission('purchases.create'))
+):
+    """
+    Record one payment to a vendor against several open purchases.
+    
+    Body: same as POST /parties/{party_id}/receipts, with purchase ids in
+    allocations. Open purchases are the vendor's unlocked purchases with
+    balance_due_money > 0, oldest first. Every allocation is booked like
+    add-payment on the purchase (credit the paying account, status update,
+    lock when fully paid).
+    """
+    vendor = await db.parties.find_one({"id": party_id, "is_deleted": False}, {"_id": 0, "id": 1, "name": 1})
+    if not vendor:
+        raise HTTPException(status_code=404, detail="Vendor not found")
+    payment_mode = payment_data.get('payment_mode')
+    if not payment_mode:
+        raise HTTPException(status_code=400, detail="Payment mode is required")
+    account_id = payment_data.get('account_id')
+    if not account_id:
+        raise HTTPException(status_code=400, detail="Account ID is required")
+    account = await db.accounts.find_one({"id": account_id, "is_deleted": False}, {"_id": 0, "id": 1, "name": 1})
+    if not account:
+        raise HTTPException(status_code=404, detail="Payment account not found")
+    
+    raw_purchases = await db.purchases.find(
+        {"vendor_party_id": party_id, "is_deleted": False, "locked": {"$ne": True}, "balance_due_money": {"$gt": 0}},
+        {"_id": 0, "id": 1, "date": 1, "description": 1, "amount_total": 1, "paid_amount_money": 1, "balance_due_money": 1, "status": 1, "locked": 1, "locked_at": 1, "locked_by": 1}
+    ).sort([("date", 1), ("id", 1)]).to_list(None)
+    raw_by_id = {doc['id']: doc for doc in raw_purchases}
+    open_purchases = [decimal_to_float(doc) for doc in raw_purchases]
+    amount = payment_data.get('amount')
+    amount = round(float(amount), 2) if amount else None
+    allocated = allocate_party_payment(
+        amount, open_purchases, "balance_due_money", payment_data.get('allocation', 'fifo'), payment_data.get('allocations'), "purchase",
+        precision=2  # Purchase money fields are stored with 2 decimals
+    )
+    
+    # Step 1: One guarded bulk_write updates every allocated purchase
+    payment_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    updates, summaries = [], []
+    for purchase, share in allocated:
+        new_paid_amount = round(float(purchase.get('paid_amount_money') or 0) + share, 2)
+        new_balance_due = max(0.0, round(float(purchase.get('amount_total') or 0) - new_paid_amount, 2))
+        changes = {
+            "paid_amount_money": new_paid_amount,
+            "balance_due_money": new_balance_due,
+            "status": calculate_purchase_status(new_paid_amount, purchase.get('amount_total') or 0)
+        }
+        if new_balance_due == 0:
+            changes.update({"locked": True, "locked_at": now, "locked_by": current_user.username})
+        updates.append((raw_by_id[purchase['id']], changes))
+        summaries.append((purchase, share, changes))
+    if not await apply_guarded_document_updates(db.purchases, updates, "paid_amount_money", payment_id):
+        raise HTTPException(status_code=409, detail="A purchase was paid meanwhile. Please retry.")
+    
+    # Step 2: One CREDIT transaction (money OUT) per purchase, numbered from one count
+    current_year = now.year
+    existing_txns = await db.transactions.count_documents({"transaction_number": {"$regex": f"^TXN-{current_year}-"}})
+    transactions, results = [], []
+    for index, (purchase, share, changes) in enumerate(summaries, start=1):
+        txn = Transaction(
+            transaction_number=f"TXN-{current_year}-{existing_txns + index:04d}",
+            date=now,
+            transaction_type="credit",
+            mode=payment_mode,
+            account_id=account_id,
+            account_name=account["name"],
+            party_id=party_id,
+            party_name=vendor["name"],
+            amount=share,
+            category="Purchase Payment",
+            reference_type="purchase",
+            reference_id=purchase['id'],
+            notes=payment_data.get('notes', f"Payment for purchase: {purchase.get('description')}"),
+            created_by=current_user.username
+        )
+        transactions.append(txn)
+        results.append({
+            "purchase_id": purchase['id'],
+            "amount": share,
+            "new_status": changes['status'],
+            "locked": changes.get('locked', False),
+            "transaction_number": txn.transaction_number
+        })
+    total = round(sum(share for _, share, _ in summaries), 2)
+    
+    try:
+        await db.transactions.insert_many([txn.model_dump() for txn in transactions])
+        # CREDIT = money OUT
+        await apply_account_increments({account_id: -total})
+    except Exception as e:
+        logger.error(f"Vendor payment {payment_id} failed, rolling back: {str(e)}")
+        await db.transactions.delete_many({"id": {"$in": [txn.id for txn in transactions]}})
+        await revert_guarded_document_updates(db.purchases, updates)
+        raise HTTPException(status_code=500, detail="Failed to record the payment. No payment was applied.")
+    
+    audit_logs = [AuditLog(
+        user_id=current_user.id, user_name=current_user.username, module="purchases", record_id=purchase['id'],
+        action="add_payment",
+        changes={
+            "payment_amount": share,
+            "payment_mode": payment_mode,
+            "account_id": account_id,
+            "account_name": account["name"],
+            "previous_paid_amount": purchase.get('paid_amount_money'),
+            "new_paid_amount": changes['paid_amount_money'],
+            "previous_balance_due": purchase.get('balance_due_money'),
+            "new_balance_due": changes['balance_due_money'],
+            "previous_status": purchase.get('status'),
+            "new_status": changes['status'],
+            "locked": changes.get('locked', False),
+            "vendor_payment_id": payment_id
+        }
+    ) for purchase, share, changes in summaries]
+    audit_logs.append(AuditLog(
+        user_id=current_user.id, user_name=current_user.username, module="party", record_id=party_id,
+        action="vendor_payment",
+        changes={"payment_id": payment_id, "amount": total, "account": account['name'], "allocations": [
+            {"purchase_id": r['purchase_id'], "amount": r['amount']} for r in results
+        ]}
+    ))
+    await db.audit_logs.insert_many([log.model_dump() for log in audit_logs])
+    
+    return {
+        "success": True,
+        "message": f"Payment of {total:.2f} OMR allocated to {len(results)} purchases",
+        "payment_id": payment_id,
+        "amount": total,
+        "allocations": results,
+        "remaining_outstanding": round(sum(float(p.get('balance_due_money') or 0) for p in open_purchases) - total, 2)
+    }
+
 @api_router.get("/invoices/{invoice_id}/impact")
 async def get_invoice_impact(invoice_id: str, current_user: User = Depends(require_permission('invoices.view'))):
     """
@@ -5948,151 +9270,349 @@ async def delete_invoice(invoice_id: str, current_user: User = Depends(require_p
         {"id": invoice_id},
         {"$set": {"is_deleted": True}}
     )
+    await release_invoice_reservations(invoice_id)
     await create_audit_log(current_user.id, current_user.full_name, "invoice", invoice_id, "delete")
     return {"message": "Invoice deleted successfully"}
 
 @api_router.get("/invoices/{invoice_id}/pdf")
-async def generate_invoice_pdf(invoice_id: str, current_user: User = Depends(require_permission('invoices.view'))):
+async def generate_invoice_pdf(invoice_id: str, request: Request, current_user: User = Depends(require_permission('invoices.view'))):
     from fastapi.responses import StreamingResponse
     from io import BytesIO
-    from reportlab.lib.pagesizes import letter, A4
-    from reportlab.lib.units import inch
-    from reportlab.pdfgen import canvas
-    from reportlab.lib import colors
-    from reportlab.platypus import Table, TableStyle
+    from invoice_pdf import render_invoice_pdf, invoice_pdf_filename
+    
+    # Skip the PDF render entirely when the client already holds this version
+    not_modified = await check_not_modified(request, db.invoices, invoice_id, INVOICE_VERSION_FIELDS, "pdf")
+    if not_modified:
+        return not_modified
     
     invoice = await db.invoices.find_one({"id": invoice_id, "is_deleted": False}, {"_id": 0})
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
+    buffer = BytesIO(render_invoice_pdf(decimal_to_float(invoice)))
     
-    # Header
-    p.setFont("Helvetica-Bold", 20)
-    p.drawString(50, height - 50, "Gold Shop ERP")
-    p.setFont("Helvetica", 10)
-    p.drawString(50, height - 70, "The Artisan Ledger")
-    
-    # Invoice details
-    p.setFont("Helvetica-Bold", 16)
-    p.drawString(50, height - 120, f"Invoice #{invoice.get('invoice_number', '')}")
-    p.setFont("Helvetica", 10)
-    invoice_date = invoice.get('date', '')
-    if isinstance(invoice_date, str):
-        date_str = invoice_date[:10]
+    pdf_response = StreamingResponse(
+        buffer,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename={invoice_pdf_filename(invoice)}"}
+    )
+    etag = build_document_etag(invoice, INVOICE_VERSION_FIELDS, "pdf")
+    apply_cache_headers(pdf_response, etag, CACHE_CONTROL_FINALIZED if etag else CACHE_CONTROL_DRAFT)
+    return pdf_response
+
+@api_router.get("/invoices/{invoice_id}/receipt")
+async def generate_invoice_receipt(
+    invoice_id: str,
+    request: Request,
+    format: str = "escpos",
+    breakdown: bool = False,
+    current_user: User = Depends(require_permission('invoices.view'))
+):
+    """
+    Compact 80mm thermal receipt for an invoice.
+    
+    Args:
+        format: "escpos" (raw printer bytes), "text" or "pdf" (narrow 80mm PDF)
+        breakdown: Include the calculation formulas (format_calculation_summary)
+    """
+    from thermal_receipt import RECEIPT_FORMATS, render_receipt
+    
+    if format not in RECEIPT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format '{format}'. Must be one of: {', '.join(RECEIPT_FORMATS)}")
+    
+    # The receipt header comes from shop settings, so their version is part of the tag
+    stored_shop = await shop_settings_cache.first()
+    shop = stored_shop or ShopSettings().model_dump()
+    # Defaults carry a fresh updated_at on every call - only stored settings version the receipt
+    shop_version = str(stored_shop.get('updated_at', '')) if stored_shop else ""
+    variant = f"receipt-{format}{'-breakdown' if breakdown else ''}:{shop_version}"
+    not_modified = await check_not_modified(request, db.invoices, invoice_id, INVOICE_VERSION_FIELDS, variant)
+    if not_modified:
+        return not_modified
+    
+    invoice = await db.invoices.find_one({"id": invoice_id, "is_deleted": False}, {"_id": 0})
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    
+    body = render_receipt(decimal_to_float(invoice), shop, format, breakdown)
+    filename = f"receipt_{invoice.get('invoice_number', 'unknown')}"
+    if format == "text":
+        response = Response(content=body, media_type="text/plain; charset=utf-8")
+    elif format == "pdf":
+        response = Response(
+            content=body,
+            media_type="application/pdf",
+            headers={"Content-Disposition": f"inline; filename={filename}.pdf"}
+        )
     else:
-        date_str = str(invoice_date)[:10]
-    p.drawString(50, height - 140, f"Date: {date_str}")
-    p.drawString(50, height - 155, f"Customer: {invoice.get('customer_name', 'N/A')}")
-    p.drawString(50, height - 170, f"Type: {invoice.get('invoice_type', 'sale').upper()}")
-    p.drawString(50, height - 185, f"Status: {invoice.get('payment_status', 'unpaid').upper()}")
-    
-    # Items table
-    y_position = height - 230
-    p.setFont("Helvetica-Bold", 10)
-    p.drawString(50, y_position, "Item")
-    p.drawString(250, y_position, "Qty")
-    p.drawString(300, y_position, "Weight")
-    p.drawString(370, y_position, "Rate")
-    p.drawString(450, y_position, "Total")
-    
-    p.setFont("Helvetica", 9)
-    y_position -= 20
-    
-    for item in invoice.get('items', []):
-        p.drawString(50, y_position, item.get('description', '')[:30])
-        p.drawString(250, y_position, str(item.get('qty', 0)))
-        p.drawString(300, y_position, f"{item.get('weight', 0)}g")
-        p.drawString(370, y_position, f"{item.get('metal_rate', 0):.2f}")
-        p.drawString(450, y_position, f"{item.get('line_total', 0):.2f}")
-        y_position -= 15
-        
-        if y_position < 100:
-            p.showPage()
-            y_position = height - 50
-    
-    # Totals
-    y_position -= 20
-    p.setFont("Helvetica-Bold", 10)
-    p.drawString(370, y_position, "Subtotal:")
-    p.drawString(450, y_position, f"{invoice.get('subtotal', 0):.2f} OMR")
-    
-    # MODULE 7: Add discount line if discount exists
-    discount_amount = invoice.get('discount_amount', 0)
-    if discount_amount > 0:
-        y_position -= 15
-        p.setFont("Helvetica", 10)
-        p.drawString(370, y_position, "Discount:")
-        p.drawString(450, y_position, f"-{discount_amount:.2f} OMR")
-    
-    y_position -= 15
-    p.setFont("Helvetica-Bold", 10)
-    p.drawString(370, y_position, "VAT:")
-    p.drawString(450, y_position, f"{invoice.get('vat_total', 0):.2f} OMR")
-    y_position -= 15
-    p.setFont("Helvetica-Bold", 12)
-    p.drawString(370, y_position, "Grand Total:")
-    p.drawString(450, y_position, f"{invoice.get('grand_total', 0):.2f} OMR")
-    y_position -= 15
-    p.setFont("Helvetica", 10)
-    p.drawString(370, y_position, "Balance Due:")
-    p.drawString(450, y_position, f"{invoice.get('balance_due', 0):.2f} OMR")
-    
-    # Footer
-    p.setFont("Helvetica-Oblique", 8)
-    p.drawString(50, 50, "Thank you for your business!")
-    
-    p.save()
-    buffer.seek(0)
+        response = Response(
+            content=body,
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f"attachment; filename={filename}.bin"}
+        )
+    etag = build_document_etag(invoice, INVOICE_VERSION_FIELDS, variant)
+    apply_cache_headers(response, etag, CACHE_CONTROL_FINALIZED if etag else CACHE_CONTROL_DRAFT)
+    return response
+
+# ============================================================================
+# BULK INVOICE PDF
+# ============================================================================
+# Daily filing prints every invoice of a day. Rendering is CPU-bound ReportLab
+# work, so it runs in a process pool (ReportLab loaded and warmed once per
+# worker) instead of on the event loop.
+#
+# - format=zip: invoices are rendered in chunks across the workers and each
+#   PDF is streamed into the ZIP as soon as its chunk completes
+# - format=pdf: one merged document drawn on a single canvas in one worker
+#   (each invoice starts on a new page; no PDF merge library needed)
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import io
+import zipfile
+
+PDF_RENDER_WORKERS = max(1, int(os.environ.get('PDF_RENDER_WORKERS', min(4, os.cpu_count() or 1))))
+BULK_PDF_MAX_INVOICES = 1000
+BULK_PDF_CHUNK_SIZE = 25
+BULK_PDF_FORMATS = ("zip", "pdf")
+
+_pdf_render_pool: Optional[ProcessPoolExecutor] = None
+
+def get_pdf_render_pool() -> ProcessPoolExecutor:
+    """
+    Process pool for PDF rendering, created on first use. Workers are spawned,
+    not forked: forking this multithreaded (Motor/uvicorn) process is unsafe
+    and would copy the whole server into every worker, while invoice_pdf
+    imports on its own.
+    """
+    global _pdf_render_pool
+    if _pdf_render_pool is None:
+        from invoice_pdf import warm_up
+        _pdf_render_pool = ProcessPoolExecutor(
+            max_workers=PDF_RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=warm_up
+        )
+    return _pdf_render_pool
+
+class _ZipChunkStream(io.RawIOBase):
+    """
+    Write-only sink for zipfile that hands out what has been written so far.
+    Being unseekable, zipfile writes entries sequentially (streaming mode).
+    """
+    def __init__(self):
+        self._chunks: List[bytes] = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+@api_router.post("/invoices/bulk-pdf")
+async def generate_invoices_bulk_pdf(payload: dict, current_user: User = Depends(require_permission('invoices.view'))):
+    """
+    Render many invoices at once.
+    
+    Body (either invoice_ids or a date range):
+    - invoice_ids: list of invoice ids (rendered in this order)
+    - date_from / date_to: invoice date range (YYYY-MM-DD or ISO 8601; a bare
+      date_to includes the whole day), rendered oldest first
+    - format: "zip" (default, one PDF per invoice) or "pdf" (single merged PDF)
+    """
+    from fastapi.responses import StreamingResponse
+    from invoice_pdf import render_invoice_pdfs, render_merged_pdf
+    
+    output_format = payload.get('format', 'zip')
+    if output_format not in BULK_PDF_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format '{output_format}'. Must be one of: {', '.join(BULK_PDF_FORMATS)}")
+    
+    invoice_ids = payload.get('invoice_ids')
+    date_from = payload.get('date_from')
+    date_to = payload.get('date_to')
+    query: Dict[str, Any] = {"is_deleted": False}
+    if invoice_ids:
+        query["id"] = {"$in": list(dict.fromkeys(invoice_ids))}
+    elif date_from or date_to:
+        date_query = {}
+        if date_from:
+            try:
+                parsed = datetime.fromisoformat(date_from.replace('Z', '+00:00'))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid date_from format. Use ISO format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)")
+            date_query['$gte'] = parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        if date_to:
+            date_query['$lte'] = parse_as_of(date_to)
+        query["date"] = date_query
+    else:
+        raise HTTPException(status_code=400, detail="Provide invoice_ids or date_from/date_to")
+    
+    invoices = await db.invoices.find(query, {"_id": 0}).sort("date", 1).to_list(BULK_PDF_MAX_INVOICES + 1)
+    if not invoices:
+        raise HTTPException(status_code=404, detail="No invoices found")
+    if len(invoices) > BULK_PDF_MAX_INVOICES:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_PDF_MAX_INVOICES} invoices per request; narrow the date range")
+    if invoice_ids:
+        position = {invoice_id: i for i, invoice_id in enumerate(invoice_ids)}
+        invoices.sort(key=lambda inv: position.get(inv['id'], 0))
+    invoices = [decimal_to_float(invoice) for invoice in invoices]
+    
+    loop = asyncio.get_running_loop()
+    pool = get_pdf_render_pool()
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
+    
+    if output_format == "pdf":
+        merged = await loop.run_in_executor(pool, render_merged_pdf, invoices)
+        return StreamingResponse(
+            io.BytesIO(merged),
+            media_type="application/pdf",
+            headers={"Content-Disposition": f"attachment; filename=invoices_{stamp}.pdf"}
+        )
+    
+    chunks = [invoices[i:i + BULK_PDF_CHUNK_SIZE] for i in range(0, len(invoices), BULK_PDF_CHUNK_SIZE)]
+    
+    async def zip_stream():
+        futures = [loop.run_in_executor(pool, render_invoice_pdfs, chunk) for chunk in chunks]
+        sink = _ZipChunkStream()
+        seen_names = set()
+        try:
+            with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+                for completed in asyncio.as_completed(futures):
+                    for filename, pdf_bytes in await completed:
+                        # Invoice numbers are unique, but never let a duplicate overwrite an entry
+                        name = filename if filename not in seen_names else f"{filename[:-4]}_{len(seen_names)}.pdf"
+                        seen_names.add(name)
+                        archive.writestr(name, pdf_bytes)
+                    yield sink.drain()
+            yield sink.drain()
+        finally:
+            for future in futures:
+                future.cancel()
     
     return StreamingResponse(
-        buffer,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename=invoice_{invoice.get('invoice_number', 'unknown')}.pdf"}
+        zip_stream(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=invoices_{stamp}.zip"}
     )
 
+# Sub-resources available on the invoice detail aggregate
+INVOICE_DETAIL_INCLUDES = ("payments", "customer", "jobcard", "returns")
+INVOICE_DETAIL_DEFAULT_INCLUDE = "payments,customer"
+# Includes covered by the invoice version fields (payments always move
+# paid_amount/balance_due) - other includes disable conditional GET (party
+# edits, for example, do not touch the invoice, so customer is not covered)
+INVOICE_DETAIL_CACHEABLE_INCLUDES = {"payments"}
+
+def _lookup_by(from_collection: str, local_field: str, foreign_field: str, as_field: str,
+               match: Optional[Dict[str, Any]] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+    """$lookup stage joining local_field to foreign_field, with extra match conditions."""
+    conditions = [{"$eq": [f"${foreign_field}", "$$local_value"]}]
+    conditions += [{"$eq": [f"${field}", value]} for field, value in (match or {}).items()]
+    pipeline = [{"$match": {"$expr": {"$and": conditions}}}, {"$project": {"_id": 0}}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    return {"$lookup": {
+        "from": from_collection,
+        "let": {"local_value": f"${local_field}"},
+        "pipeline": pipeline,
+        "as": as_field
+    }}
+
+def invoice_detail_pipeline(invoice_id: str, includes: set) -> List[Dict[str, Any]]:
+    """Single aggregation returning the invoice plus the requested sub-resources."""
+    pipeline = [
+        {"$match": {"id": invoice_id, "is_deleted": False}},
+        {"$project": {"_id": 0}}
+    ]
+    if "payments" in includes:
+        pipeline.append(_lookup_by("transactions", "id", "reference_id", "_payments",
+                                   {"reference_type": "invoice", "is_deleted": False}, limit=100))
+    if "customer" in includes:
+        pipeline.append(_lookup_by("parties", "customer_id", "id", "_customer", {"is_deleted": False}, limit=1))
+    if "jobcard" in includes:
+        pipeline.append(_lookup_by("jobcards", "jobcard_id", "id", "_jobcard", {"is_deleted": False}, limit=1))
+    if "returns" in includes:
+        pipeline.append(_lookup_by("returns", "id", "reference_id", "_returns",
+                                   {"reference_type": "invoice", "is_deleted": False}))
+    return pipeline
+
 @api_router.get("/invoices/{invoice_id}/full-details")
-async def get_invoice_full_details(invoice_id: str, current_user: User = Depends(require_permission('invoices.view'))):
+async def get_invoice_full_details(
+    invoice_id: str,
+    request: Request,
+    response: Response,
+    include: str = INVOICE_DETAIL_DEFAULT_INCLUDE,
+    current_user: User = Depends(require_permission('invoices.view'))
+):
     """
     Get invoice with full details including payment transactions for professional invoice printing
+    
+    Everything is loaded in one aggregation ($lookup per sub-resource).
+    include: comma-separated subset of payments, customer, jobcard, returns
+    (default: payments,customer)
     """
-    invoice = await db.invoices.find_one({"id": invoice_id, "is_deleted": False}, {"_id": 0})
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
+    includes = {part.strip() for part in include.split(",") if part.strip()}
+    unknown = includes - set(INVOICE_DETAIL_INCLUDES)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid include '{', '.join(sorted(unknown))}'. Must be a subset of: {', '.join(INVOICE_DETAIL_INCLUDES)}"
+        )
+    cacheable = includes <= INVOICE_DETAIL_CACHEABLE_INCLUDES
+    variant = "full-details:" + ",".join(sorted(includes))
     
-    # Get all payment transactions for this invoice
-    payments = await db.transactions.find({
-        "reference_type": "invoice",
-        "reference_id": invoice_id,
-        "is_deleted": False
-    }, {"_id": 0}).to_list(length=100)
+    if cacheable:
+        not_modified = await check_not_modified(request, db.invoices, invoice_id, INVOICE_VERSION_FIELDS, variant)
+        if not_modified:
+            return not_modified
     
-    # Get customer details if saved customer
-    customer_details = None
-    if invoice.get('customer_type') == 'saved' and invoice.get('customer_id'):
-        party = await db.parties.find_one({"id": invoice['customer_id'], "is_deleted": False}, {"_id": 0})
-        if party:
+    rows = await db.invoices.aggregate(invoice_detail_pipeline(invoice_id, includes)).to_list(1)
+    if not rows:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    invoice = rows[0]
+    payments = invoice.pop("_payments", None)
+    customers = invoice.pop("_customer", None)
+    jobcards = invoice.pop("_jobcard", None)
+    returns = invoice.pop("_returns", None)
+    
+    result = {"invoice": Invoice(**invoice)}
+    if "payments" in includes:
+        result["payments"] = decimal_to_float(payments)
+    if "customer" in includes:
+        # Get customer details if saved customer
+        customer_details = None
+        if invoice.get('customer_type') == 'saved' and customers:
+            party = customers[0]
             customer_details = {
                 "name": party.get('name'),
                 "phone": party.get('phone'),
                 "address": party.get('address'),
                 "gstin": party.get('gstin')  # If you add GSTIN field to Party model
             }
+        result["customer_details"] = customer_details
+    if "jobcard" in includes:
+        result["jobcard"] = decimal_to_float(jobcards[0]) if jobcards else None
+    if "returns" in includes:
+        # Returns store amounts as Decimal128
+        result["returns"] = decimal_to_float(returns)
     
-    return {
-        "invoice": Invoice(**invoice),
-        "payments": payments,
-        "customer_details": customer_details
-    }
+    etag = build_document_etag(invoice, INVOICE_VERSION_FIELDS, variant) if cacheable else None
+    apply_cache_headers(response, etag, CACHE_CONTROL_FINALIZED if etag else CACHE_CONTROL_DRAFT)
+    
+    return result
 
 @api_router.get("/settings/shop")
 async def get_shop_settings(current_user: User = Depends(get_current_user)):
     """
     Get shop settings for invoice printing. Returns placeholder data if not configured.
     """
-    settings = await db.shop_settings.find_one({}, {"_id": 0})
+    settings = await shop_settings_cache.first()
     if not settings:
         # Return default placeholder settings
         default_settings = ShopSettings()
@@ -6114,6 +9634,7 @@ async def update_shop_settings(settings_data: dict, current_user: User = Depends
         # Create new settings
         new_settings = ShopSettings(**settings_data)
         await db.shop_settings.insert_one(new_settings.model_dump())
+    shop_settings_cache.invalidate()
     
     await create_audit_log(current_user.id, current_user.full_name, "settings", "shop_settings", "update", settings_data)
     return {"message": "Shop settings updated successfully"}
@@ -6130,6 +9651,14 @@ async def create_invoice(invoice_data: dict, current_user: User = Depends(requir
     # Remove conflicting keys and add required fields
     invoice_data_clean = {k: v for k, v in invoice_data.items() if k not in ['invoice_number', 'created_by']}
     invoice = Invoice(**invoice_data_clean, invoice_number=invoice_number, created_by=current_user.id)
+    await ensure_period_open(invoice.date, "Invoice")
+    
+    # Draft sale invoices hold their stock until finalized or expired
+    if invoice.status == "draft":
+        shortfalls = await reserve_invoice_stock(invoice, current_user.id)
+        if shortfalls:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock: {'; '.join(shortfalls)}")
+    
     await db.invoices.insert_one(invoice.model_dump())
     
     # Stock movements will ONLY happen when invoice is finalized via /invoices/{id}/finalize endpoint
@@ -6138,19 +9667,34 @@ async def create_invoice(invoice_data: dict, current_user: User = Depends(requir
     return invoice
 
 @api_router.get("/accounts", response_model=List[Account])
-async def get_accounts(current_user: User = Depends(require_permission('finance.view'))):
+async def get_accounts(as_of: Optional[str] = None, current_user: User = Depends(require_permission('finance.view'))):
+    """
+    Get all accounts.
+    
+    as_of (YYYY-MM-DD or ISO timestamp): adds balance_as_of to every account,
+    computed from the latest balance snapshot plus a bounded transaction replay.
+    """
     if not user_has_permission(current_user, 'finance.view'):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You don't have permission to view finance data")
     
     accounts = await db.accounts.find({"is_deleted": False}, {"_id": 0}).to_list(1000)
+    if as_of:
+        as_of_dt = parse_as_of(as_of)
+        for account in accounts:
+            account['balance_as_of'] = await get_account_balance_as_of(account, as_of_dt)
+        # Returned directly - the extra balance_as_of field is not part of the Account model
+        return MongoJSONResponse(accounts)
     return accounts
 
 @api_router.get("/accounts/{account_id}", response_model=Account)
-async def get_account(account_id: str, current_user: User = Depends(require_permission('finance.view'))):
-    """Get a single account by ID"""
+async def get_account(account_id: str, as_of: Optional[str] = None, current_user: User = Depends(require_permission('finance.view'))):
+    """Get a single account by ID (optionally with its balance as of a date)"""
     account = await db.accounts.find_one({"id": account_id, "is_deleted": False}, {"_id": 0})
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
+    if as_of:
+        account['balance_as_of'] = await get_account_balance_as_of(account, parse_as_of(as_of))
+        return MongoJSONResponse(account)
     return account
 
 @api_router.post("/accounts", status_code=201)
@@ -6174,6 +9718,7 @@ async def create_account(account_data: dict, current_user: User = Depends(requir
     try:
         account = Account(**account_data, created_by=current_user.id)
         await db.accounts.insert_one(account.model_dump())
+        account_ref_cache.invalidate()
         await create_audit_log(current_user.id, current_user.full_name, "account", account.id, "create")
         return account
     except ValueError as e:
@@ -6199,6 +9744,7 @@ async def update_account(account_id: str, update_data: dict, current_user: User
         update_data['account_type'] = account_type
     
     await db.accounts.update_one({"id": account_id}, {"$set": update_data})
+    account_ref_cache.invalidate()
     await create_audit_log(current_user.id, current_user.full_name, "account", account_id, "update", update_data)
     return {"message": "Account updated successfully"}
 
@@ -6229,6 +9775,7 @@ async def delete_account(request: Request, account_id: str, current_user: User =
         {"id": account_id},
         {"$set": {"is_deleted": True}}
     )
+    account_ref_cache.invalidate()
     await create_audit_log(current_user.id, current_user.full_name, "account", account_id, "delete")
     return {"message": "Account deleted successfully"}
 
@@ -6275,8 +9822,8 @@ async def get_transactions(
     
     # Account type filter (cash vs bank)
     if account_type:
-        accounts = await db.accounts.find({"account_type": account_type, "is_deleted": False}, {"_id": 0}).to_list(1000)
-        account_ids = [acc['id'] for acc in accounts]
+        accounts = await account_ref_cache.all()
+        account_ids = [acc['id'] for acc in accounts if acc.get('account_type') == account_type]
         if account_ids:
             query["account_id"] = {"$in": account_ids}
         else:
@@ -6293,14 +9840,21 @@ async def get_transactions(
     transactions = await db.transactions.find(query, {"_id": 0}).sort("date", -1).skip(skip).limit(page_size).to_list(page_size)
     
     # Enhance each transaction with account type and running balance
+    # Account reference data comes from the cache; live balances for the accounts
+    # on this page are fetched in a single query
+    page_account_ids = list({txn['account_id'] for txn in transactions})
+    live_balances = await db.accounts.find(
+        {"id": {"$in": page_account_ids}}, {"_id": 0, "id": 1, "current_balance": 1}
+    ).to_list(None)
+    balance_map = {b['id']: b.get('current_balance', 0) for b in live_balances}
     account_cache = {}
+    for acc_id in page_account_ids:
+        account = await account_ref_cache.get_by_id(acc_id, include_deleted=True)
+        if account:
+            account['current_balance'] = balance_map.get(acc_id, 0)
+            account_cache[acc_id] = account
+    
     for txn in transactions:
-        # Get account details
-        if txn['account_id'] not in account_cache:
-            account = await db.accounts.find_one({"id": txn['account_id']}, {"_id": 0})
-            if account:
-                account_cache[txn['account_id']] = account
-        
         if txn['account_id'] in account_cache:
             account = account_cache[txn['account_id']]
             txn['account_type'] = account['account_type']
@@ -6356,7 +9910,13 @@ async def get_transactions(
         txn['balance_before'] = round(balance_before, 3)
         txn['balance_after'] = round(running_balance, 3)
     
-    return create_pagination_response(transactions, total_count, page, page_size)
+    return MongoJSONResponse(create_pagination_response(transactions, total_count, page, page_size))
+
+# Set by the server on manual transactions - never taken from the request body
+TRANSACTION_SERVER_FIELDS = {
+    "id", "transaction_number", "account_name", "created_by", "created_at",
+    "journal_entry_id", "is_deleted", "deleted_at", "deleted_by"
+}
 
 @api_router.post("/transactions", response_model=Transaction)
 async def create_transaction(transaction_data: dict, current_user: User = Depends(require_permission('finance.create'))):
@@ -6364,7 +9924,7 @@ async def create_transaction(transaction_data: dict, current_user: User = Depend
     Create a manual finance transaction.
     
     WARNING: Manual transactions should be created in pairs for double-entry bookkeeping.
-    Consider creating both debit and credit sides to maintain balance.
+    Prefer POST /journal-entries, which posts both sides as one balanced entry.
     
     Balance update rules:
     - ASSET/EXPENSE accounts: Debit increases, Credit decreases
@@ -6386,14 +9946,16 @@ async def create_transaction(transaction_data: dict, current_user: User = Depend
             detail="transaction_type must be either 'debit' or 'credit'"
         )
     
-    # Remove conflicting keys and add required fields
-    transaction_data_clean = {k: v for k, v in transaction_data.items() if k not in ['transaction_number', 'account_name', 'created_by']}
+    # Remove conflicting and server-owned keys (created_at drives back-dated
+    # corrections in the as-of and period snapshot replays) and add required fields
+    transaction_data_clean = {k: v for k, v in transaction_data.items() if k not in TRANSACTION_SERVER_FIELDS}
     transaction = Transaction(
         **transaction_data_clean,
         transaction_number=transaction_number,
         account_name=account['name'],
         created_by=current_user.id
     )
+    await ensure_period_open(transaction.date, "Transaction")
     
     await db.transactions.insert_one(transaction.model_dump())
     
@@ -6424,6 +9986,829 @@ async def create_transaction(transaction_data: dict, current_user: User = Depend
     return transaction
 
 
+# ============================================================================
+# JOURNAL ENTRIES (balanced double-entry postings)
+# ============================================================================
+# A journal entry holds N debit/credit lines that must balance. Every line is
+# written as a Transaction carrying journal_entry_id, so the account ledgers,
+# as-of balances and snapshots need no special handling. All lines go in with
+# one insert_many and all account balance changes with one ordered bulk_write;
+# if the bulk_write stops part-way, the applied $incs and the inserted lines
+# are reverted before the error is returned (MongoDB multi-document
+# transactions need a replica set, which this deployment does not require).
+
+JOURNAL_BALANCE_TOLERANCE = 0.0005  # Amounts are kept to 3 decimals (OMR)
+JOURNAL_MAX_LINES = 100
+
+async def post_journal_entry(
+    lines: List[Dict[str, Any]],
+    description: str,
+    user_id: str,
+    date: Optional[datetime] = None,
+    reference_type: Optional[str] = None,
+    reference_id: Optional[str] = None,
+    reversal_of: Optional[str] = None
+) -> JournalEntry:
+    """
+    Validate and post a balanced journal entry.
+    
+    Args:
+        lines: [{"account_id", "debit" | "credit", "memo", "party_id", "party_name"}]
+               - exactly one of debit/credit per line, greater than 0
+        description: Entry description (also used as transaction notes)
+        user_id: Acting user
+        date: Business date (defaults to now)
+        reference_type / reference_id: Optional source document
+        reversal_of: Id of the entry this one reverses
+    
+    Returns:
+        The posted JournalEntry
+    
+    Raises:
+        HTTPException 400 for unbalanced or malformed lines, 404 for unknown accounts
+    """
+    if len(lines) < 2:
+        raise HTTPException(status_code=400, detail="A journal entry needs at least two lines")
+    if len(lines) > JOURNAL_MAX_LINES:
+        raise HTTPException(status_code=400, detail=f"A journal entry can have at most {JOURNAL_MAX_LINES} lines")
+    if not description:
+        raise HTTPException(status_code=400, detail="Description is required")
+    if date is not None:
+        await ensure_period_open(date, "Journal entry")
+    
+    account_ids = list({line.get('account_id') for line in lines})
+    accounts = {a['id']: a for a in await db.accounts.find(
+        {"id": {"$in": account_ids}, "is_deleted": False}, {"_id": 0, "id": 1, "name": 1, "account_type": 1}
+    ).to_list(None)}
+    
+    normalized = []
+    for index, line in enumerate(lines, start=1):
+        account = accounts.get(line.get('account_id'))
+        if not account:
+            raise HTTPException(status_code=404, detail=f"Line {index}: account {line.get('account_id')} not found")
+        debit = round(float(line.get('debit') or 0), 3)
+        credit = round(float(line.get('credit') or 0), 3)
+        if debit < 0 or credit < 0 or (debit > 0) == (credit > 0):
+            raise HTTPException(status_code=400, detail=f"Line {index}: exactly one of debit or credit must be greater than 0")
+        normalized.append({
+            "account_id": account['id'],
+            "account_name": account['name'],
+            "account_type": account.get('account_type', 'asset'),
+            "debit": debit,
+            "credit": credit,
+            "memo": line.get('memo'),
+            "party_id": line.get('party_id'),
+            "party_name": line.get('party_name')
+        })
+    total_debit = round(sum(line['debit'] for line in normalized), 3)
+    total_credit = round(sum(line['credit'] for line in normalized), 3)
+    if abs(total_debit - total_credit) > JOURNAL_BALANCE_TOLERANCE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Journal entry is not balanced: debits {total_debit:.3f} != credits {total_credit:.3f}"
+        )
+    
+    date = date or datetime.now(timezone.utc)
+    year = date.year
+    entry_count = await db.journal_entries.count_documents({"entry_number": {"$regex": f"^JE-{year}"}})
+    txn_count = await db.transactions.count_documents({"transaction_number": {"$regex": f"^TXN-{year}"}})
+    entry_id = str(uuid.uuid4())
+    entry_number = f"JE-{year}-{str(entry_count + 1).zfill(4)}"
+    
+    transactions = []
+    increments: Dict[str, float] = {}
+    for offset, line in enumerate(normalized, start=1):
+        transaction_type = "debit" if line['debit'] > 0 else "credit"
+        amount = line['debit'] or line['credit']
+        txn = Transaction(
+            transaction_number=f"TXN-{year}-{str(txn_count + offset).zfill(4)}",
+            date=date,
+            transaction_type=transaction_type,
+            mode="journal",
+            account_id=line['account_id'],
+            account_name=line['account_name'],
+            party_id=line['party_id'],
+            party_name=line['party_name'],
+            amount=amount,
+            category="Journal Entry",
+            notes=f"{entry_number}: {line['memo'] or description}",
+            reference_type=reference_type,
+            reference_id=reference_id,
+            journal_entry_id=entry_id,
+            created_by=user_id
+        )
+        line['transaction_id'] = txn.id
+        transactions.append(txn)
+        delta = calculate_balance_delta(line['account_type'], transaction_type, amount)
+        increments[line['account_id']] = round(increments.get(line['account_id'], 0) + delta, 3)
+    
+    entry = JournalEntry(
+        id=entry_id,
+        entry_number=entry_number,
+        date=date,
+        description=description,
+        lines=[{k: v for k, v in line.items() if k not in ('party_id', 'party_name')} for line in normalized],
+        total_debit=total_debit,
+        total_credit=total_credit,
+        reference_type=reference_type,
+        reference_id=reference_id,
+        reversal_of=reversal_of,
+        created_by=user_id
+    )
+    
+    await db.transactions.insert_many([txn.model_dump() for txn in transactions])
+    balances_applied = False
+    try:
+        # Reverses its own partial writes if it fails part-way
+        await apply_account_increments(increments)
+        balances_applied = True
+        await db.journal_entries.insert_one(entry.model_dump())
+    except Exception as e:
+        if balances_applied:
+            await apply_account_increments({account_id: -delta for account_id, delta in increments.items()})
+        await db.transactions.delete_many({"journal_entry_id": entry_id})
+        logger.error(f"Journal entry {entry_number} failed and was rolled back: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to post journal entry. Nothing was recorded.")
+    return entry
+
+@api_router.post("/journal-entries", status_code=201)
+async def create_journal_entry(entry_data: dict, current_user: User = Depends(require_permission('finance.create'))):
+    """
+    Post a balanced journal entry.
+    
+    Body:
+        {
+            "date": "2024-05-01" (optional, ISO 8601),
+            "description": "Owner capital injection",
+            "reference_type": ..., "reference_id": ... (optional),
+            "lines": [
+                {"account_id": "<cash>", "debit": 1000, "memo": "..."},
+                {"account_id": "<capital>", "credit": 1000}
+            ]
+        }
+    """
+    date = None
+    if entry_data.get('date'):
+        try:
+            date = datetime.fromisoformat(str(entry_data['date']).replace('Z', '+00:00'))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format. Use ISO format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)")
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+    entry = await post_journal_entry(
+        entry_data.get('lines') or [],
+        entry_data.get('description'),
+        current_user.id,
+        date=date,
+        reference_type=entry_data.get('reference_type'),
+        reference_id=entry_data.get('reference_id')
+    )
+    await create_audit_log(
+        current_user.id, current_user.full_name, "journal_entry", entry.id, "create",
+        {"entry_number": entry.entry_number, "total": entry.total_debit, "lines": len(entry.lines)}
+    )
+    return entry
+
+@api_router.get("/journal-entries")
+async def get_journal_entries(
+    page: int = 1,
+    page_size: int = 20,
+    account_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    current_user: User = Depends(require_permission('finance.view'))
+):
+    """List journal entries, newest first (optionally touching one account / within a date range)."""
+    query: Dict[str, Any] = {"is_deleted": False}
+    if account_id:
+        query["lines.account_id"] = account_id
+    if date_from or date_to:
+        date_query = {}
+        if date_from:
+            try:
+                date_query['$gte'] = datetime.fromisoformat(date_from.replace('Z', '+00:00'))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid date_from format. Use ISO format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)")
+        if date_to:
+            date_query['$lte'] = parse_as_of(date_to)
+        query["date"] = date_query
+    skip = (page - 1) * page_size
+    total_count = await db.journal_entries.count_documents(query)
+    entries = await db.journal_entries.find(query, {"_id": 0}).sort([("date", -1), ("entry_number", -1)]).skip(skip).limit(page_size).to_list(page_size)
+    return MongoJSONResponse(create_pagination_response(entries, total_count, page, page_size))
+
+@api_router.get("/journal-entries/{entry_id}")
+async def get_journal_entry(entry_id: str, current_user: User = Depends(require_permission('finance.view'))):
+    entry = await db.journal_entries.find_one({"id": entry_id, "is_deleted": False}, {"_id": 0})
+    if not entry:
+        raise HTTPException(status_code=404, detail="Journal entry not found")
+    return MongoJSONResponse(entry)
+
+@api_router.post("/journal-entries/{entry_id}/reverse")
+async def reverse_journal_entry(entry_id: str, payload: Optional[dict] = None, current_user: User = Depends(require_permission('finance.create'))):
+    """
+    Reverse a posted entry by posting its mirror image (debits and credits
+    swapped). Posted entries are never edited or deleted.
+    """
+    original = await db.journal_entries.find_one({"id": entry_id, "is_deleted": False}, {"_id": 0})
+    if not original:
+        raise HTTPException(status_code=404, detail="Journal entry not found")
+    if original.get('status') == "reversed":
+        raise HTTPException(status_code=400, detail=f"Journal entry {original['entry_number']} is already reversed")
+    # Claim the reversal first so two concurrent calls cannot both reverse it
+    claim = await db.journal_entries.update_one(
+        {"id": entry_id, "status": "posted"},
+        {"$set": {"status": "reversed"}}
+    )
+    if claim.modified_count == 0:
+        raise HTTPException(status_code=409, detail="Journal entry is already being reversed")
+    
+    reason = (payload or {}).get('reason') or ""
+    try:
+        reversal = await post_journal_entry(
+            [{
+                "account_id": line['account_id'],
+                "debit": line.get('credit', 0),
+                "credit": line.get('debit', 0),
+                "memo": f"Reversal of {original['entry_number']}"
+            } for line in original['lines']],
+            f"Reversal of {original['entry_number']}: {original['description']} {reason}".strip(),
+            current_user.id,
+            reference_type=original.get('reference_type'),
+            reference_id=original.get('reference_id'),
+            reversal_of=entry_id
+        )
+    except HTTPException:
+        await db.journal_entries.update_one({"id": entry_id}, {"$set": {"status": "posted"}})
+        raise
+    await db.journal_entries.update_one({"id": entry_id}, {"$set": {"reversed_by": reversal.id}})
+    await create_audit_log(
+        current_user.id, current_user.full_name, "journal_entry", entry_id, "reverse",
+        {"entry_number": original['entry_number'], "reversal_entry": reversal.entry_number, "reason": reason}
+    )
+    return reversal
+
+# ============================================================================
+# FINANCIAL STATEMENTS (period-end snapshots)
+# ============================================================================
+# Trial balance, profit & loss and balance sheet are built from account
+# balances as of a date. Balances come from the latest month-end snapshot at
+# or before that date (account_period_snapshots: every account's balance at
+# the period end) plus ONE bounded aggregate over the transactions since:
+# - transactions dated after the snapshot cut (up to the date)
+# - back-dated transactions entered after the snapshot was taken
+# - snapshotted transactions deleted after the snapshot was taken
+# So a comparative report over several years reads a handful of snapshots
+# and never rescans the full history. Accounts are classified strictly by
+# account_type (asset/liability/equity/income/expense), never by name.
+
+def as_utc(moment: datetime) -> datetime:
+    """Mongo returns naive UTC datetimes; make them comparable with aware ones."""
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+def period_key(moment: datetime) -> str:
+    return moment.strftime("%Y-%m")
+
+def month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month_start(moment: datetime) -> datetime:
+    start = month_start(moment)
+    return start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+
+def period_end(moment: datetime) -> datetime:
+    """Last instant of the calendar month containing `moment`."""
+    return next_month_start(moment) - timedelta(microseconds=1)
+
+async def get_latest_period_snapshot(at_or_before: datetime) -> Optional[dict]:
+    return await db.account_period_snapshots.find_one(
+        {"period_end": {"$lte": at_or_before}}, {"_id": 0, "party_balances": 0, "stock_balances": 0}, sort=[("period_end", -1)]
+    )
+
+async def compute_balances_as_of(upto: datetime, snapshot: Optional[dict] = None, use_snapshot: bool = True) -> Dict[str, Any]:
+    """
+    Every account's balance as of `upto` (business date).
+    
+    Args:
+        upto: Cut-off (inclusive)
+        snapshot: Period snapshot to start from (looked up when not given)
+        use_snapshot: False forces a full replay from opening balances
+    
+    Returns:
+        {"balances": {account_id: balance}, "snapshot_period": str | None,
+         "replayed_transactions": int}
+    """
+    if snapshot is None and use_snapshot:
+        snapshot = await get_latest_period_snapshot(upto)
+    
+    if snapshot and snapshot.get('is_closed') and timedelta(0) <= upto - as_utc(snapshot['period_end']) < timedelta(milliseconds=1):
+        # A closed period cannot change: its stored balances are final
+        return {"balances": dict(snapshot['balances']), "snapshot_period": snapshot['period'], "replayed_transactions": 0}
+    
+    if snapshot:
+        cut, taken_at = snapshot['period_end'], snapshot['created_at']
+        match = {"$or": [
+            {"is_deleted": False, "date": {"$gt": cut, "$lte": upto}},
+            {"is_deleted": False, "date": {"$lte": cut}, "created_at": {"$gt": taken_at}},
+            {"is_deleted": True, "date": {"$lte": cut}, "created_at": {"$lte": taken_at}, "deleted_at": {"$gt": taken_at}}
+        ]}
+    else:
+        match = {"is_deleted": False, "date": {"$lte": upto}}
+    rows = await db.transactions.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"account_id": "$account_id", "type": "$transaction_type", "deleted": "$is_deleted"},
+            "amount": {"$sum": "$amount"},
+            "count": {"$sum": 1}
+        }}
+    ]).to_list(None)
+    
+    accounts = await account_ref_cache.all(include_deleted=True)
+    account_types = {a['id']: a.get('account_type', 'asset') for a in accounts}
+    base = (snapshot or {}).get('balances', {})
+    balances = {a['id']: base.get(a['id'], _to_float(a.get('opening_balance'))) for a in accounts}
+    replayed = 0
+    for row in rows:
+        account_id = row['_id'].get('account_id')
+        if account_id not in balances or row['_id'].get('type') not in ('debit', 'credit'):
+            continue
+        delta = calculate_balance_delta(account_types[account_id], row['_id']['type'], _to_float(row['amount']))
+        # A snapshotted transaction deleted since the snapshot is taken back out
+        balances[account_id] += -delta if row['_id'].get('deleted') else delta
+        replayed += row['count']
+    return {
+        "balances": {account_id: round(balance, 3) for account_id, balance in balances.items()},
+        "snapshot_period": snapshot['period'] if snapshot else None,
+        "replayed_transactions": replayed
+    }
+
+async def ensure_period_snapshots(created_by: str) -> List[dict]:
+    """
+    Create month-end snapshots for every fully elapsed month that has none,
+    oldest first, each built from the previous one plus that month's lines.
+    
+    Returns:
+        The snapshots created
+    """
+    last_complete_end = month_start(datetime.now(timezone.utc)) - timedelta(microseconds=1)
+    latest = await get_latest_period_snapshot(last_complete_end)
+    if latest:
+        next_period = next_month_start(as_utc(latest['period_end']))
+    else:
+        first = await db.transactions.find_one({"is_deleted": False}, {"_id": 0, "date": 1}, sort=[("date", 1)])
+        if not first:
+            return []
+        next_period = month_start(as_utc(first['date']))
+    
+    created = []
+    previous = latest
+    while next_period <= last_complete_end:
+        end = period_end(next_period)
+        result = await compute_balances_as_of(end, snapshot=previous, use_snapshot=previous is not None)
+        snapshot = {
+            "id": str(uuid.uuid4()),
+            "period": period_key(next_period),
+            "period_start": next_period,
+            "period_end": end,
+            "balances": result['balances'],
+            "previous_period": previous['period'] if previous else None,
+            "transactions_since_previous": result['replayed_transactions'],
+            "created_at": datetime.now(timezone.utc),
+            "created_by": created_by
+        }
+        try:
+            await db.account_period_snapshots.insert_one(dict(snapshot))
+        except DuplicateKeyError:
+            # Another worker built this period meanwhile - continue from its copy
+            snapshot = await db.account_period_snapshots.find_one({"period": snapshot['period']}, {"_id": 0})
+        else:
+            created.append(snapshot)
+        previous = snapshot
+        next_period = next_month_start(next_period)
+    return created
+
+def _statement_date(value: Optional[str], default: datetime) -> datetime:
+    return parse_as_of(value) if value else default
+
+def _comparative_dates(moment: datetime, compare_years: int) -> List[datetime]:
+    """The same calendar date in each of the previous `compare_years` years (Feb 29 -> Feb 28)."""
+    dates = [moment]
+    for years_back in range(1, compare_years + 1):
+        try:
+            dates.append(moment.replace(year=moment.year - years_back))
+        except ValueError:
+            dates.append(moment.replace(year=moment.year - years_back, day=28))
+    return dates
+
+async def _accounts_by_type() -> Dict[str, List[dict]]:
+    grouped: Dict[str, List[dict]] = {t: [] for t in VALID_ACCOUNT_TYPES}
+    for account in sorted(await account_ref_cache.all(include_deleted=True), key=lambda a: a.get('name', '')):
+        grouped.setdefault(account.get('account_type', 'asset').lower(), []).append(account)
+    return grouped
+
+MAX_COMPARE_YEARS = 10
+
+@api_router.post("/reports/period-snapshots")
+async def create_period_snapshots(current_user: User = Depends(require_permission('finance.create'))):
+    """Build missing month-end balance snapshots (normally run by the background task)"""
+    created = await ensure_period_snapshots(current_user.id)
+    return {"created": len(created), "periods": [snapshot['period'] for snapshot in created]}
+
+@api_router.get("/reports/period-snapshots")
+async def get_period_snapshots(current_user: User = Depends(require_permission('finance.view'))):
+    """List stored month-end snapshots (without the per-account balances)"""
+    snapshots = await db.account_period_snapshots.find(
+        {}, {"_id": 0, "balances": 0, "party_balances": 0, "stock_balances": 0}
+    ).sort("period_end", -1).to_list(None)
+    return MongoJSONResponse(snapshots)
+
+@api_router.get("/reports/trial-balance")
+async def get_trial_balance(as_of: Optional[str] = None, current_user: User = Depends(require_permission('finance.view'))):
+    """
+    Trial balance as of a date (default: now).
+    
+    Each account's balance is shown in the debit or credit column by its
+    normal side (a negative balance moves to the opposite column). The two
+    columns must total the same; a difference points at single-sided legacy
+    transactions, since journal entries are always balanced.
+    
+    Args:
+        as_of: Optional cut-off (YYYY-MM-DD = end of that day, or ISO 8601)
+    """
+    upto = _statement_date(as_of, datetime.now(timezone.utc))
+    result = await compute_balances_as_of(upto)
+    lines = []
+    total_debit = total_credit = 0.0
+    for account_type, accounts in (await _accounts_by_type()).items():
+        normal_side = get_normal_balance(account_type)
+        for account in accounts:
+            balance = result['balances'].get(account['id'], 0.0)
+            if not balance:
+                continue
+            on_normal_side = balance >= 0
+            debit = abs(balance) if (normal_side == 'debit') == on_normal_side else 0.0
+            credit = abs(balance) if not debit else 0.0
+            total_debit += debit
+            total_credit += credit
+            lines.append({
+                "account_id": account['id'],
+                "account_name": account.get('name'),
+                "account_type": account_type,
+                "balance": balance,
+                "debit": debit,
+                "credit": credit
+            })
+    difference = round(total_debit - total_credit, 3)
+    return {
+        "as_of": upto.isoformat(),
+        "accounts": lines,
+        "total_debit": round(total_debit, 3),
+        "total_credit": round(total_credit, 3),
+        "difference": difference,
+        "balanced": abs(difference) <= JOURNAL_BALANCE_TOLERANCE,
+        "snapshot_period": result['snapshot_period'],
+        "replayed_transactions": result['replayed_transactions']
+    }
+
+@api_router.get("/reports/profit-loss")
+async def get_profit_and_loss(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    compare_years: int = 0,
+    current_user: User = Depends(require_permission('finance.view'))
+):
+    """
+    Profit & loss for a date range (default: current month to date).
+    
+    Income and expense for the range are the change in each income/expense
+    account balance between the start and the end of the range, so every
+    column costs two snapshot-backed balance lookups.
+    
+    Args:
+        date_from / date_to: Range (YYYY-MM-DD or ISO 8601; date_to inclusive)
+        compare_years: Add the same range for up to 10 previous years
+    """
+    if not 0 <= compare_years <= MAX_COMPARE_YEARS:
+        raise HTTPException(status_code=400, detail=f"compare_years must be between 0 and {MAX_COMPARE_YEARS}")
+    now = datetime.now(timezone.utc)
+    end = _statement_date(date_to, now)
+    if date_from:
+        try:
+            start = datetime.fromisoformat(date_from.replace('Z', '+00:00'))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date_from format. Use ISO format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)")
+        start = start if start.tzinfo else start.replace(tzinfo=timezone.utc)
+    else:
+        start = month_start(end)
+    if start > end:
+        raise HTTPException(status_code=400, detail="date_from must be before date_to")
+    
+    grouped = await _accounts_by_type()
+    columns = []
+    for column_start, column_end in zip(_comparative_dates(start, compare_years), _comparative_dates(end, compare_years)):
+        opening = await compute_balances_as_of(column_start - timedelta(microseconds=1))
+        closing = await compute_balances_as_of(column_end)
+        sections = {}
+        for account_type in ("income", "expense"):
+            rows = []
+            for account in grouped.get(account_type, []):
+                amount = round(closing['balances'].get(account['id'], 0.0) - opening['balances'].get(account['id'], 0.0), 3)
+                if amount:
+                    rows.append({"account_id": account['id'], "account_name": account.get('name'), "amount": amount})
+            sections[account_type] = {"accounts": rows, "total": round(sum(r['amount'] for r in rows), 3)}
+        columns.append({
+            "date_from": column_start.isoformat(),
+            "date_to": column_end.isoformat(),
+            "income": sections["income"],
+            "expenses": sections["expense"],
+            "net_profit": round(sections["income"]["total"] - sections["expense"]["total"], 3),
+            "snapshot_periods": [opening['snapshot_period'], closing['snapshot_period']],
+            "replayed_transactions": opening['replayed_transactions'] + closing['replayed_transactions']
+        })
+    return {"columns": columns}
+
+@api_router.get("/reports/balance-sheet")
+async def get_balance_sheet(
+    as_of: Optional[str] = None,
+    compare_years: int = 0,
+    current_user: User = Depends(require_permission('finance.view'))
+):
+    """
+    Balance sheet as of a date (default: now), optionally with the same date
+    in up to 10 previous years.
+    
+    Equity includes current earnings (cumulative income - expenses) so that
+    assets = liabilities + equity when the books balance.
+    """
+    if not 0 <= compare_years <= MAX_COMPARE_YEARS:
+        raise HTTPException(status_code=400, detail=f"compare_years must be between 0 and {MAX_COMPARE_YEARS}")
+    upto = _statement_date(as_of, datetime.now(timezone.utc))
+    grouped = await _accounts_by_type()
+    columns = []
+    for column_date in _comparative_dates(upto, compare_years):
+        result = await compute_balances_as_of(column_date)
+        balances = result['balances']
+        
+        def section(account_type: str) -> Dict[str, Any]:
+            rows = [
+                {"account_id": a['id'], "account_name": a.get('name'), "amount": balances.get(a['id'], 0.0)}
+                for a in grouped.get(account_type, []) if balances.get(a['id'], 0.0)
+            ]
+            return {"accounts": rows, "total": round(sum(r['amount'] for r in rows), 3)}
+        
+        assets, liabilities, equity = section("asset"), section("liability"), section("equity")
+        current_earnings = round(section("income")["total"] - section("expense")["total"], 3)
+        total_equity = round(equity["total"] + current_earnings, 3)
+        difference = round(assets["total"] - liabilities["total"] - total_equity, 3)
+        columns.append({
+            "as_of": column_date.isoformat(),
+            "assets": assets,
+            "liabilities": liabilities,
+            "equity": {**equity, "current_earnings": current_earnings, "total": total_equity},
+            "total_liabilities_and_equity": round(liabilities["total"] + total_equity, 3),
+            "difference": difference,
+            "balanced": abs(difference) <= JOURNAL_BALANCE_TOLERANCE,
+            "snapshot_period": result['snapshot_period'],
+            "replayed_transactions": result['replayed_transactions']
+        })
+    return {"columns": columns}
+
+
+# ============================================================================
+# PERIOD CLOSE
+# ============================================================================
+# Closing a month freezes its month-end snapshot: account balances are
+# recomputed one last time (picking up any back-dated entries), and party
+# (gold + money) and stock balances at the period end are stored alongside.
+# From then on every write dated on or before the end of the latest closed
+# period is rejected (see ensure_period_open), so closed balances - and any
+# report built from them - never change and can be cached indefinitely.
+# Periods close in order; only the latest closed period can be reopened.
+
+async def get_closed_through() -> Optional[dict]:
+    """The latest closed period (without its balances), or None."""
+    return await db.account_period_snapshots.find_one(
+        {"is_closed": True},
+        {"_id": 0, "balances": 0, "party_balances": 0, "stock_balances": 0},
+        sort=[("period_end", -1)]
+    )
+
+async def ensure_period_open(date: Any, action: str = "Entry"):
+    """
+    Reject a write dated inside a closed period.
+    
+    Args:
+        date: Business date of the write (datetime or ISO string)
+        action: What is being written, for the error message
+    
+    Raises:
+        HTTPException 409 if the date is on or before the end of the latest closed period
+    """
+    if isinstance(date, str):
+        try:
+            date = datetime.fromisoformat(date.replace('Z', '+00:00'))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format. Use ISO format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)")
+    if not isinstance(date, datetime):
+        return
+    closed = await get_closed_through()
+    if closed and as_utc(date) <= as_utc(closed['period_end']):
+        raise HTTPException(
+            status_code=409,
+            detail=f"{action} dated {as_utc(date).date().isoformat()} falls in closed period {closed['period']}. "
+                   f"Date it after {as_utc(closed['period_end']).date().isoformat()} or reopen the period."
+        )
+
+def parse_period(period: str) -> datetime:
+    """Start of a YYYY-MM period (UTC)."""
+    try:
+        return datetime.strptime(period, "%Y-%m").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid period '{period}'. Use YYYY-MM.")
+
+async def compute_party_balances_as_of(upto: datetime) -> Dict[str, Dict[str, float]]:
+    """
+    Per-party balances at a period end: net gold (IN - OUT) from the gold
+    ledger, plus outstanding receivables/payables of documents dated in or
+    before the period (as they stand at close time).
+    """
+    balances: Dict[str, Dict[str, float]] = {}
+    def party(party_id: str) -> Dict[str, float]:
+        return balances.setdefault(party_id, {"gold_balance": 0.0, "receivable": 0.0, "payable": 0.0})
+    
+    gold = await db.gold_ledger.aggregate([
+        {"$match": {"is_deleted": False, "date": {"$lte": upto}}},
+        {"$group": {
+            "_id": "$party_id",
+            "gold_in": {"$sum": {"$cond": [{"$eq": ["$type", "IN"]}, "$weight_grams", 0]}},
+            "gold_out": {"$sum": {"$cond": [{"$eq": ["$type", "OUT"]}, "$weight_grams", 0]}}
+        }}
+    ]).to_list(None)
+    for row in gold:
+        if row['_id']:
+            party(row['_id'])['gold_balance'] = round(_to_float(row['gold_in']) - _to_float(row['gold_out']), 3)
+    
+    receivables = await db.invoices.aggregate([
+        {"$match": {"is_deleted": False, "status": "finalized", "date": {"$lte": upto}, "customer_id": {"$ne": None}}},
+        {"$group": {"_id": "$customer_id", "balance_due": {"$sum": "$balance_due"}}}
+    ]).to_list(None)
+    for row in receivables:
+        party(row['_id'])['receivable'] = round(_to_float(row['balance_due']), 3)
+    
+    payables = await db.purchases.aggregate([
+        {"$match": {"is_deleted": False, "date": {"$lte": upto}, "vendor_party_id": {"$ne": None}}},
+        {"$group": {"_id": "$vendor_party_id", "balance_due": {"$sum": "$balance_due_money"}}}
+    ]).to_list(None)
+    for row in payables:
+        party(row['_id'])['payable'] = round(_to_float(row['balance_due']), 3)
+    return balances
+
+async def compute_stock_balances_as_of(upto: datetime) -> Dict[str, Dict[str, float]]:
+    """Per-header stock (qty/weight) at a period end, from stock checkpoints + movements."""
+    headers = await db.inventory_headers.find({"is_deleted": False}, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+    balances = {}
+    for header in headers:
+        stock = await get_stock_balance_as_of(header, upto)
+        balances[header['id']] = {"name": header['name'], "qty": stock['qty'], "weight": stock['weight']}
+    return balances
+
+@api_router.get("/accounting-periods")
+async def get_accounting_periods(current_user: User = Depends(require_permission('finance.view'))):
+    """List periods with a month-end snapshot and their close status, newest first."""
+    periods = await db.account_period_snapshots.find(
+        {}, {"_id": 0, "balances": 0, "party_balances": 0, "stock_balances": 0}
+    ).sort("period_end", -1).to_list(None)
+    closed = await get_closed_through()
+    return MongoJSONResponse({
+        "closed_through": closed['period'] if closed else None,
+        "periods": periods
+    })
+
+@api_router.get("/accounting-periods/{period}")
+async def get_accounting_period(period: str, current_user: User = Depends(require_permission('finance.view'))):
+    """A period's stored month-end account, party and stock balances."""
+    parse_period(period)
+    snapshot = await db.account_period_snapshots.find_one({"period": period}, {"_id": 0})
+    if not snapshot:
+        raise HTTPException(status_code=404, detail=f"No snapshot for period {period}")
+    return MongoJSONResponse(snapshot)
+
+@api_router.post("/accounting-periods/{period}/close")
+async def close_accounting_period(period: str, current_user: User = Depends(require_permission('finance.close'))):
+    """
+    Close a month: lock writes dated in it and store final account, party and
+    stock balances at its end.
+    
+    The period must be over and the previous closed period (if any) must be
+    the month before it. The lock is claimed before the balances are computed,
+    so no dated write can slip in between.
+    """
+    start = parse_period(period)
+    end = period_end(start)
+    if end >= datetime.now(timezone.utc):
+        raise HTTPException(status_code=400, detail=f"Period {period} has not ended yet")
+    closed = await get_closed_through()
+    if closed:
+        if as_utc(closed['period_end']) >= end:
+            raise HTTPException(status_code=400, detail=f"Period {period} is already closed (closed through {closed['period']})")
+        expected = period_key(next_month_start(as_utc(closed['period_end'])))
+        if expected != period:
+            raise HTTPException(status_code=400, detail=f"Periods close in order: close {expected} first")
+    
+    await ensure_period_snapshots(current_user.id)
+    snapshot = await db.account_period_snapshots.find_one(
+        {"period": period}, {"_id": 0, "party_balances": 0, "stock_balances": 0}
+    )
+    if not snapshot:
+        # No transactions up to this period yet, so nothing was snapshotted
+        snapshot = {
+            "id": str(uuid.uuid4()),
+            "period": period,
+            "period_start": start,
+            "period_end": end,
+            "balances": {},
+            "previous_period": None,
+            "transactions_since_previous": 0,
+            "created_at": datetime.now(timezone.utc),
+            "created_by": current_user.id
+        }
+        try:
+            await db.account_period_snapshots.insert_one(dict(snapshot))
+        except DuplicateKeyError:
+            snapshot = await db.account_period_snapshots.find_one({"period": period}, {"_id": 0, "party_balances": 0, "stock_balances": 0})
+    
+    # Claim the lock first: from here on ensure_period_open rejects writes in the period
+    claim = await db.account_period_snapshots.update_one(
+        {"id": snapshot['id'], "is_closed": {"$ne": True}},
+        {"$set": {"is_closed": True, "closed_at": datetime.now(timezone.utc), "closed_by": current_user.id}}
+    )
+    if claim.modified_count == 0:
+        raise HTTPException(status_code=409, detail=f"Period {period} is already being closed")
+    
+    try:
+        taken_at = datetime.now(timezone.utc)
+        accounts = await compute_balances_as_of(end, snapshot=snapshot)
+        party_balances = await compute_party_balances_as_of(end)
+        stock_balances = await compute_stock_balances_as_of(end)
+        await db.account_period_snapshots.update_one(
+            {"id": snapshot['id']},
+            {"$set": {
+                "balances": accounts['balances'],
+                "party_balances": party_balances,
+                "stock_balances": stock_balances,
+                # Re-based: corrections before this moment are now inside the balances
+                "created_at": taken_at
+            }}
+        )
+    except Exception:
+        await db.account_period_snapshots.update_one(
+            {"id": snapshot['id']},
+            {"$set": {"is_closed": False}, "$unset": {"closed_at": "", "closed_by": ""}}
+        )
+        raise
+    
+    await create_audit_log(
+        current_user.id, current_user.full_name, "accounting_period", snapshot['id'], "close",
+        {"period": period, "corrections_applied": accounts['replayed_transactions'],
+         "parties": len(party_balances), "stock_headers": len(stock_balances)}
+    )
+    return {
+        "message": f"Period {period} closed",
+        "period": period,
+        "period_end": end.isoformat(),
+        "accounts": len(accounts['balances']),
+        "parties": len(party_balances),
+        "stock_headers": len(stock_balances),
+        "corrections_applied": accounts['replayed_transactions']
+    }
+
+@api_router.post("/accounting-periods/{period}/reopen")
+async def reopen_accounting_period(period: str, payload: Optional[dict] = None, current_user: User = Depends(require_permission('finance.close'))):
+    """Reopen the latest closed period so dated corrections can be posted again."""
+    parse_period(period)
+    closed = await get_closed_through()
+    if not closed or closed['period'] != period:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Only the latest closed period ({closed['period'] if closed else 'none'}) can be reopened"
+        )
+    reason = (payload or {}).get('reason')
+    if not reason:
+        raise HTTPException(status_code=400, detail="A reason is required to reopen a period")
+    await db.account_period_snapshots.update_one(
+        {"id": closed['id']},
+        {
+            "$set": {"is_closed": False, "reopened_at": datetime.now(timezone.utc), "reopened_by": current_user.id},
+            "$unset": {"closed_at": "", "closed_by": ""}
+        }
+    )
+    await create_audit_log(
+        current_user.id, current_user.full_name, "accounting_period", closed['id'], "reopen",
+        {"period": period, "reason": reason}
+    )
+    return {"message": f"Period {period} reopened", "period": period}
+
+
 @api_router.get("/transactions/summary")
 async def get_transactions_summary(
     start_date: Optional[str] = None,
@@ -6501,7 +10886,7 @@ async def get_transactions_summary(
         
         # Get accounts to determine cash vs bank
         try:
-            accounts = await db.accounts.find({"is_deleted": False}, {"_id": 0}).to_list(1000)
+            accounts = await account_ref_cache.all()
             account_types = {acc['id']: acc.get('account_type', 'unknown') for acc in accounts if 'id' in acc}
             # FIX: Also get account names to properly identify cash/bank accounts
             account_names = {acc['id']: acc.get('name', '').lower() for acc in accounts if 'id' in acc}
@@ -6624,6 +11009,7 @@ async def create_daily_closing(closing_data: dict, current_user: User = Depends(
             target_date = closing_date
         else:
             raise ValueError("Invalid date format")
+        await ensure_period_open(target_date, "Daily closing")
         
         # Check if we need to auto-calculate fields
         needs_calculation = (
@@ -6678,6 +11064,8 @@ async def create_daily_closing(closing_data: dict, current_user: User = Depends(
         await create_audit_log(current_user.id, current_user.full_name, "daily_closing", closing.id, "create")
         return closing
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to create daily closing: {str(e)}")
 
@@ -7640,13 +12028,24 @@ async def get_inventory_stock_report(
     header_id: str,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    as_of: Optional[str] = None,
     current_user: User = Depends(require_permission('reports.view'))
 ):
-    """Get detailed stock report for a specific inventory category"""
+    """
+    Get detailed stock report for a specific inventory category.
+    
+    as_of (YYYY-MM-DD or ISO timestamp): also return the stock balance as of that
+    date, served from the latest stock checkpoint plus a bounded movement replay.
+    Movements are then limited to that date unless end_date is given.
+    """
     header = await db.inventory_headers.find_one({"id": header_id, "is_deleted": False}, {"_id": 0})
     if not header:
         raise HTTPException(status_code=404, detail="Inventory category not found")
     
+    as_of_dt = parse_as_of(as_of) if as_of else None
+    if as_of_dt and not end_date:
+        end_date = as_of_dt.isoformat()
+    
     # Build query for movements
     query = {"header_id": header_id, "is_deleted": False}
     if start_date:
@@ -7669,7 +12068,7 @@ async def get_inventory_stock_report(
     total_weight_out = sum(abs(m.get('weight_delta', 0)) for m in movements if m.get('weight_delta', 0) < 0)
     current_weight = total_weight_in - total_weight_out
     
-    return {
+    report = {
         "header": header,
         "movements": movements,
         "summary": {
@@ -7682,6 +12081,9 @@ async def get_inventory_stock_report(
         },
         "count": len(movements)
     }
+    if as_of_dt:
+        report["balance_as_of"] = await get_stock_balance_as_of(header, as_of_dt)
+    return report
 
 @api_router.get("/reports/financial-summary")
 async def get_financial_summary(
@@ -7728,7 +12130,7 @@ async def get_financial_summary(
     
     # Get data from database
     transactions = await db.transactions.find(txn_query, {"_id": 0}).to_list(10000)
-    accounts = await db.accounts.find({"is_deleted": False}, {"_id": 0}).to_list(1000)
+    accounts = await get_accounts_with_balances()
     invoices = await db.invoices.find(invoice_query, {"_id": 0}).to_list(10000)
     
     # ============================================================================
@@ -9774,6 +14176,21 @@ async def health_check(request: Request):
             detail=f"Service unhealthy: {str(e)}"
         )
 
+@api_router.get("/system/cache-stats")
+async def get_cache_stats(current_user: User = Depends(require_permission('users.view'))):
+    """Hit/miss statistics for the in-process reference data caches"""
+    return {
+        "caches": [cache.stats() for cache in REFERENCE_CACHES],
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+@api_router.post("/system/cache-stats/reset")
+async def reset_reference_caches(current_user: User = Depends(require_permission('users.update'))):
+    """Force a reload of all reference data caches (e.g. after a direct database edit)"""
+    for cache in REFERENCE_CACHES:
+        cache.invalidate()
+    return {"message": "Reference caches invalidated"}
+
 
 # ========================================
 # WORKFLOW CONTROL - IMPACT SUMMARY ENDPOINTS
@@ -10107,6 +14524,7 @@ async def delete_transaction(
     ACCOUNTING RULES:
     - Can only delete transactions NOT linked to invoices (manual transactions)
     - Invoice payment transactions should not be deleted directly
+    - Journal entry lines cannot be deleted one by one - reverse the entry
     - Reverses the account balance change when deleted
     - Soft delete with audit trail
     """
@@ -10121,6 +14539,14 @@ async def delete_transaction(
             status_code=400,
             detail="Cannot delete invoice payment transactions. Delete the invoice or payment record instead."
         )
+    # Posted journal entries are immutable - deleting one line would unbalance the entry
+    if transaction.get("journal_entry_id"):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Transaction is a line of journal entry {transaction['journal_entry_id']}. "
+                   f"Use POST /api/journal-entries/{transaction['journal_entry_id']}/reverse instead."
+        )
+    await ensure_period_open(transaction.get('date'), "Transaction")
     
     # Get transaction details for balance reversal
     account_id = transaction.get('account_id')
@@ -10405,12 +14831,15 @@ async def get_returns(
     status: Optional[str] = None,
     refund_mode: Optional[str] = None,
     search: Optional[str] = None,
+    fields: str = "summary",
     current_user: User = Depends(require_permission('returns.view'))
 ):
     """
     Get all returns with pagination and filters.
     Filters: return_type, party_id, status, refund_mode, search
+    fields: summary (default, no items array) | full
     """
+    projection = list_projection("returns", fields)
     try:
         # Build query
         query = {"is_deleted": False}
@@ -10439,11 +14868,11 @@ async def get_returns(
         total_pages = (total_count + page_size - 1) // page_size
         
         # Fetch returns
-        cursor = db.returns.find(query).sort("created_at", -1).skip(skip).limit(page_size)
+        cursor = db.returns.find(query, projection).sort("created_at", -1).skip(skip).limit(page_size)
         returns = await cursor.to_list(length=page_size)
         
-        return {
-            "items": [decimal_to_float(ret) for ret in returns],
+        return MongoJSONResponse({
+            "items": returns,
             "pagination": {
                 "total_count": total_count,
                 "page": page,
@@ -10452,7 +14881,7 @@ async def get_returns(
                 "has_next": page < total_pages,
                 "has_prev": page > 1
             }
-        }
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching returns: {str(e)}")
@@ -10462,14 +14891,24 @@ async def get_returns(
 @limiter.limit("1000/hour")
 async def get_return_by_id(
     request: Request,
+    response: Response,
     return_id: str,
     current_user: User = Depends(require_permission('returns.view'))
 ):
     """Get a single return by ID"""
+    # Finalized returns are never modified again (only soft-deleted)
+    not_modified = await check_not_modified(
+        request, db.returns, return_id, RETURN_VERSION_FIELDS, "return", CACHE_CONTROL_IMMUTABLE
+    )
+    if not_modified:
+        return not_modified
+    
     return_doc = await db.returns.find_one({"id": return_id, "is_deleted": False})
     if not return_doc:
         raise HTTPException(status_code=404, detail="Return not found")
     
+    etag = build_document_etag(return_doc, RETURN_VERSION_FIELDS, "return")
+    apply_cache_headers(response, etag, CACHE_CONTROL_IMMUTABLE if etag else CACHE_CONTROL_DRAFT)
     return decimal_to_float(return_doc)
 
 
@@ -10680,6 +15119,7 @@ async def finalize_return(
         stock_movement_ids = []
         transaction_id = None
         gold_ledger_id = None
+        counters_applied = False
         
         # ========================================================================
         # SALES RETURN WORKFLOW
@@ -10696,10 +15136,12 @@ async def finalize_return(
                     qty = float(qty.to_decimal())
                 
                 if weight_grams > 0:
+                    header = await resolve_inventory_header(item.get('description'))
                     movement_id = str(uuid.uuid4())
                     stock_movement = StockMovement(
                         id=movement_id,
                         movement_type="IN",  # FIXED: Use correct field name
+                        header_id=header['id'] if header else None,
                         header_name=item.get('description'),  # FIXED: Use correct field name
                         qty_delta=round(qty, 0),  # FIXED: Use correct field name
                         weight_delta=round(weight_grams, 3),  # FIXED: Use correct field name
@@ -10713,16 +15155,9 @@ async def finalize_return(
                     await db.stock_movements.insert_one(stock_movement.model_dump())
                     stock_movement_ids.append(movement_id)
                     
-                    # Update inventory header stock
-                    await db.inventory_headers.update_one(
-                        {"name": item.get('description')},
-                        {
-                            "$inc": {
-                                "current_qty": qty,
-                                "current_weight": round(weight_grams, 3)
-                            }
-                        }
-                    )
+                    # Update inventory header stock (unguarded increment)
+                    if header:
+                        await apply_stock_delta(header['id'], qty, round(weight_grams, 3))
             
             # 2. Create money refund transactions
             if refund_mode in ['money', 'mixed'] and refund_money_amount > 0:
@@ -10857,7 +15292,10 @@ async def finalize_return(
         # PURCHASE RETURN WORKFLOW
         # ========================================================================
         elif return_type == 'purchase_return':
-            # 1. Create stock movements (Stock OUT - returned to vendor)
+            # 1a. Guarded atomic stock decrements first (all-or-nothing) so a
+            # concurrent sale cannot be oversold by goods going back to the vendor
+            return_items = []
+            stock_lines = []
             for item in return_doc.get('items', []):
                 weight_grams = item.get('weight_grams', 0)
                 qty = item.get('qty', 0)
@@ -10866,12 +15304,34 @@ async def finalize_return(
                     weight_grams = float(weight_grams.to_decimal())
                 if isinstance(qty, Decimal128):
                     qty = float(qty.to_decimal())
+                return_items.append((item, qty, weight_grams))
                 
+                if weight_grams > 0:
+                    header = await resolve_inventory_header(item.get('description'))
+                    if header:
+                        stock_lines.append({
+                            "header_id": header['id'],
+                            "label": item.get('description'),
+                            "qty": qty,
+                            "weight": round(weight_grams, 3)
+                        })
+            
+            _, stock_shortfalls = await decrement_stock_lines(stock_lines)
+            if stock_shortfalls:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Insufficient stock for purchase return: {'; '.join(stock_shortfalls)}"
+                )
+            
+            # 1b. Create stock movements (Stock OUT - returned to vendor)
+            header_ids = {line['label']: line['header_id'] for line in stock_lines}
+            for item, qty, weight_grams in return_items:
                 if weight_grams > 0:
                     movement_id = str(uuid.uuid4())
                     stock_movement = StockMovement(
                         id=movement_id,
                         movement_type="OUT",  # FIXED: Use correct field name
+                        header_id=header_ids.get(item.get('description')),
                         header_name=item.get('description'),  # FIXED: Use correct field name
                         qty_delta=-round(qty, 0),  # FIXED: Use correct field name (negative for OUT)
                         weight_delta=-round(weight_grams, 3),  # FIXED: Use correct field name (negative for OUT)
@@ -10884,17 +15344,7 @@ async def finalize_return(
                     )
                     await db.stock_movements.insert_one(stock_movement.model_dump())
                     stock_movement_ids.append(movement_id)
-                    
-                    # Update inventory header stock (decrease)
-                    await db.inventory_headers.update_one(
-                        {"name": item.get('description')},
-                        {
-                            "$inc": {
-                                "current_qty": -qty,
-                                "current_weight": -round(weight_grams, 3)
-                            }
-                        }
-                    )
+                    # Inventory header already decreased in step 1a
             
             # 2. Create money refund (Transaction - Credit - vendor refunds us)
             if refund_mode in ['money', 'mixed'] and refund_money_amount > 0:
@@ -10975,6 +15425,11 @@ async def finalize_return(
                         {"$set": {"outstanding_balance": round(new_outstanding, 2)}}
                     )
         
+        # ========================================================================
+        # RETURNED COUNTERS ON THE INVOICE / PURCHASE (single $inc)
+        # ========================================================================
+        counters_applied = await apply_return_counters(return_doc)
+        
         # ========================================================================
         # UPDATE RETURN STATUS TO FINALIZED
         # ========================================================================
@@ -11074,6 +15529,10 @@ async def finalize_return(
             if gold_ledger_id:
                 await db.gold_ledger.delete_one({"id": gold_ledger_id})
             
+            # 4a. Reverse the returned counters on the invoice/purchase
+            if counters_applied:
+                await apply_return_counters(return_doc, sign=-1)
+            
             # 5. Revert inventory header changes
             return_doc = await db.returns.find_one({"id": return_id})
             if return_doc:
@@ -11084,28 +15543,16 @@ async def finalize_return(
                         qty_change = item.get('qty', 0)
                         weight_change = round(item.get('weight_grams'), 3)
                         
-                        if return_type == 'sale_return':
-                            # We added stock, now subtract it back
-                            await db.inventory_headers.update_one(
-                                {"name": item.get('description')},
-                                {
-                                    "$inc": {
-                                        "current_qty": -qty_change,
-                                        "current_weight": -weight_change
-                                    }
-                                }
-                            )
-                        else:  # purchase_return
-                            # We removed stock, now add it back
-                            await db.inventory_headers.update_one(
-                                {"name": item.get('description')},
-                                {
-                                    "$inc": {
-                                        "current_qty": qty_change,
-                                        "current_weight": weight_change
-                                    }
-                                }
-                            )
+                        header = await resolve_inventory_header(item.get('description'))
+                        if not header:
+                            continue
+                        # sale_return: we added stock, subtract it back (unguarded);
+                        # purchase_return: we removed stock, add it back
+                        sign = -1 if return_type == 'sale_return' else 1
+                        await db.inventory_headers.update_one(
+                            {"id": header['id']},
+                            {"$inc": {"current_qty": sign * qty_change, "current_weight": sign * weight_change}, "$set": stock_stamp()}
+                        )
             
             # 6. Create audit log for rollback
             await create_audit_log(
@@ -11141,6 +15588,8 @@ async def delete_return(
 ):
     """
     Soft delete a return (only allowed in draft status).
+    Drafts are never part of the returned counters, so the invoice/purchase
+    counters are left untouched.
     """
     try:
         # Fetch return
@@ -11268,14 +15717,25 @@ app.include_router(api_router)
 # app.add_middleware(SecurityHeadersMiddleware)
 
 # 3. Input Sanitization
-# temporarily disabling the Input Sanitization middleware
-# app.add_middleware(InputSanitizationMiddleware)
+# No middleware - handled per field by the SafeStr annotations on the models
 
 # 4. CSRF Protection
 # (You can comment this out if you still have issues, but moving it 'above' CORS usually fixes it)
 # app.add_middleware(CSRFProtectionMiddleware)
 
-# 5. CORS Middleware (MUST BE LAST/OUTERMOST)
+# 5. Idempotency-Key replay for payment / finalize endpoints (inside compression,
+#    so stored responses are uncompressed)
+app.add_middleware(IdempotencyMiddleware)
+
+# 6. Response Compression (gzip/brotli, negotiated via Accept-Encoding)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.environ.get('COMPRESSION_MIN_SIZE', '1024')),
+    gzip_level=int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6')),
+    brotli_quality=int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4')),
+)
+
+# 7. CORS Middleware (MUST BE LAST/OUTERMOST)
 # This ensures CORS headers are added to ALL responses, even 403 errors.
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -11305,6 +15765,72 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ============================================================================
+# DATABASE INDEXES
+# ============================================================================
+# (collection, keys, options) - created idempotently on startup
+
+INDEX_SPECS = [
+    # Stock ledger replay (checkpoints / reconciliation)
+    ("stock_movements", [("header_id", 1), ("created_at", 1), ("id", 1)], {}),
+    ("stock_movements", [("header_name", 1), ("created_at", 1)], {}),
+    ("stock_checkpoints", [("header_id", 1), ("as_of", -1)], {}),
+    # As-of account balances
+    ("transactions", [("account_id", 1), ("date", 1)], {}),
+    ("account_balance_snapshots", [("account_id", 1), ("as_of", -1)], {}),
+    # GET /inventory: equality, then the sort keys (current_weight desc, id),
+    # then current_qty so the min_qty range is filtered from the index without
+    # breaking the sort order (ESR)
+    ("inventory_headers", [("is_deleted", 1), ("current_weight", -1), ("id", 1), ("current_qty", 1)], {"collation": CASE_INSENSITIVE_COLLATION}),
+    ("inventory_headers", [("name", 1)], {"collation": CASE_INSENSITIVE_COLLATION}),
+    # Draft-invoice stock reservations: TTL expiry + available-to-sell sums
+    ("stock_reservations", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("stock_reservations", [("header_id", 1), ("expires_at", 1)], {}),
+    ("stock_reservations", [("invoice_id", 1)], {}),
+    # Tagged pieces: O(1) scan lookup + per-header listing
+    ("stock_items", [("tag", 1)], {"unique": True}),
+    ("stock_items", [("header_id", 1), ("status", 1)], {}),
+    # Invoice detail aggregate ($lookup by reference)
+    ("transactions", [("reference_id", 1)], {}),
+    ("returns", [("reference_id", 1)], {}),
+    # Party receipts / vendor payments: open documents of a party, oldest first
+    # (equality fields, then the sort field, then the balance range)
+    ("invoices", [("customer_id", 1), ("status", 1), ("date", 1), ("balance_due", 1)], {}),
+    ("purchases", [("vendor_party_id", 1), ("date", 1), ("balance_due_money", 1)], {}),
+    # Idempotency-Key records expire after IDEMPOTENCY_KEY_TTL_HOURS
+    ("idempotency_keys", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    # Journal entries + trial balance aggregate
+    ("transactions", [("journal_entry_id", 1)], {"sparse": True}),
+    ("transactions", [("date", 1), ("account_id", 1)], {}),
+    ("journal_entries", [("date", -1), ("entry_number", -1)], {}),
+    ("journal_entries", [("lines.account_id", 1), ("date", -1)], {}),
+    # Financial statements: one month-end snapshot per period
+    ("account_period_snapshots", [("period", 1)], {"unique": True}),
+    ("account_period_snapshots", [("period_end", -1)], {}),
+    ("account_period_snapshots", [("is_closed", 1), ("period_end", -1)], {}),
+    ("transactions", [("is_deleted", 1), ("deleted_at", 1)], {}),
+]
+
+# (collection, keys) - superseded indexes dropped on startup
+OBSOLETE_INDEX_SPECS = [
+    ("inventory_headers", [("is_deleted", 1), ("current_weight", -1)]),
+    ("inventory_headers", [("is_deleted", 1), ("current_qty", 1), ("current_weight", -1)]),
+]
+
+async def ensure_indexes():
+    for collection, keys, options in INDEX_SPECS:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            logger.warning(f"Index creation failed on {collection} {keys}: {e}")
+    for collection, keys in OBSOLETE_INDEX_SPECS:
+        name = "_".join(f"{field}_{direction}" for field, direction in keys)
+        try:
+            if name in await db[collection].index_information():
+                await db[collection].drop_index(name)
+        except Exception as e:
+            logger.warning(f"Dropping obsolete index {name} on {collection} failed: {e}")
+
 @app.on_event("startup")
 async def startup_db_init():
     """Initialize database with default users on startup"""
@@ -11313,7 +15839,14 @@ async def startup_db_init():
         await initialize_database()
     except Exception as e:
         logger.warning(f"Database initialization warning: {e}")
+    
+    await ensure_indexes()
+    
+    if STOCK_CHECKPOINT_INTERVAL_HOURS > 0:
+        app.state.stock_checkpoint_task = asyncio.create_task(stock_checkpoint_loop())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+    if _pdf_render_pool is not None:
+        _pdf_render_pool.shutdown(wait=False, cancel_futures=True)
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""
+Stock Concurrency Stress Check
+Drives the real endpoints concurrently against one inventory header, through
+the ASGI app in-process (no server needed):
+
+    POST /api/invoices/{id}/finalize   - draft sale invoices (Stock OUT)
+    POST /api/returns/{id}/finalize    - sales returns of sold pieces (Stock IN)
+
+The drafts are created while the shelf is full, their reservations are then
+expired and the shelf is cut below the number of drafts, so every finalize
+goes through the full reservation check and they race for the remaining
+pieces while returns put pieces back. It then verifies there is no drift:
+
+    final stock == stock at start - finalized + returned
+    final stock == stock at start + stock movements written during the run
+    final stock >= 0
+    0 < finalized <= stock at start + returned  (the race actually sold stock)
+
+SAFETY: it only runs against a dedicated, empty test database given with
+--db-name (name ending in _test or _stress, different from DB_NAME in .env),
+and drops that database afterwards. MONGO_URL still comes from .env.
+Requires httpx (ASGI transport, listed in requirements.txt).
+
+Usage:
+    python stress_stock_concurrency.py --db-name goldshop_stress [--invoices 100] [--returns 20] [--stock-qty 50] [--weight 2.5]
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from dotenv import dotenv_values
+
+ROOT_DIR = Path(__file__).parent
+HEADER_NAME = "Stress 22K"
+RATE = 25.0
+
+
+def check_database_name(db_name: str) -> str:
+    """Refuse anything that is not clearly a throwaway test database."""
+    if not re.fullmatch(r"[A-Za-z0-9_-]+_(test|stress)", db_name):
+        return "database name must end with _test or _stress"
+    if db_name == dotenv_values(ROOT_DIR / ".env").get("DB_NAME"):
+        return "database name must differ from DB_NAME in .env"
+    return ""
+
+
+def invoice_body(customer_id: str, weight: float) -> dict:
+    value = round(weight * RATE, 3)
+    return {
+        "customer_type": "saved",
+        "customer_id": customer_id,
+        "customer_name": "Stress Customer",
+        "invoice_type": "sale",
+        "items": [{
+            "category": HEADER_NAME,
+            "description": HEADER_NAME,
+            "qty": 1,
+            "weight": weight,
+            "net_gold_weight": weight,
+            "purity": 916,
+            "metal_rate": RATE,
+            "gold_value": value,
+            "making_value": 0.0,
+            "vat_percent": 0.0,
+            "vat_amount": 0.0,
+            "line_total": value,
+        }],
+        "subtotal": value,
+        "grand_total": value,
+        "balance_due": value,
+    }
+
+
+async def run(args) -> bool:
+    # server reads DB_NAME at import time (load_dotenv does not override it)
+    os.environ["DB_NAME"] = args.db_name
+    sys.path.insert(0, str(ROOT_DIR))
+    import httpx
+    import jwt
+    import server
+
+    db = server.db
+    if await db.list_collection_names():
+        print(f"❌ Refusing to run: database '{args.db_name}' is not empty")
+        return False
+
+    try:
+        await server.ensure_indexes()
+        user_id = str(uuid.uuid4())
+        await db.users.insert_one({
+            "id": user_id, "username": "stress-admin", "email": "stress@example.com",
+            "full_name": "Stress Admin", "role": "admin", "permissions": [],
+            "is_active": True, "is_deleted": False, "created_at": datetime.now(timezone.utc)
+        })
+        token = jwt.encode(
+            {"user_id": user_id, "exp": datetime.now(timezone.utc) + timedelta(hours=1)},
+            server.JWT_SECRET, algorithm=server.JWT_ALGORITHM
+        )
+        cash_id = str(uuid.uuid4())
+        await db.accounts.insert_one({
+            "id": cash_id, "name": "Stress Cash", "account_type": "asset", "opening_balance": 0,
+            "current_balance": 1_000_000, "created_at": datetime.now(timezone.utc),
+            "created_by": user_id, "is_deleted": False
+        })
+        customer_id = str(uuid.uuid4())
+        await db.parties.insert_one({
+            "id": customer_id, "name": "Stress Customer", "party_type": "customer",
+            "created_at": datetime.now(timezone.utc), "created_by": user_id, "is_deleted": False
+        })
+        header_id = str(uuid.uuid4())
+        setup_qty = args.invoices + args.returns
+        await db.inventory_headers.insert_one({
+            "id": header_id, "name": HEADER_NAME, "current_qty": setup_qty,
+            "current_weight": round(setup_qty * args.weight, 3), "is_active": True,
+            "created_at": datetime.now(timezone.utc), "created_by": user_id, "is_deleted": False
+        })
+
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://stress", headers={"Authorization": f"Bearer {token}"}, timeout=120
+        ) as client:
+            async def post(path: str, body: dict = None) -> httpx.Response:
+                return await client.post(path, json=body or {})
+
+            # Setup (sequential): sold invoices with draft returns, then the drafts to race
+            return_ids = []
+            for _ in range(args.returns):
+                created = await post("/api/invoices", invoice_body(customer_id, args.weight))
+                assert created.status_code == 200, created.text
+                invoice = created.json()
+                finalized = await post(f"/api/invoices/{invoice['id']}/finalize")
+                assert finalized.status_code == 200, finalized.text
+                created = await post("/api/returns", {
+                    "return_type": "sale_return", "reference_type": "invoice", "reference_id": invoice["id"],
+                    "items": [{"description": HEADER_NAME, "qty": 1, "weight_grams": args.weight,
+                               "purity": 916, "amount": round(args.weight * RATE, 2)}],
+                    "refund_mode": "money", "refund_money_amount": round(args.weight * RATE, 2),
+                    "account_id": cash_id, "payment_mode": "cash", "reason": "stress"
+                })
+                assert created.status_code == 201, created.text
+                return_ids.append(created.json()["return"]["id"])
+            draft_ids = []
+            for _ in range(args.invoices):
+                created = await post("/api/invoices", invoice_body(customer_id, args.weight))
+                assert created.status_code == 200, created.text
+                draft_ids.append(created.json()["id"])
+
+            # Expire the drafts' reservations (as if their TTL had passed), then cut
+            # the shelf below the number of drafts so finalizations contend
+            await db.stock_reservations.update_many(
+                {"invoice_id": {"$in": draft_ids}},
+                {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+            )
+            start_qty = args.stock_qty
+            start_weight = round(args.stock_qty * args.weight, 3)
+            await db.inventory_headers.update_one(
+                {"id": header_id}, {"$set": {"current_qty": start_qty, "current_weight": start_weight}}
+            )
+            run_started = datetime.now(timezone.utc)
+
+            async def finalize_invoice(invoice_id):
+                return ("invoice", (await post(f"/api/invoices/{invoice_id}/finalize")).status_code)
+
+            async def finalize_return(return_id):
+                return ("return", (await post(f"/api/returns/{return_id}/finalize")).status_code)
+
+            tasks = [finalize_invoice(i) for i in draft_ids] + [finalize_return(r) for r in return_ids]
+            outcomes = await asyncio.gather(*tasks)
+
+        sold = sum(1 for kind, code in outcomes if kind == "invoice" and code == 200)
+        returned = sum(1 for kind, code in outcomes if kind == "return" and code == 200)
+        errors = sorted({code for _, code in outcomes if code >= 500})
+
+        header = await db.inventory_headers.find_one({"id": header_id}, {"_id": 0})
+        moved = await db.stock_movements.aggregate([
+            {"$match": {
+                "$or": [{"header_id": header_id}, {"header_name": HEADER_NAME}],
+                "date": {"$gte": run_started},
+                "is_deleted": {"$ne": True}
+            }},
+            {"$group": {"_id": None, "qty": {"$sum": "$qty_delta"}, "weight": {"$sum": "$weight_delta"}}}
+        ]).to_list(1)
+        moved_qty = moved[0]["qty"] if moved else 0
+        moved_weight = moved[0]["weight"] if moved else 0.0
+
+        expected_qty = start_qty - sold + returned
+        expected_weight = round(start_weight + (returned - sold) * args.weight, 3)
+        final_qty = round(header["current_qty"], 6)
+        final_weight = round(header["current_weight"], 3)
+
+        print(f"drafts={args.invoices} returns={args.returns} stock_at_start={start_qty}")
+        print(f"finalized={sold} returned={returned} server_errors={errors or 'none'}")
+        print(f"qty    : final={final_qty} expected={expected_qty} start+movements={round(start_qty + moved_qty, 6)}")
+        print(f"weight : final={final_weight} expected={expected_weight} start+movements={round(start_weight + moved_weight, 3)}")
+
+        ok = (
+            not errors
+            and final_qty == expected_qty
+            and abs(final_weight - expected_weight) < 0.001
+            and final_qty == round(start_qty + moved_qty, 6)
+            and abs(final_weight - (start_weight + moved_weight)) < 0.001
+            and final_qty >= 0
+            and final_weight >= 0
+            and 0 < sold <= start_qty + returned
+        )
+        if sold == 0:
+            print("❌ No invoice was finalized - the race did not exercise the stock guards")
+        print("✅ No drift detected" if ok else "❌ DRIFT DETECTED")
+        return ok
+    finally:
+        await server.client.drop_database(args.db_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-name", required=True, help="Dedicated test database (must end with _test or _stress)")
+    parser.add_argument("--invoices", type=int, default=100, help="Draft invoices finalized concurrently")
+    parser.add_argument("--returns", type=int, default=20, help="Sales returns finalized concurrently")
+    parser.add_argument("--stock-qty", type=int, default=50, help="Pieces on the shelf when the race starts")
+    parser.add_argument("--weight", type=float, default=2.5, help="Grams per piece")
+    args = parser.parse_args()
+
+    problem = check_database_name(args.db_name)
+    if problem:
+        parser.error(f"refusing to run: {problem}")
+    ok = asyncio.run(run(args))
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
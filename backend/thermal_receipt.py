@@ -0,0 +1,213 @@
+"""
+Thermal Receipt Rendering
+-------------------------
+Compact receipt output for 80mm thermal printers, built from the same invoice
+data and calculation summary as the A4 invoice PDF.
+
+The receipt is laid out once as a list of ReceiptLine rows (fixed 48-column
+width, the Font A line length of an 80mm printer) and then rendered to:
+- ESC/POS bytes, sent straight to the printer
+- plain text
+- a narrow PDF (80mm wide, height fitted to the content)
+
+Text and ESC/POS rendering are pure string work and take well under a
+millisecond; the narrow PDF uses ReportLab (imported lazily) with the builtin
+Courier font, so no font files are loaded.
+"""
+
+from io import BytesIO
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from invoice_calculator import format_calculation_summary
+
+
+RECEIPT_WIDTH = 48  # characters per line (80mm paper, Font A)
+RECEIPT_FORMATS = ("escpos", "text", "pdf")
+
+# Narrow PDF geometry (points): 80mm paper with ~4mm margins, Courier 7pt
+# (0.6em advance) fits 48 characters in the 72mm printable width
+PDF_PAPER_WIDTH = 226.77
+PDF_MARGIN = 11.0
+PDF_FONT_SIZE = 7
+PDF_LINE_HEIGHT = 9
+
+# ESC/POS command bytes
+ESC_INIT = b"\x1b@"
+ESC_CODEPAGE_WPC1252 = b"\x1bt\x10"
+ESC_ALIGN = {"left": b"\x1ba\x00", "center": b"\x1ba\x01", "right": b"\x1ba\x02"}
+ESC_BOLD_ON = b"\x1bE\x01"
+ESC_BOLD_OFF = b"\x1bE\x00"
+GS_SIZE_DOUBLE = b"\x1d!\x11"
+GS_SIZE_NORMAL = b"\x1d!\x00"
+ESC_FEED_LINES = b"\x1bd\x04"
+GS_PARTIAL_CUT = b"\x1dVB\x00"
+
+
+class ReceiptLine(NamedTuple):
+    text: str
+    align: str = "left"
+    bold: bool = False
+    double: bool = False
+
+
+def _money(value: Any) -> str:
+    return f"{float(value or 0):.3f}"
+
+
+def _columns(left: str, right: str, width: int = RECEIPT_WIDTH) -> str:
+    """Left text and right-aligned value on one line (left side truncated to fit)."""
+    room = width - len(right) - 1
+    return f"{left[:room]:<{room}} {right}"
+
+
+def _wrap(text: str, width: int = RECEIPT_WIDTH, indent: str = "  ") -> List[str]:
+    """Word-wrap text to the receipt width; continuation lines are indented."""
+    lines, current = [], ""
+    for word in text.split():
+        candidate = f"{current} {word}" if current else word
+        if len(candidate) <= width:
+            current = candidate
+            continue
+        if current:
+            lines.append(current)
+        current = indent + word
+        while len(current) > width:
+            lines.append(current[:width])
+            current = indent + current[width:]
+    if current:
+        lines.append(current)
+    return lines
+
+
+def build_receipt(invoice: Dict[str, Any], shop: Optional[Dict[str, Any]] = None, breakdown: bool = False) -> List[ReceiptLine]:
+    """
+    Lay out a receipt for an invoice.
+
+    Args:
+        invoice: Invoice document with numeric amounts (decimal_to_float output)
+        shop: Shop settings (shop_name, address, phone)
+        breakdown: Append the calculation formulas from format_calculation_summary
+
+    Returns:
+        Receipt rows, each at most RECEIPT_WIDTH characters
+    """
+    shop = shop or {}
+    rule = ReceiptLine("-" * RECEIPT_WIDTH)
+    items = invoice.get('items', [])
+
+    lines = [ReceiptLine(shop.get('shop_name', 'Gold Shop ERP')[:RECEIPT_WIDTH // 2], "center", True, True)]
+    for field in ('address', 'phone'):
+        if shop.get(field):
+            lines.extend(ReceiptLine(text, "center") for text in _wrap(shop[field]))
+    lines.append(rule)
+
+    date_str = str(invoice.get('date', ''))[:10]
+    lines.append(ReceiptLine(_columns(f"Invoice: {invoice.get('invoice_number', '')}", date_str)))
+    lines.append(ReceiptLine(f"Customer: {invoice.get('customer_name') or 'Walk-in'}"[:RECEIPT_WIDTH]))
+    lines.append(rule)
+
+    # Items: description on its own line, qty/weight/total underneath
+    lines.append(ReceiptLine(_columns("Item", "Total"), bold=True))
+    for item in items:
+        lines.append(ReceiptLine((item.get('description') or item.get('category') or 'Item')[:RECEIPT_WIDTH]))
+        detail = f"  {item.get('qty', 1)} x {float(item.get('weight', 0) or 0):.3f}g @ {_money(item.get('metal_rate'))}"
+        lines.append(ReceiptLine(_columns(detail, _money(item.get('line_total')))))
+    lines.append(rule)
+
+    # Totals
+    discount = float(invoice.get('discount_amount') or 0)
+    lines.append(ReceiptLine(_columns("Subtotal", _money(invoice.get('subtotal')))))
+    if discount > 0:
+        lines.append(ReceiptLine(_columns("Discount", f"-{_money(discount)}")))
+    lines.append(ReceiptLine(_columns("VAT", _money(invoice.get('vat_total')))))
+    lines.append(ReceiptLine(_columns("TOTAL OMR", _money(invoice.get('grand_total'))), bold=True))
+    paid = float(invoice.get('paid_amount') or 0)
+    if paid > 0:
+        lines.append(ReceiptLine(_columns("Paid", _money(paid))))
+        lines.append(ReceiptLine(_columns("Balance Due", _money(invoice.get('balance_due')))))
+
+    if breakdown:
+        # Stored invoices do not always carry the component totals the summary expects
+        summary_input = dict(invoice)
+        summary_input.setdefault('metal_total', sum(float(i.get('gold_value', 0) or 0) for i in items))
+        summary_input.setdefault('making_total', sum(float(i.get('making_value', 0) or 0) for i in items))
+        summary_input['discount_amount'] = discount
+        lines.append(rule)
+        for formula in format_calculation_summary(summary_input).values():
+            lines.extend(ReceiptLine(text) for text in _wrap(formula))
+
+    lines.append(rule)
+    lines.append(ReceiptLine("Thank you for your business!", "center"))
+    return lines
+
+
+def render_text(lines: List[ReceiptLine]) -> str:
+    """Plain-text receipt (alignment applied with spaces; bold/size dropped)."""
+    out = []
+    for line in lines:
+        if line.align == "center":
+            out.append(line.text.center(RECEIPT_WIDTH).rstrip())
+        elif line.align == "right":
+            out.append(line.text.rjust(RECEIPT_WIDTH))
+        else:
+            out.append(line.text)
+    return "\n".join(out) + "\n"
+
+
+def render_escpos(lines: List[ReceiptLine]) -> bytes:
+    """ESC/POS byte stream: init, WPC1252 code page, rows, feed and partial cut."""
+    out = bytearray(ESC_INIT + ESC_CODEPAGE_WPC1252)
+    for line in lines:
+        out += ESC_ALIGN.get(line.align, ESC_ALIGN["left"])
+        if line.bold:
+            out += ESC_BOLD_ON
+        if line.double:
+            out += GS_SIZE_DOUBLE
+        out += line.text.encode("cp1252", errors="replace") + b"\n"
+        if line.double:
+            out += GS_SIZE_NORMAL
+        if line.bold:
+            out += ESC_BOLD_OFF
+    out += ESC_ALIGN["left"] + ESC_FEED_LINES + GS_PARTIAL_CUT
+    return bytes(out)
+
+
+def render_narrow_pdf(lines: List[ReceiptLine]) -> bytes:
+    """80mm-wide single-page PDF; the page height is fitted to the receipt."""
+    from reportlab.pdfgen import canvas
+
+    heights = [PDF_LINE_HEIGHT * (2 if line.double else 1) for line in lines]
+    page_height = sum(heights) + 2 * PDF_MARGIN
+    buffer = BytesIO()
+    p = canvas.Canvas(buffer, pagesize=(PDF_PAPER_WIDTH, page_height), pageCompression=0)
+    right_edge = PDF_PAPER_WIDTH - PDF_MARGIN
+    y = page_height - PDF_MARGIN
+    for line, line_height in zip(lines, heights):
+        y -= line_height
+        font = "Courier-Bold" if line.bold else "Courier"
+        size = PDF_FONT_SIZE * (2 if line.double else 1)
+        p.setFont(font, size)
+        if line.align == "center":
+            p.drawCentredString(PDF_PAPER_WIDTH / 2, y, line.text)
+        elif line.align == "right":
+            p.drawRightString(right_edge, y, line.text)
+        else:
+            p.drawString(PDF_MARGIN, y, line.text)
+    p.showPage()
+    p.save()
+    return buffer.getvalue()
+
+
+def render_receipt(invoice: Dict[str, Any], shop: Optional[Dict[str, Any]] = None, output_format: str = "escpos", breakdown: bool = False):
+    """
+    Build and render a receipt in one call.
+
+    Returns:
+        bytes for "escpos" and "pdf", str for "text"
+    """
+    lines = build_receipt(invoice, shop, breakdown)
+    if output_format == "text":
+        return render_text(lines)
+    if output_format == "pdf":
+        return render_narrow_pdf(lines)
+    return render_escpos(lines)
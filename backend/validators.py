@@ -1,14 +1,33 @@
-from pydantic import BaseModel, Field, validator
-from typing import Optional
+from pydantic import BaseModel, Field, BeforeValidator, validator
+from typing import Annotated, Any, Optional
 import re
 import bleach
 import html
 
 
+# ============================================================================
+# PRECOMPILED PATTERNS
+# ============================================================================
+# Compiled once at import time - these run on every validated request field.
+
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+PHONE_STRIP_PATTERN = re.compile(r'[^\d\s\-\+\(\)]')
+PHONE_FORMAT_PATTERN = re.compile(r'^\+?[\d\s\-()]+$')
+NUMERIC_STRIP_PATTERN = re.compile(r'[^\d\.\-]')
+USERNAME_STRIP_PATTERN = re.compile(r'[^\w\-\.]')
+
+
 # ============================================================================
 # INPUT SANITIZATION UTILITIES
 # ============================================================================
 
+def _needs_markup_cleaning(text: str) -> bool:
+    """
+    Fast path check: text without '<' or '&' cannot carry a tag or an entity,
+    so the (expensive) bleach parse can be skipped entirely.
+    """
+    return '<' in text or '&' in text
+
 def sanitize_html(text: Optional[str]) -> Optional[str]:
     """
     Remove all HTML tags and script content from text input.
@@ -16,6 +35,8 @@ def sanitize_html(text: Optional[str]) -> Optional[str]:
     """
     if text is None:
         return None
+    if not _needs_markup_cleaning(text):
+        return text.strip()
     # Remove all HTML tags including scripts
     cleaned = bleach.clean(text, tags=[], strip=True)
     return cleaned.strip()
@@ -56,8 +77,7 @@ def sanitize_email(email: Optional[str]) -> Optional[str]:
     email = email.strip().lower()
     
     # Basic email validation pattern
-    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    if not re.match(email_pattern, email):
+    if not EMAIL_PATTERN.match(email):
         raise ValueError('Invalid email format')
     
     return email
@@ -73,7 +93,7 @@ def sanitize_phone(phone: Optional[str]) -> Optional[str]:
     phone = sanitize_html(phone)
     
     # Allow only valid phone characters
-    phone = re.sub(r'[^\d\s\-\+\(\)]', '', phone)
+    phone = PHONE_STRIP_PATTERN.sub('', phone)
     
     return phone.strip() if phone else None
 
@@ -89,7 +109,7 @@ def sanitize_numeric_string(value: str) -> str:
     value = sanitize_html(str(value))
     
     # Keep only numbers, decimal point, and minus sign
-    value = re.sub(r'[^\d\.\-]', '', value)
+    value = NUMERIC_STRIP_PATTERN.sub('', value)
     
     return value
 
@@ -118,49 +138,65 @@ def validate_purity(purity: int) -> int:
     return purity
 
 
+# ============================================================================
+# SCHEMA-AWARE SANITIZATION (field annotations)
+# ============================================================================
+# Sanitization is declared per field on the Pydantic models instead of being
+# applied to every string of every request body. IDs, dates, enums and numbers
+# are never touched; only fields annotated with one of the types below are
+# cleaned, and they are cleaned while the model validates.
+
+def _clean_markup(value: Any) -> Any:
+    """BeforeValidator hook: strip HTML from string input, pass anything else through."""
+    if isinstance(value, str):
+        return sanitize_html(value)
+    return value
+
+def _clean_text(max_length: int):
+    """Build a BeforeValidator hook that applies sanitize_text_field with a length cap."""
+    def _hook(value: Any) -> Any:
+        if isinstance(value, str):
+            return sanitize_text_field(value, max_length=max_length)
+        return value
+    return _hook
+
+def sanitized_text(max_length: int, required: bool = False):
+    """
+    Annotated string type that is HTML-stripped, escaped and truncated to
+    max_length during validation (see sanitize_text_field).
+
+    Blank input collapses to None, so a required field rejects it.
+    """
+    base = str if required else Optional[str]
+    return Annotated[base, BeforeValidator(_clean_text(max_length))]
+
+# Free text stored as-is apart from HTML removal (names, notes on core models)
+SafeStr = Annotated[str, BeforeValidator(_clean_markup)]
+
+
 class PartyValidator(BaseModel):
-    name: str = Field(..., min_length=1, max_length=100)
+    name: sanitized_text(100, required=True) = Field(..., min_length=1, max_length=100)
     phone: Optional[str] = Field(None, max_length=20)
-    address: Optional[str] = Field(None, max_length=500)
+    address: sanitized_text(500) = Field(None, max_length=500)
     party_type: str = Field(..., pattern="^(customer|vendor|worker)$")
-    notes: Optional[str] = Field(None, max_length=1000)
-    
-    @validator('name')
-    def sanitize_name(cls, v):
-        return sanitize_text_field(v, max_length=100)
+    notes: sanitized_text(1000) = Field(None, max_length=1000)
     
     @validator('phone')
     def validate_phone(cls, v):
         if v:
             v = sanitize_phone(v)
-            if v and not re.match(r'^\+?[\d\s\-()]+$', v):
+            if v and not PHONE_FORMAT_PATTERN.match(v):
                 raise ValueError('Invalid phone number format')
         return v
-    
-    @validator('address')
-    def sanitize_address(cls, v):
-        return sanitize_text_field(v, max_length=500)
-    
-    @validator('notes')
-    def sanitize_notes(cls, v):
-        return sanitize_text_field(v, max_length=1000)
 
 class StockMovementValidator(BaseModel):
     movement_type: str = Field(..., pattern="^(Stock IN|Stock OUT|Adjustment IN|Adjustment OUT|Transfer)$")
     header_id: str = Field(..., min_length=1)
-    description: str = Field(..., min_length=1, max_length=200)
+    description: sanitized_text(200, required=True) = Field(..., min_length=1, max_length=200)
     qty_delta: float = Field(..., ge=-10000, le=10000)
     weight_delta: float = Field(..., ge=-10000, le=10000)
     purity: int = Field(..., ge=1, le=999)
-    notes: Optional[str] = Field(None, max_length=500)
-    
-    @validator('description')
-    def sanitize_description(cls, v):
-        return sanitize_text_field(v, max_length=200)
-    
-    @validator('notes')
-    def sanitize_notes(cls, v):
-        return sanitize_text_field(v, max_length=500)
+    notes: sanitized_text(500) = Field(None, max_length=500)
     
     @validator('purity')
     def validate_purity_range(cls, v):
@@ -169,33 +205,17 @@ class StockMovementValidator(BaseModel):
 class JobCardValidator(BaseModel):
     card_type: str = Field(..., pattern="^(repair|custom|polish|resize)$")
     customer_id: Optional[str] = None
-    customer_name: Optional[str] = Field(None, max_length=100)
+    customer_name: sanitized_text(100) = Field(None, max_length=100)
     worker_id: Optional[str] = None
-    worker_name: Optional[str] = Field(None, max_length=100)
+    worker_name: sanitized_text(100) = Field(None, max_length=100)
     delivery_date: Optional[str] = None
-    notes: Optional[str] = Field(None, max_length=1000)
-    
-    @validator('customer_name')
-    def sanitize_customer_name(cls, v):
-        return sanitize_text_field(v, max_length=100)
-    
-    @validator('worker_name')
-    def sanitize_worker_name(cls, v):
-        return sanitize_text_field(v, max_length=100)
-    
-    @validator('notes')
-    def sanitize_notes(cls, v):
-        return sanitize_text_field(v, max_length=1000)
+    notes: sanitized_text(1000) = Field(None, max_length=1000)
 
 class AccountValidator(BaseModel):
-    name: str = Field(..., min_length=1, max_length=100)
+    name: sanitized_text(100, required=True) = Field(..., min_length=1, max_length=100)
     account_type: str = Field(..., pattern="^(cash|bank|credit_card|mobile_wallet)$")
     opening_balance: float = Field(default=0, ge=-1000000, le=1000000)
     
-    @validator('name')
-    def sanitize_name(cls, v):
-        return sanitize_text_field(v, max_length=100)
-    
     @validator('opening_balance')
     def validate_balance(cls, v):
         return validate_amount(v)
@@ -205,22 +225,10 @@ class TransactionValidator(BaseModel):
     mode: str = Field(..., pattern="^(cash|bank_transfer|card|cheque|online)$")
     account_id: str = Field(..., min_length=1)
     party_id: Optional[str] = None
-    party_name: Optional[str] = Field(None, max_length=100)
+    party_name: sanitized_text(100) = Field(None, max_length=100)
     amount: float = Field(..., gt=0, le=1000000)
-    category: str = Field(..., max_length=50)
-    notes: Optional[str] = Field(None, max_length=500)
-    
-    @validator('party_name')
-    def sanitize_party_name(cls, v):
-        return sanitize_text_field(v, max_length=100)
-    
-    @validator('category')
-    def sanitize_category(cls, v):
-        return sanitize_text_field(v, max_length=50)
-    
-    @validator('notes')
-    def sanitize_notes(cls, v):
-        return sanitize_text_field(v, max_length=500)
+    category: sanitized_text(50, required=True) = Field(..., max_length=50)
+    notes: sanitized_text(500) = Field(None, max_length=500)
     
     @validator('amount')
     def validate_amount_range(cls, v):
@@ -229,7 +237,7 @@ class TransactionValidator(BaseModel):
 class UserUpdateValidator(BaseModel):
     username: Optional[str] = Field(None, min_length=3, max_length=50)
     email: Optional[str] = Field(None, pattern=r'^[\w\.-]+@[\w\.-]+\.\w+$')
-    full_name: Optional[str] = Field(None, min_length=1, max_length=100)
+    full_name: sanitized_text(100) = Field(None, min_length=1, max_length=100)
     role: Optional[str] = Field(None, pattern="^(admin|manager|staff)$")
     is_active: Optional[bool] = None
     
@@ -238,16 +246,12 @@ class UserUpdateValidator(BaseModel):
         if v:
             # Remove HTML but keep alphanumeric and basic chars
             v = sanitize_html(v)
-            v = re.sub(r'[^\w\-\.]', '', v)
+            v = USERNAME_STRIP_PATTERN.sub('', v)
         return v
     
     @validator('email')
     def sanitize_email_field(cls, v):
         return sanitize_email(v) if v else None
-    
-    @validator('full_name')
-    def sanitize_full_name(cls, v):
-        return sanitize_text_field(v, max_length=100)
 
 class PasswordChangeValidator(BaseModel):
     new_password: str = Field(..., min_length=6, max_length=100)
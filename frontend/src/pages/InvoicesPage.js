@@ -167,9 +167,15 @@ export default function InvoicesPage() {
     }
   };
 
-  const handleViewInvoice = (invoice) => {
-    setViewInvoice(invoice);
-    setShowViewDialog(true);
+  const handleViewInvoice = async (invoice) => {
+    // List rows are summaries (no items) - load the full invoice for the dialog
+    try {
+      const response = await API.get(`/api/invoices/${invoice.id}`);
+      setViewInvoice(response.data);
+      setShowViewDialog(true);
+    } catch (error) {
+      toast.error('Failed to load invoice details');
+    }
   };
 
   const handleOpenPaymentDialog = (invoice) => {
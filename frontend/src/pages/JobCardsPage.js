@@ -453,7 +453,20 @@ export default function JobCardsPage() {
     }
   };
 
-  const handleEditJobCard = (jobcard) => {
+  // List rows are summaries (no items) - dialogs load the full job card
+  const loadFullJobCard = async (jobcard) => {
+    try {
+      const response = await API.get(`/api/jobcards/${jobcard.id}`);
+      return response.data;
+    } catch (error) {
+      toast.error('Failed to load job card details');
+      return null;
+    }
+  };
+
+  const handleEditJobCard = async (listJobCard) => {
+    const jobcard = await loadFullJobCard(listJobCard);
+    if (!jobcard) return;
     setEditingJobCard(jobcard);
     // delivery_date is already in YYYY-MM-DD format (date-only field)
     const deliveryDate = jobcard.delivery_date || '';
@@ -469,7 +482,7 @@ export default function JobCardsPage() {
       notes: jobcard.notes || '',
       gold_rate_at_jobcard: jobcard.gold_rate_at_jobcard || '',  // MODULE 8: Load gold rate
       status: jobcard.status || 'created',
-      items: jobcard.items.map(item => ({
+      items: (jobcard.items || []).map(item => ({
         ...item,
         making_charge_type: item.making_charge_type || 'flat',
         making_charge_value: item.making_charge_value || 0,
@@ -479,7 +492,9 @@ export default function JobCardsPage() {
     setShowDialog(true);
   };
 
-  const handleViewJobCard = (jobcard) => {
+  const handleViewJobCard = async (listJobCard) => {
+    const jobcard = await loadFullJobCard(listJobCard);
+    if (!jobcard) return;
     setViewJobCard(jobcard);
     setShowViewDialog(true);
   };
@@ -727,7 +742,7 @@ export default function JobCardsPage() {
                     </td>
                     <td className="px-4 py-3 text-sm">{formatDate(jc.created_at || jc.date_created)}</td>
                     <td className="px-4 py-3">{getStatusBadge(jc.status)}</td>
-                    <td className="px-4 py-3 text-sm">{(jc.items && jc.items.length) || 0} items</td>
+                    <td className="px-4 py-3 text-sm">{jc.item_count !== undefined ? jc.item_count : ((jc.items && jc.items.length) || 0)} items</td>
                     <td className="px-4 py-3">
                       <div className="flex gap-2">
                         {/* View button - always available */}
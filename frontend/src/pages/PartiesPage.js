@@ -202,7 +202,16 @@ export default function PartiesPage() {
     }
   };
 
-  const handleEdit = (party) => {
+  const handleEdit = async (listParty) => {
+    // List rows are summaries - load the full party (notes) before editing
+    let party;
+    try {
+      const response = await API.get(`/api/parties/${listParty.id}`);
+      party = response.data;
+    } catch (error) {
+      toast.error('Failed to load party details');
+      return;
+    }
     setEditingParty(party);
     setFormData({
       name: party.name,
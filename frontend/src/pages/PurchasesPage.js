@@ -175,7 +175,20 @@ export default function PurchasesPage() {
     setSearchParams({ page: newPage.toString() });
   };
 
-  const handleOpenDialog = (purchase = null) => {
+  // List rows are summaries - dialogs work on the full purchase document
+  const loadFullPurchase = async (purchase) => {
+    try {
+      const response = await API.get(`/api/purchases/${purchase.id}`);
+      return response.data;
+    } catch (error) {
+      toast.error('Failed to load purchase details');
+      return null;
+    }
+  };
+
+  const handleOpenDialog = async (listPurchase = null) => {
+    const purchase = listPurchase ? await loadFullPurchase(listPurchase) : null;
+    if (listPurchase && !purchase) return;
     if (purchase) {
       setEditingPurchase(purchase);
       setFormData({
@@ -378,7 +391,9 @@ export default function PurchasesPage() {
     }
   };
 
-  const handleViewPurchase = (purchase) => {
+  const handleViewPurchase = async (listPurchase) => {
+    const purchase = await loadFullPurchase(listPurchase);
+    if (!purchase) return;
     setViewPurchase(purchase);
     setShowViewDialog(true);
   };
@@ -309,8 +309,11 @@ const ReturnsPage = () => {
   };
   
   // Open edit dialog for draft returns
-  const openEditDialog = async (returnObj) => {
+  const openEditDialog = async (listReturn) => {
     try {
+      // List rows are summaries (no items) - load the full return
+      const { data: returnObj } = await API.get(`/api/returns/${listReturn.id}`);
+      
       // Load reference data
       await loadReferenceData(returnObj.return_type);
       
@@ -406,9 +409,12 @@ const ReturnsPage = () => {
   const openFinalizeDialog = async (returnObj) => {
     try {
       // Fetch finalize impact
-      const response = await API.get(`/api/returns/${returnObj.id}/finalize-impact`);
+      const [response, fullReturn] = await Promise.all([
+        API.get(`/api/returns/${returnObj.id}/finalize-impact`),
+        API.get(`/api/returns/${returnObj.id}`)
+      ]);
       setFinalizeImpact(response.data);
-      setSelectedReturn(returnObj);
+      setSelectedReturn(fullReturn.data);
       setShowFinalizeDialog(true);
     } catch (err) {
       console.error('Error fetching finalize impact:', err);